@@ -1,41 +1,182 @@
 from fastapi import HTTPException, Response, status
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 from pathlib import Path
-from generate import generate_text
+from dataclasses import asdict
+from generate import Generation, generate_text
+from response_cache import cache_key
+from config import GenerationParams
+from schemas import GenerateRequest, BatchGenerateRequest
+from executor import QueueFullError, saturation
+from batching import ContinuousBatcher
+from ipc import InferenceClient
+from streaming import TokenStreamer, CancelToken, format_event
+from bulk import generate_bulk
+from registry import generate_on
+from metrics import REGISTRY, REQUEST_DURATION, REQUESTS_IN_FLIGHT, REQUESTS_SHED, TOKENS_PER_SECOND
+from logs import sampled, truncate
 import time 
+import asyncio
 import logging
+import scheduling
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+def _model(request: Request, payload: GenerateRequest) -> str:
+    # the registry model a request asks for, None for the default model
+    name = payload.model
+    if not name or name == getattr(request.app.state, 'model_name', None):
+        return None
+    registry = getattr(request.app.state, 'registry', None)
+    if registry is None or name not in registry:
+        warning = f"Unknown model {name}"
+        logger.warning(warning)
+        raise HTTPException(status_code=404, detail=warning)
+    return name
+
+async def _generate_on(request: Request, model: str, prompt: str, params: GenerationParams, streamer: TokenStreamer = None):
+    # loaded here, or in the inference process when this is an HTTP worker
+    client = getattr(request.app.state, 'batcher', None)
+    if isinstance(client, InferenceClient):
+        return await client.submit(prompt, params, streamer=streamer, model=model)
+    return await generate_on(request.app.state, model, prompt, params, streamer)
+
+async def _generate(request: Request, prompt: str, params: GenerationParams, model: str = None):
+    if model:
+        return await _generate_on(request, model, prompt, params)
+    
+    batcher = getattr(request.app.state, 'batcher', None)
+    if batcher:
+        # batched with other concurrent prompts into a single generate call
+        return await batcher.submit(prompt, params)
+    
+    # run inference on the executor thread pool so the event loop keeps serving
+    token = CancelToken()
+    try:
+        return await request.app.state.executor.submit(generate_text,
+            prompt, 
+            request.app.state.tokenizer, 
+            request.app.state.model, 
+            request.app.state.device,
+            params,
+            token,
+            prefix_cache=getattr(request.app.state, 'prefix_cache', None),
+            prompt_cache=getattr(request.app.state, 'prompt_cache', None),
+            speculative=getattr(request.app.state, 'speculative', None))
+    except asyncio.CancelledError:
+        # the client went away, stop decoding
+        token.cancel()
+        raise
+
+def _request_finished(endpoint: str, start_time: float, generation: Generation = None):
+    elapsed = time.perf_counter() - start_time
+    REQUESTS_IN_FLIGHT.dec()
+    REQUEST_DURATION.observe(elapsed, endpoint=endpoint)
+    if generation is not None and generation.generated_tokens and elapsed > 0:
+        TOKENS_PER_SECOND.observe(generation.generated_tokens / elapsed)
+
+def _schedule(payload: GenerateRequest) -> scheduling.Schedule:
+    # the deadline counts from now, the request's queueing and generation are ordered by it
+    schedule = scheduling.Schedule.within(payload.priority, payload.deadline)
+    scheduling.current.set(schedule)
+    return schedule
+
+async def _disconnected(request: Request):
+    # the body has been read, so the next message is the client hanging up
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+async def _unless_disconnected(request: Request, awaitable):
+    # the awaitable's result, or None if the client hangs up first, in which case it is
+    # cancelled so no more decode steps go into a response nobody will read
+    task = asyncio.ensure_future(awaitable)
+    disconnect = asyncio.ensure_future(_disconnected(request))
+    try:
+        await asyncio.wait((task, disconnect), return_when=asyncio.FIRST_COMPLETED)
+        return task.result() if task.done() else None
+    finally:
+        disconnect.cancel()
+        task.cancel()
+
+async def _generate_cacheable(request: Request, prompt: str, params: GenerationParams, model: str = None):
+    # cached as a plain dict so a shared backend can store it as JSON
+    return asdict(await _generate(request, prompt, params, model))
+
 @router.post("/generate")
-async def generate_handler(request: Request, payload: dict):
-    logger.info(f"Received payload: {payload}")
+async def generate_handler(request: Request, payload: GenerateRequest):
+    config = request.app.state.config
+    # the payload and output of only a sample of requests, cut short, so logging stays
+    # cheap under load and does not flood the log pipeline
+    log_payload = sampled(config.log_sample_rate)
+    if log_payload:
+        logger.info("Received payload: %s", truncate(str(payload.model_dump(exclude_none=True)), config.log_max_chars))
         
-    prompt = payload.get('prompt')
+    prompt = payload.prompt
     if not prompt:
         warning = "No prompt provided in payload"
         logger.warning(warning)
         raise HTTPException(status_code=400, detail = warning)
+    
+    # server defaults with the request's overrides, built once per request
+    params = config.resolve(payload)
+    model = _model(request, payload)
+    schedule = _schedule(payload)
         
-    start_time = time.time()
-    logger.info(f"Prompt extracted: {prompt}")
-                
+    # monotonic, so the measured time is immune to wall clock adjustments
+    start_time = time.perf_counter()
+    
+    REQUESTS_IN_FLIGHT.inc()
+    generation = None
     try:
-        generated_text = generate_text(prompt, 
-            request.app.state.tokenizer, 
-            request.app.state.model, 
-            request.app.state.device)
+        response_cache = getattr(request.app.state, 'response_cache', None)
         
-        response_time = round(time.time() - start_time, 2)
+        if response_cache is not None and params.deterministic:
+            # identical deterministic requests share one generation and its cached result
+            # registry models share the default model's mode and device, their name tells them apart
+            fingerprint = request.app.state.model_fingerprint + (f"|{model}" if model else "")
+            key = cache_key(fingerprint, prompt, params)
+            cached = await _unless_disconnected(request, response_cache.get_or_generate(key, 
+                lambda: _generate_cacheable(request, prompt, params, model),
+                cacheable=lambda value: value['finish_reason'] != "timeout"))
+            generation = Generation(**cached) if cached is not None else None
+        else:
+            generation = await _unless_disconnected(request, _generate(request, prompt, params, model))
         
-        result = {"generated_text": generated_text, "response_time": response_time}
+        if generation is None:
+            REQUESTS_SHED.inc(priority=schedule.priority, reason="disconnected")
+            logger.info("Client disconnected, generation cancelled")
+            # nginx's code for a request the client closed, only ever seen in logs
+            return Response(status_code=499)
         
-        logger.info(f"Response: {result['generated_text']}")
+        response_time = round(time.perf_counter() - start_time, 2)
+        
+        result = {
+            "generated_text": generation.text, 
+            "finish_reason": generation.finish_reason,
+            "generated_tokens": generation.generated_tokens,
+            "response_time": response_time
+        }
+        
+        if log_payload:
+            logger.info("Response: %s", truncate(generation.text, config.log_max_chars))
         
         return result
     
+    except QueueFullError as qe:
+        error = f"Service overloaded: {str(qe)}"
+        logger.warning(error)
+        raise HTTPException(status_code=503, detail=error, 
+            headers={"Retry-After": str(qe.retry_after)})
+    
+    except scheduling.DeadlineExceededError as de:
+        error = f"Deadline exceeded: {str(de)}"
+        logger.warning(error)
+        raise HTTPException(status_code=504, detail=error)
+    
     except ValueError as ve:
         error = f"ValueError occurred: {str(ve)}"
         logger.error(error)
@@ -52,7 +193,236 @@ async def generate_handler(request: Request, payload: dict):
         raise HTTPException(status_code=500, detail=error)
     
     finally:
-        logger.info(f"Total request time: {time.time() - start_time:.2f} seconds")
+        _request_finished("/generate", start_time, generation)
+        logger.info("Total request time: %.2f seconds", time.perf_counter() - start_time)
+
+async def _generate_streaming(request: Request, prompt: str, params: GenerationParams, streamer: TokenStreamer, model: str = None):
+    if model:
+        return await _generate_on(request, model, prompt, params, streamer)
+    
+    batcher = getattr(request.app.state, 'batcher', None)
+    if isinstance(batcher, (ContinuousBatcher, InferenceClient)):
+        # joins the running batch, here or in the inference process, and streams tokens as each decode step completes
+        return await batcher.submit(prompt, params, streamer=streamer)
+    
+    return await request.app.state.executor.submit(generate_text,
+        prompt, 
+        request.app.state.tokenizer, 
+        request.app.state.model, 
+        request.app.state.device,
+        params,
+        streamer,
+        getattr(request.app.state, 'prefix_cache', None),
+        prompt_cache=getattr(request.app.state, 'prompt_cache', None),
+        speculative=getattr(request.app.state, 'speculative', None))
+
+@router.post("/generate/stream")
+async def generate_stream_handler(request: Request, payload: GenerateRequest):
+    prompt = payload.prompt
+    if not prompt:
+        warning = "No prompt provided in payload"
+        logger.warning(warning)
+        raise HTTPException(status_code=400, detail = warning)
+    
+    params = request.app.state.config.resolve(payload)
+    model = _model(request, payload)
+    schedule = _schedule(payload)
+    
+    # Server-Sent Events when asked for, chunked NDJSON otherwise
+    sse = "text/event-stream" in request.headers.get("accept", "")
+    start_time = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    
+    tokenizer = request.app.state.tokenizer
+    if model:
+        tokenizer = await asyncio.to_thread(request.app.state.registry.tokenizer, model)
+    streamer = TokenStreamer(tokenizer, params.stop)
+    task = asyncio.ensure_future(_generate_streaming(request, prompt, params, streamer, model))
+    task.add_done_callback(lambda t: streamer.fail(t.exception()) if not t.cancelled() and t.exception() else None)
+    
+    # wait for the first chunk so an overloaded service can still answer with a plain 503
+    first = await streamer.get()
+    if isinstance(first, QueueFullError):
+        _request_finished("/generate/stream", start_time)
+        error = f"Service overloaded: {str(first)}"
+        logger.warning(error)
+        raise HTTPException(status_code=503, detail=error, 
+            headers={"Retry-After": str(first.retry_after)})
+    
+    if isinstance(first, scheduling.DeadlineExceededError):
+        _request_finished("/generate/stream", start_time)
+        error = f"Deadline exceeded: {str(first)}"
+        logger.warning(error)
+        raise HTTPException(status_code=504, detail=error)
+    
+    if isinstance(first, BaseException):
+        _request_finished("/generate/stream", start_time)
+        error = f"Model generation failed: {str(first)}"
+        logger.error(error)
+        raise HTTPException(status_code=500, detail=error)
+    
+    async def events():
+        item = first
+        generation = None
+        try:
+            while item is not None:
+                if isinstance(item, BaseException):
+                    logger.error("Streaming generation failed: %s", item)
+                    yield format_event({"error": str(item)}, sse, event="error")
+                    return
+                
+                yield format_event({"token": item}, sse)
+                if await request.is_disconnected():
+                    return
+                item = await streamer.get()
+            
+            generation = await task
+            time_to_first_token = None
+            if streamer.first_token_time is not None:
+                time_to_first_token = round(streamer.first_token_time - start_time, 3)
+            
+            yield format_event({
+                "generated_text": generation.text,
+                "finish_reason": generation.finish_reason,
+                "generated_tokens": generation.generated_tokens,
+                "time_to_first_token": time_to_first_token,
+                "response_time": round(time.perf_counter() - start_time, 2)
+            }, sse, event="done")
+        
+        finally:
+            _request_finished("/generate/stream", start_time, generation)
+            # the client disconnected or the stream ended; either way stop decoding
+            if not task.done():
+                streamer.cancel()
+                task.cancel()
+                REQUESTS_SHED.inc(priority=schedule.priority, reason="disconnected")
+                logger.info("Client disconnected, generation cancelled")
+    
+    media_type = "text/event-stream" if sse else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type, 
+        headers={"Cache-Control": "no-cache"})
+
+def _item_error(error: Exception) -> str:
+    # the same wording /generate uses for the status code it would have returned
+    if isinstance(error, ValidationError):
+        return "Invalid request: " + "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+    if isinstance(error, ValueError):
+        return f"ValueError occurred: {str(error)}"
+    if isinstance(error, RuntimeError):
+        return f"Model generation failed: {str(error)}"
+    return f"Unexpected error occurred: {str(error)}"
+
+def _parse_batch(request: Request, body: bytes) -> tuple[list, list]:
+    # (index, prompt, params) items to generate for and (index, error) pairs for the rest
+    config = request.app.state.config
+    items, errors = [], []
+    
+    if "application/x-ndjson" in request.headers.get("content-type", ""):
+        # one /generate payload per line, each with its own overrides
+        lines = [line for line in body.decode("utf-8").splitlines() if line.strip()]
+        for index, line in enumerate(lines):
+            try:
+                payload = GenerateRequest.model_validate_json(line)
+            except ValidationError as ve:
+                errors.append((index, _item_error(ve)))
+                continue
+            if not payload.prompt:
+                errors.append((index, "No prompt provided in payload"))
+                continue
+            if payload.model and payload.model != getattr(request.app.state, 'model_name', None):
+                errors.append((index, f"Only the default model answers batches, not {payload.model}"))
+                continue
+            items.append((index, payload.prompt, config.resolve(payload)))
+        return items, errors
+    
+    try:
+        payload = BatchGenerateRequest.model_validate_json(body)
+    except ValidationError as ve:
+        raise RequestValidationError(ve.errors())
+    params = config.resolve(payload)
+    for index, prompt in enumerate(payload.prompts):
+        if prompt:
+            items.append((index, prompt, params))
+        else:
+            errors.append((index, "No prompt provided in payload"))
+    return items, errors
+
+@router.post("/generate/batch")
+async def generate_batch_handler(request: Request):
+    # validating up to BULK_MAX_PROMPTS payloads takes a while, done in a worker thread
+    items, errors = await asyncio.to_thread(_parse_batch, request, await request.body())
+    
+    count = len(items) + len(errors)
+    if not count:
+        warning = "No prompts provided in payload"
+        logger.warning(warning)
+        raise HTTPException(status_code=400, detail = warning)
+    
+    limit = request.app.state.config.bulk_max_prompts
+    if count > limit:
+        warning = f"Too many prompts: {count} given, at most {limit} allowed"
+        logger.warning(warning)
+        raise HTTPException(status_code=413, detail = warning)
+    
+    logger.info("Received batch of %d prompts", count)
+    start_time = time.perf_counter()
+    
+    async def results():
+        failed = len(errors)
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            for index, error in errors:
+                yield format_event({"index": index, "error": error}, sse=False)
+            
+            # results are streamed as they complete, each tagged with its input index
+            async for index, outcome in generate_bulk(request.app.state, items):
+                if isinstance(outcome, BaseException):
+                    failed += 1
+                    logger.error("Batch item %d failed: %s", index, outcome)
+                    yield format_event({"index": index, "error": _item_error(outcome)}, sse=False)
+                    continue
+                
+                yield format_event({
+                    "index": index,
+                    "generated_text": outcome.text,
+                    "finish_reason": outcome.finish_reason,
+                    "generated_tokens": outcome.generated_tokens
+                }, sse=False)
+            
+            response_time = round(time.perf_counter() - start_time, 2)
+            logger.info("Batch of %d prompts finished in %.2f seconds with %d failures", count, response_time, failed)
+            yield format_event({"completed": count - failed, "failed": failed, "response_time": response_time}, sse=False)
+        
+        finally:
+            _request_finished("/generate/batch", start_time)
+    
+    return StreamingResponse(results(), media_type="application/x-ndjson", 
+        headers={"Cache-Control": "no-cache"})
+
+@router.get("/models")
+async def models_handler(request: Request):
+    # the default model and the registry's, with which of them are loaded right now
+    client = getattr(request.app.state, 'batcher', None)
+    registry = getattr(request.app.state, 'registry', None)
+    if isinstance(client, InferenceClient):
+        models = await client.models()
+    else:
+        models = registry.describe() if registry else []
+    # with MODEL_DIR_PATH under MODEL_ROOT_PATH the registry finds the default model too,
+    # which requests naming it never load, they go to the default model
+    default = getattr(request.app.state, 'model_name', None)
+    return {"default": default, "models": [model for model in models if model["name"] != default]}
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics_handler(request: Request):
+    # Prometheus text format; HTTP workers serve the inference process's metrics, which
+    # their own updates are forwarded to
+    client = getattr(request.app.state, 'batcher', None)
+    if isinstance(client, InferenceClient):
+        content = await client.metrics()
+    else:
+        content = REGISTRY.render()
+    return Response(content=content, media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # Serve openapi documentation UI
 @router.get("/docs", include_in_schema=False)
@@ -71,8 +441,28 @@ async def openapi_handler():
 
 @router.get("/health")
 async def health_check(request: Request):
+    # an HTTP worker is only as healthy as its link to the inference process
+    client = getattr(request.app.state, 'batcher', None)
+    if isinstance(client, InferenceClient) and not client.connected:
+        content = "Inference process not reachable"
+        logger.info(f"Health check failed - {content}")
+        
+        return Response(content='{"status": "unhealthy", "detail": "' + content + '"}', 
+            media_type="application/json", 
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    
+    # a pod that cannot warm up is restarted rather than left running unready
+    if getattr(request.app.state, 'warmup_failed', False):
+        content = "Warm-up failed"
+        logger.info(f"Health check failed - {content}")
+        
+        return Response(content='{"status": "unhealthy", "detail": "' + content + '"}', 
+            media_type="application/json", 
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    
     # Check if model and tokenizer are accessible and functional
-    if not hasattr(request.app.state, 'model') or not hasattr(request.app.state, 'tokenizer'):
+    loaded = hasattr(request.app.state, 'model') or isinstance(client, InferenceClient)
+    if not loaded or not hasattr(request.app.state, 'tokenizer'):
         content = "Model or tokenizer not loaded"
         logger.info(f"Health check failed - {content}")
         
@@ -80,4 +470,34 @@ async def health_check(request: Request):
             media_type="application/json", 
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
     
-    return {"status": "healthy"}
\ No newline at end of file
+    return {"status": "healthy"}
+
+@router.get("/ready")
+async def readiness_check(request: Request):
+    # separate from /health: a live pod only takes traffic once warm-up has finished
+    if not getattr(request.app.state, 'ready', False):
+        content = "Warm-up has not finished"
+        logger.info(f"Readiness check failed - {content}")
+        
+        return Response(content='{"status": "not ready", "detail": "' + content + '"}', 
+            media_type="application/json", 
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    
+    # an overloaded pod leaves the rotation until it has drained, so new requests go to
+    # replicas that can start on them right away
+    client = getattr(request.app.state, 'batcher', None)
+    if isinstance(client, InferenceClient):
+        used = await client.saturation()
+    elif hasattr(request.app.state, 'executor'):
+        used = saturation(request.app.state)
+    else:
+        used = 0
+    if used >= request.app.state.config.ready_max_saturation:
+        content = f"Inference queue is {used:.0%} full"
+        logger.info(f"Readiness check failed - {content}")
+        
+        return Response(content='{"status": "overloaded", "detail": "' + content + '"}', 
+            media_type="application/json", 
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    
+    return {"status": "ready"}
\ No newline at end of file
@@ -0,0 +1,341 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+import itertools
+import torch
+import scheduling
+from config import GenerationParams
+from generate import Generation, generate_batch, new_sequence, decode_generations
+from decoding import DecodeBatch, prefill, release
+from executor import QueueFullError
+from tokenization import encode
+from metrics import QUEUE_WAIT, TOKENIZATION
+
+logger = logging.getLogger(__name__)
+
+# Collects concurrent /generate prompts into micro-batches and runs each batch as a
+# single padded generation on the inference executor. A batch is closed
+# when it reaches `max_batch_size`, when adding the next prompt would exceed
+# `max_batch_tokens` padded prompt tokens, or `max_wait_ms` after its first prompt.
+# Waiting prompts are taken in priority order, earliest deadline first within a priority
+# class, and those too close to their deadline for a first token are dropped instead of batched.
+class BatchScheduler:
+
+    def __init__(self, executor, tokenizer, model, device,
+            max_batch_size: int = None, max_wait_ms: float = None, max_batch_tokens: int = None, prefix_cache=None, prompt_cache=None):
+        self.executor = executor
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.prefix_cache = prefix_cache
+        self.prompt_cache = prompt_cache
+
+        self.max_batch_size = max_batch_size or int(os.environ.get('BATCH_MAX_SIZE', 8))
+        self.max_wait_ms = max_wait_ms or float(os.environ.get('BATCH_MAX_WAIT_MS', 10))
+        self.max_batch_tokens = max_batch_tokens or int(os.environ.get('BATCH_MAX_TOKENS', 4096))
+
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._pending = 0
+        self._worker = None
+        self._batches = set()
+        self._slots = None
+
+    @property
+    def pending(self) -> int:
+        # requests waiting for a batch or running in one
+        return self._pending
+
+    def start(self):
+        # one batch in flight per executor worker, the rest keep collecting
+        self._slots = asyncio.Semaphore(self.executor.max_workers)
+        self._worker = asyncio.create_task(self._run())
+        logger.info(f"Batch scheduler started with max batch size {self.max_batch_size}, "
+            f"max wait {self.max_wait_ms}ms and max batch tokens {self.max_batch_tokens}")
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+        await asyncio.gather(*self._batches, return_exceptions=True)
+        logger.info("Batch scheduler has been stopped.")
+
+    async def submit(self, prompt: str, params: GenerationParams = GenerationParams(), prompt_ids: list[int] = None) -> Generation:
+        if self._pending >= self.executor.max_queue_depth:
+            raise QueueFullError(self._pending, self.executor.retry_after)
+
+        # encoded once, here unless the caller has the token ids already, and batched as ids
+        if prompt_ids is None:
+            start_time = time.perf_counter()
+            prompt_ids = encode(self.tokenizer, prompt, params.max_length, self.prompt_cache)
+            TOKENIZATION.observe(time.perf_counter() - start_time)
+        future = asyncio.get_running_loop().create_future()
+        schedule = scheduling.current.get()
+
+        self._pending += 1
+        try:
+            await self._queue.put((schedule.key(), next(self._order), (prompt, prompt_ids, params, future, schedule)))
+            return await future
+        finally:
+            self._pending -= 1
+
+    async def _run(self):
+        carry = None
+        while True:
+            # a batch is made up once a slot is free for it, of the most urgent prompts by then
+            await self._slots.acquire()
+            first = carry or await self._next()
+            batch = [first]
+            carry = None
+
+            deadline = asyncio.get_running_loop().time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    # unlike wait_for, a timeout block never swallows a cancel from stop()
+                    async with asyncio.timeout(timeout):
+                        item = await self._next()
+                except TimeoutError:
+                    break
+
+                # prompts are left-padded to the longest one in the batch
+                longest = max(len(item[1]), *(len(b[1]) for b in batch))
+                if longest * (len(batch) + 1) > self.max_batch_tokens:
+                    carry = item
+                    break
+                batch.append(item)
+
+            # skip requests whose clients went away while they waited
+            batch = [b for b in batch if not b[3].done()]
+            if not batch:
+                self._slots.release()
+                continue
+
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _next(self):
+        while True:
+            _, _, item = await self._queue.get()
+            future, schedule = item[3], item[4]
+            if not future.done() and schedule.too_late:
+                future.set_exception(scheduling.shed(schedule))
+                continue
+            return item
+
+    async def _run_batch(self, batch):
+        # the batch waits for the executor as its most urgent prompt would
+        scheduling.current.set(min((b[4] for b in batch), key=lambda schedule: schedule.key()))
+        try:
+            prompts = [prompt for prompt, _, _, _, _ in batch]
+            logger.info("Running batch of %d prompts", len(prompts))
+
+            results = await self.executor.submit(generate_batch,
+                prompts,
+                self.tokenizer,
+                self.model,
+                self.device,
+                [params for _, _, params, _, _ in batch],
+                self.prefix_cache,
+                input_ids=[prompt_ids for _, prompt_ids, _, _, _ in batch],
+                deadlines=[schedule.deadline for _, _, _, _, schedule in batch])
+
+            for (_, _, _, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+        except Exception as e:
+            for _, _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+        finally:
+            self._slots.release()
+
+# Iteration-level batching: a dedicated thread steps the model one token at a time over
+# the running sequences. New prompts join the batch between steps, and a sequence leaves
+# as soon as it hits EOS or its token limit, so its response goes out immediately instead
+# of waiting for the longest generation in the batch. Waiting prompts join in priority
+# order, earliest deadline first within a priority class, and those too close to their
+# deadline for a first token are dropped instead of prefilled.
+class ContinuousBatcher:
+
+    def __init__(self, executor, tokenizer, model, device,
+            max_batch_size: int = None, max_batch_tokens: int = None, prefix_cache=None, prompt_cache=None, initializer=None):
+        self.executor = executor
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.prefix_cache = prefix_cache
+        self.prompt_cache = prompt_cache
+
+        self.max_batch_size = max_batch_size or int(os.environ.get('BATCH_MAX_SIZE', 8))
+        self.max_batch_tokens = max_batch_tokens or int(os.environ.get('BATCH_MAX_TOKENS', 4096))
+
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._carry = None
+        self._pending = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        # the running sequences' KV caches, only used by the decode thread
+        self._batch = DecodeBatch()
+        # runs first in the decode thread, which does every forward pass, to pin it to its cores
+        self._initializer = initializer
+
+    @property
+    def pending(self) -> int:
+        # requests waiting to join the batch or decoding in it
+        return self._pending
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="continuous-batcher", daemon=True)
+        self._thread.start()
+        logger.info(f"Continuous batcher started with max batch size {self.max_batch_size} "
+            f"and max batch tokens {self.max_batch_tokens}")
+
+    async def stop(self):
+        self._stopped.set()
+        if self._thread:
+            await asyncio.to_thread(self._thread.join)
+        logger.info("Continuous batcher has been stopped.")
+
+    async def submit(self, prompt: str, params: GenerationParams = GenerationParams(), streamer=None, prompt_ids: list[int] = None) -> Generation:
+        if self._pending >= self.executor.max_queue_depth:
+            raise QueueFullError(self._pending, self.executor.retry_after)
+
+        if prompt_ids is None:
+            start_time = time.perf_counter()
+            prompt_ids = encode(self.tokenizer, prompt, params.max_length, self.prompt_cache)
+            TOKENIZATION.observe(time.perf_counter() - start_time)
+        schedule = scheduling.current.get()
+        sequence = new_sequence(prompt_ids, self.tokenizer, params, streamer, schedule.deadline)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self._pending += 1
+        try:
+            self._queue.put((schedule.key(), next(self._order), schedule, (sequence, params, future, loop)))
+            return await future
+        except asyncio.CancelledError:
+            # client went away, stop spending decode steps on it
+            sequence.cancelled = True
+            raise
+        finally:
+            self._pending -= 1
+
+    def _admit(self, running):
+        admitted = []
+        tokens = sum(len(s.token_ids) for s, _, _, _ in running)
+        while len(running) + len(admitted) < self.max_batch_size and not self._stopped.is_set():
+            try:
+                # block for new work only when nothing is decoding
+                if self._carry:
+                    entry, self._carry = self._carry, None
+                elif not running and not admitted:
+                    entry = self._queue.get(timeout=0.1)
+                else:
+                    entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            _, _, schedule, item = entry
+            sequence = item[0]
+            if sequence.cancelled:
+                continue
+            if schedule.too_late:
+                self._resolve(item[3], item[2], scheduling.shed(schedule))
+                continue
+            if (running or admitted) and tokens + len(sequence.prompt_ids) > self.max_batch_tokens:
+                # no room this step, it goes first next time
+                self._carry = entry
+                break
+            tokens += len(sequence.prompt_ids)
+            QUEUE_WAIT.observe(time.perf_counter() - sequence.created_at)
+            admitted.append(item)
+        return admitted
+
+    def _retire(self, running):
+        still_running, finished, gone = [], [], []
+        for item in running:
+            sequence = item[0]
+            if sequence.finished or sequence.cancelled:
+                release(sequence)
+                gone.append(sequence)
+                if sequence.finished:
+                    finished.append(item)
+            else:
+                still_running.append(item)
+        self._batch.leave(gone)
+
+        # sequences finishing on the same step are decoded in one batched call
+        if finished:
+            generations = decode_generations([s for s, _, _, _ in finished], self.tokenizer, [p for _, p, _, _ in finished])
+            for (_, _, future, loop), generation in zip(finished, generations):
+                self._resolve(loop, future, generation)
+        return still_running
+
+    def _fail(self, items, error):
+        for sequence, _, future, loop in items:
+            release(sequence)
+            self._resolve(loop, future, error)
+
+    @staticmethod
+    def _resolve(loop, future, outcome):
+        def resolve():
+            if future.done():
+                return
+            if isinstance(outcome, BaseException):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            # event loop already closed during shutdown
+            pass
+
+    def _run(self):
+        if self._initializer:
+            self._initializer()
+        running = []
+        with torch.no_grad():
+            while not self._stopped.is_set() or running:
+                admitted = self._admit(running)
+                prompts = [s for s, _, _, _ in admitted if not s.finished]
+                if prompts:
+                    try:
+                        prefill(self.model, prompts, self.device, self.prefix_cache)
+                    except Exception as e:
+                        logger.error(f"Prefill failed: {str(e)}")
+                        self._fail(admitted, e)
+                        admitted = []
+                running = self._retire(running + admitted)
+                if not running:
+                    continue
+
+                try:
+                    # the batch cache is laid out anew only when sequences join or leave
+                    self._batch.join([s for s, _, _, _ in admitted if not (s.finished or s.cancelled)])
+                    self._batch.step(self.model, self.device)
+                except Exception as e:
+                    logger.error(f"Decode step failed: {str(e)}")
+                    self._fail(running, e)
+                    self._batch = DecodeBatch()
+                    running = []
+                    continue
+
+                running = self._retire(running)
+
+        # fail whatever never made it into the batch
+        leftover = [self._carry] if self._carry else []
+        while not self._queue.empty():
+            leftover.append(self._queue.get_nowait())
+        self._fail([item for _, _, _, item in leftover], RuntimeError("Service is shutting down"))
@@ -0,0 +1,93 @@
+import os
+import asyncio
+import logging
+from itertools import islice
+from generate import generate_batch
+from executor import QueueFullError
+import scheduling
+
+logger = logging.getLogger(__name__)
+
+# prompts tokenized per call off the event loop, so no single call holds the tokenizer for long
+ENCODE_SLICE = 1024
+
+def encoded(tokenizer, items: list) -> list:
+    # (index, prompt, params) items as (index, prompt, params, prompt_ids), each prompt
+    # truncated to its own max_length
+    max_length = max(params.max_length for _, _, params in items)
+    input_ids = tokenizer([prompt for _, prompt, _ in items], truncation=True, max_length=max_length)['input_ids']
+    return [(index, prompt, params, list(ids[:params.max_length])) for ids, (index, prompt, params) in zip(input_ids, items)]
+
+async def by_length(tokenizer, items: list) -> list:
+    # (index, prompt, params, prompt_ids) items from shortest to longest prompt in tokens, so
+    # prompts batched together need little padding; tokenized and sorted in worker threads,
+    # a batch can hold many thousands of prompts and the event loop keeps serving meanwhile
+    encoded_items = []
+    for start in range(0, len(items), ENCODE_SLICE):
+        encoded_items += await asyncio.to_thread(encoded, tokenizer, items[start:start + ENCODE_SLICE])
+    return await asyncio.to_thread(sorted, encoded_items, key=lambda item: len(item[3]))
+
+async def _admitted(submit):
+    # bulk work waits for room in the queue instead of failing, so it never crowds out
+    # interactive requests for long
+    while True:
+        try:
+            return await submit()
+        except QueueFullError as qe:
+            await asyncio.sleep(qe.retry_after)
+
+async def _generate_chunk(state, chunk: list) -> list:
+    # one padded batch on the executor; when it fails, each prompt is retried alone so
+    # only the prompts that actually fail report an error
+    try:
+        generations = await _admitted(lambda: state.executor.submit(generate_batch,
+            [prompt for _, prompt, _, _ in chunk],
+            state.tokenizer,
+            state.model,
+            state.device,
+            [params for _, _, params, _ in chunk],
+            getattr(state, 'prefix_cache', None),
+            input_ids=[prompt_ids for _, _, _, prompt_ids in chunk]))
+        return [(index, generation) for (index, _, _, _), generation in zip(chunk, generations)]
+    except Exception as e:
+        if len(chunk) == 1:
+            return [(chunk[0][0], e)]
+        logger.warning(f"Batch of {len(chunk)} prompts failed, retrying them one by one. Error: {str(e)}")
+        return [result for item in chunk for result in await _generate_chunk(state, [item])]
+
+async def _generate_one(state, index: int, prompt: str, params, prompt_ids: list[int]):
+    try:
+        return index, await _admitted(lambda: state.batcher.submit(prompt, params, prompt_ids=prompt_ids))
+    except Exception as e:
+        return index, e
+
+# Generates for many (index, prompt, params) items, shortest prompts first, yielding
+# (index, Generation or exception) pairs as results come in. Without a batcher the items
+# run in padded batches of `batch_size` on the executor; with one, `batch_size` items are
+# kept in flight so the batcher always has a batch of similar lengths to work on. They
+# are of the bulk priority class, so queued interactive requests start before them.
+async def generate_bulk(state, items: list, batch_size: int = None):
+    batch_size = batch_size or int(os.environ.get('BATCH_MAX_SIZE', 8))
+    scheduling.current.set(scheduling.Schedule("bulk"))
+    items = await by_length(state.tokenizer, items)
+
+    if not getattr(state, 'batcher', None):
+        for start in range(0, len(items), batch_size):
+            for result in await _generate_chunk(state, items[start:start + batch_size]):
+                yield result
+        return
+
+    waiting = iter(items)
+    running = {asyncio.create_task(_generate_one(state, *item)) for item in islice(waiting, batch_size)}
+    try:
+        while running:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+                item = next(waiting, None)
+                if item:
+                    running.add(asyncio.create_task(_generate_one(state, *item)))
+    finally:
+        # the client went away, stop generating for it
+        for task in running:
+            task.cancel()
@@ -0,0 +1,82 @@
+import os
+import json
+import time
+import argparse
+import torch
+from datetime import datetime, timezone
+from config import GenerationParams
+from generate import generate_batch
+from model_loader import load_model_and_tokenizer
+from topology import available_cpus, cgroup_cpu_limit, cpu_budget, node_type
+
+PROMPT = "The quick brown fox jumps over the lazy dog while the band plays on. "
+
+def thread_counts(budget: int) -> list[int]:
+    # powers of two up to the CPUs there are to use, and that number itself
+    counts = [2**i for i in range(budget.bit_length()) if 2**i < budget]
+    return counts + [budget]
+
+def tokens_per_second(model, tokenizer, device, threads: int, batch_size: int, max_new_tokens: int, repeats: int) -> float:
+    # greedy, so every thread count generates the same tokens
+    torch.set_num_threads(threads)
+    prompts = [f"{i}. {PROMPT * 4}" for i in range(batch_size)]
+    params = [GenerationParams(max_length=64, max_new_tokens=max_new_tokens, temperature=0)] * batch_size
+
+    generate_batch(prompts, tokenizer, model, device, params)
+    tokens, elapsed = 0, 0.0
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        generations = generate_batch(prompts, tokenizer, model, device, params)
+        elapsed += time.perf_counter() - start_time
+        tokens += sum(generation.generated_tokens for generation in generations)
+    return round(tokens / elapsed, 1)
+
+def calibrate(model, tokenizer, device, counts: list[int], batch_size: int = 1, max_new_tokens: int = 32, repeats: int = 3) -> dict:
+    # tokens per second at each intra-op thread count and the fastest of them
+    results = {}
+    for threads in counts:
+        results[threads] = tokens_per_second(model, tokenizer, device, threads, batch_size, max_new_tokens, repeats)
+        print(f"threads={threads}: {results[threads]} tokens/s")
+    return {"threads": max(results, key=results.get), "tokens_per_second": results}
+
+def save(path: str, node: str, calibration: dict):
+    # one entry per node type, so nodes of different types can share the file
+    calibrations = {}
+    if os.path.exists(path):
+        with open(path) as output:
+            calibrations = json.load(output)
+    calibrations[node] = calibration
+    with open(path, "w") as output:
+        json.dump(calibrations, output, indent=2)
+
+# Measures generation throughput of the configured model across torch intra-op thread
+# counts on this node and records the fastest for its node type, which the service uses
+# at startup when THREAD_CALIBRATION_PATH points at the file. Run it where the service
+# runs, inside the pod, so the CPU quota and core type are the service's own.
+def main():
+    parser = argparse.ArgumentParser(description="Find the fastest torch thread count for MODEL_DIR_PATH on this node type")
+    parser.add_argument("--threads", type=str, default=None, help="Comma-separated thread counts to try (default: powers of two up to the CPUs available)")
+    parser.add_argument("--batch-size", type=int, default=1, help="Prompts generated together (default: 1)")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="Tokens generated per prompt (default: 32)")
+    parser.add_argument("--repeats", type=int, default=3, help="Measured passes per thread count, after one warm-up pass (default: 3)")
+    parser.add_argument("--output", type=str, default=os.environ.get('THREAD_CALIBRATION_PATH', "thread-calibration.json"),
+        help="Calibration file to add this node type to (default: THREAD_CALIBRATION_PATH or thread-calibration.json)")
+    args = parser.parse_args()
+
+    budget = cpu_budget(available_cpus(), cgroup_cpu_limit())
+    counts = [int(count) for count in args.threads.split(",")] if args.threads else thread_counts(budget)
+    node = node_type(budget)
+
+    model, tokenizer, device = load_model_and_tokenizer()
+    calibration = calibrate(model, tokenizer, device, counts, args.batch_size, args.max_new_tokens, args.repeats)
+    calibration.update({
+        "mode": model.inference_mode,
+        "batch_size": args.batch_size,
+        "calibrated_at": datetime.now(timezone.utc).isoformat(timespec="seconds")
+    })
+
+    save(args.output, node, calibration)
+    print(f"{calibration['threads']} threads are fastest on {node}, written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import os
+from dataclasses import dataclass, field, replace
+
+# Everything that determines the output for a given prompt and model. Built once from the
+# environment as server defaults, then per request with the client's overrides applied.
+@dataclass(frozen=True)
+class GenerationParams:
+    max_length: int = 512
+    max_new_tokens: int = 50
+    temperature: float = 0.3
+    top_k: int = 20
+    top_p: float = 0.9
+    repetition_penalty: float = 1.2
+    stop: tuple[str, ...] = field(default_factory=tuple)
+    stop_token_ids: tuple[int, ...] = field(default_factory=tuple)
+    seed: int | None = None
+    # wall-clock seconds the generation may take before it is cut short
+    timeout: float | None = None
+
+    @property
+    def do_sample(self) -> bool:
+        return self.temperature > 0
+
+    @property
+    def deterministic(self) -> bool:
+        # greedy decoding or a fixed seed always gives the same output for the same input
+        return not self.do_sample or self.seed is not None
+
+@dataclass(frozen=True)
+class ServiceConfig:
+    defaults: GenerationParams
+    max_new_tokens_limit: int
+    timeout_limit: float | None = None
+    # prompts accepted by one /generate/batch request
+    bulk_max_prompts: int = 100000
+    # queue saturation at which /ready takes the pod out of rotation until it drains
+    ready_max_saturation: float = 1.0
+    # fraction of requests whose prompt and output are logged, cut to `log_max_chars`
+    log_sample_rate: float = 1.0
+    log_max_chars: int = 200
+
+    @classmethod
+    def from_env(cls):
+        defaults = GenerationParams(
+            max_length = int(os.environ.get('MAX_LENGTH', 512)),
+            max_new_tokens = int(os.environ.get('MAX_NEW_TOKENS', 50)),
+            temperature = float(os.environ.get('TEMPERATURE', 0.3)),
+            top_k = int(os.environ.get('TOP_K', 20)),
+            top_p = float(os.environ.get('TOP_P', 0.9)),
+            repetition_penalty = float(os.environ.get('REPETITION_PENALTY', 1.2)),
+            timeout = float(os.environ.get('GENERATION_TIMEOUT', 60)) or None)
+
+        max_new_tokens_limit = int(os.environ.get('MAX_NEW_TOKENS_LIMIT', defaults.max_new_tokens))
+        return cls(defaults, max(max_new_tokens_limit, defaults.max_new_tokens), defaults.timeout,
+            int(os.environ.get('BULK_MAX_PROMPTS', 100000)),
+            float(os.environ.get('READY_MAX_SATURATION', 1.0)),
+            float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 1.0)),
+            int(os.environ.get('LOG_PAYLOAD_MAX_CHARS', 200)))
+
+    def resolve(self, request) -> GenerationParams:
+        # apply a request's overrides to the server defaults, clamped to server maximums
+        overrides = request.model_dump(exclude_none=True, exclude={'prompt', 'prompts', 'model', 'priority', 'deadline'})
+        for name in ('stop', 'stop_token_ids'):
+            if name in overrides:
+                overrides[name] = tuple(overrides[name])
+        if 'max_new_tokens' in overrides:
+            overrides['max_new_tokens'] = min(overrides['max_new_tokens'], self.max_new_tokens_limit)
+        if 'timeout' in overrides and self.timeout_limit:
+            overrides['timeout'] = min(overrides['timeout'], self.timeout_limit)
+        return replace(self.defaults, **overrides)
@@ -0,0 +1,315 @@
+import time
+import torch
+from transformers import DynamicCache, LogitsProcessorList
+from transformers.cache_utils import Cache, DynamicLayer
+from transformers import RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from metrics import PREFILL, DECODE_TOKEN, BATCH_SIZE
+import scheduling
+
+def sampling_processor(temperature: float, top_k: int, top_p: float, repetition_penalty: float):
+    # same processors, in the same order, as `model.generate(do_sample=True, ...)`
+    processors = LogitsProcessorList()
+    if repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+    if temperature == 0:
+        # greedy decoding, the warpers cannot change the most likely token
+        return processors
+    if temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    if top_k:
+        processors.append(TopKLogitsWarper(top_k=top_k))
+    if top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p=top_p))
+    return processors
+
+# A single prompt being decoded. Prefill leaves each sequence its own KV cache (`past`, one
+# (key, value) pair per layer without any padding), which moves into a DecodeBatch's cache
+# when the sequence joins one, so sequences can join and leave a running batch independently.
+class Sequence:
+
+    def __init__(self, prompt_ids: list[int], max_new_tokens: int, eos_token_id: int, logits_processor,
+            streamer=None, do_sample: bool = True, seed: int = None, stopping_criteria=None):
+        self.prompt_ids = list(prompt_ids)
+        self.generated_ids = []
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+        self.logits_processor = logits_processor
+        self.streamer = streamer
+        self.do_sample = do_sample
+        self.stopping_criteria = stopping_criteria or []
+
+        # a seeded sequence draws from its own generator so its output does not depend
+        # on whatever else shares the batch
+        self.seed = seed
+        self.generator = None
+
+        self.past = None
+        self.next_logits = None
+        self.finish_reason = None
+        self._cancelled = False
+        # when the sequence was queued, for its queue wait
+        self.created_at = time.perf_counter()
+        if not self.prompt_ids or max_new_tokens <= 0:
+            self._finish("length")
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled or (self.streamer is not None and self.streamer.cancelled)
+
+    @cancelled.setter
+    def cancelled(self, value: bool):
+        self._cancelled = value
+
+    @property
+    def token_ids(self) -> list[int]:
+        return self.prompt_ids + self.generated_ids
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def output_ids(self) -> list[int]:
+        # generated ids that belong in the response, without the token that stopped the sequence
+        if self.finish_reason in ("eos", "stop_token"):
+            return self.generated_ids[:-1]
+        return self.generated_ids
+
+    def append(self, token_id: int):
+        self.generated_ids.append(token_id)
+
+        if token_id == self.eos_token_id:
+            reason = "eos"
+        else:
+            reason = next((c.reason for c in self.stopping_criteria if c(self)), None)
+            if reason is None and len(self.generated_ids) >= self.max_new_tokens:
+                reason = "length"
+
+        if self.streamer and reason not in ("eos", "stop_token"):
+            self.streamer.put(token_id)
+        if reason:
+            self._finish(reason)
+
+    def _finish(self, reason: str):
+        self.finish_reason = reason
+        if self.streamer:
+            self.streamer.end(reason)
+
+def _cache_tensors(past_key_values):
+    if isinstance(past_key_values, DynamicCache):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    return [(keys, values) for keys, values in past_key_values]
+
+def _sample(sequences, logits):
+    # logits: one row of next-token scores per sequence
+    logits = logits.float()
+    for row, sequence in enumerate(sequences):
+        input_ids = torch.tensor([sequence.token_ids], device=logits.device)
+        scores = sequence.logits_processor(input_ids, logits[row:row + 1])
+        if not sequence.do_sample:
+            sequence.append(int(scores.argmax(dim=-1)))
+            continue
+
+        if sequence.seed is not None and sequence.generator is None:
+            sequence.generator = torch.Generator(device=logits.device).manual_seed(sequence.seed)
+        probs = torch.softmax(scores, dim=-1)
+        sequence.append(int(torch.multinomial(probs, num_samples=1, generator=sequence.generator)))
+
+def prefill(model, sequences: list[Sequence], device, prefix_cache=None):
+    start_time = time.perf_counter()
+    misses = sequences
+    if prefix_cache is not None:
+        misses = []
+        for sequence in sequences:
+            # at least one prompt token must still run to produce the next-token logits
+            matched, past = prefix_cache.lookup(sequence.prompt_ids[:-1])
+            if matched:
+                _prefill_suffix(model, sequence, matched, past, device)
+            else:
+                misses.append(sequence)
+
+    if misses:
+        _prefill_batch(model, misses, device)
+
+    if prefix_cache is not None:
+        for sequence in sequences:
+            prefix_cache.insert(sequence.prompt_ids, sequence.past)
+
+    _sample(sequences, torch.cat([s.next_logits for s in sequences]))
+    for sequence in sequences:
+        sequence.next_logits = None
+
+    PREFILL.observe(time.perf_counter() - start_time)
+    scheduling.observe_prefill(time.perf_counter() - start_time)
+    BATCH_SIZE.observe(len(sequences), stage="prefill")
+
+def _prefill_batch(model, sequences: list[Sequence], device):
+    # run all new prompts in one left-padded forward pass, then keep only each
+    # sequence's unpadded slice of the cache
+    longest = max(len(s.prompt_ids) for s in sequences)
+    pad_id = sequences[0].eos_token_id
+
+    input_ids = torch.tensor([[pad_id] * (longest - len(s.prompt_ids)) + s.prompt_ids for s in sequences], device=device)
+    attention_mask = torch.tensor([[0] * (longest - len(s.prompt_ids)) + [1] * len(s.prompt_ids) for s in sequences], device=device)
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    outputs = model(input_ids=input_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        use_cache=True)
+
+    layers = _cache_tensors(outputs.past_key_values)
+    for row, sequence in enumerate(sequences):
+        start = longest - len(sequence.prompt_ids)
+        sequence.past = [(k[row:row + 1, :, start:], v[row:row + 1, :, start:]) for k, v in layers]
+        sequence.next_logits = outputs.logits[row:row + 1, -1, :]
+
+def _prefill_suffix(model, sequence: Sequence, matched: int, past, device):
+    # only the prompt tokens after the cached prefix go through the model
+    suffix = sequence.prompt_ids[matched:]
+    outputs = model(input_ids=torch.tensor([suffix], device=device),
+        attention_mask=torch.ones(1, len(sequence.prompt_ids), dtype=torch.long, device=device),
+        past_key_values=DynamicCache(ddp_cache_data=[(k.to(device), v.to(device)) for k, v in past]),
+        position_ids=torch.arange(matched, len(sequence.prompt_ids), device=device).unsqueeze(0),
+        use_cache=True)
+
+    sequence.past = _cache_tensors(outputs.past_key_values)
+    sequence.next_logits = outputs.logits[:, -1, :]
+
+# free columns a decode batch's cache gets at most, as many as its sequences may still generate
+GROWTH = 64
+
+class _BufferLayer(DynamicLayer):
+    # one layer of a decode batch's cache, in a buffer with free columns on the right: each
+    # step's keys and values are written into them instead of concatenated onto a copy
+
+    def __init__(self, keys: torch.Tensor, values: torch.Tensor, width: int):
+        super().__init__()
+        self.dtype, self.device = keys.dtype, keys.device
+        self.is_initialized = True
+        self._keys, self._values = keys, values
+        self.keys, self.values = keys[:, :, :width], values[:, :, :width]
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, *args, **kwargs):
+        start = self.keys.shape[2]
+        end = start + key_states.shape[2]
+        if end > self._keys.shape[2]:
+            # out of free columns, copied once into a buffer with room for more
+            self._keys = _widened(self._keys, end + GROWTH)
+            self._values = _widened(self._values, end + GROWTH)
+        self._keys[:, :, start:end] = key_states
+        self._values[:, :, start:end] = value_states
+        self.keys, self.values = self._keys[:, :, :end], self._values[:, :, :end]
+        return self.keys, self.values
+
+def _widened(buffer: torch.Tensor, capacity: int) -> torch.Tensor:
+    widened = buffer.new_zeros(*buffer.shape[:2], capacity, *buffer.shape[3:])
+    widened[:, :, :buffer.shape[2]] = buffer
+    return widened
+
+# The running sequences' KV caches as one left-padded batch cache. It is laid out anew only
+# when sequences join or leave; in between, each decode step writes its token's keys and
+# values into free columns in place, so a step copies none of the cache.
+class DecodeBatch:
+
+    def __init__(self):
+        self.sequences = []
+        # each row's cached tokens, right-aligned at `_width` columns
+        self._lengths = []
+        self._width = 0
+        self._cache = None
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    def join(self, sequences: list[Sequence]):
+        # prefilled sequences, whose own caches are copied in and then freed
+        if sequences:
+            self._layout(list(range(len(self.sequences))), sequences)
+
+    def leave(self, sequences: list[Sequence]):
+        # sequences not in the batch are ignored
+        gone = set(map(id, sequences))
+        keep = [row for row, sequence in enumerate(self.sequences) if id(sequence) not in gone]
+        if len(keep) < len(self.sequences):
+            self._layout(keep, [])
+
+    def _layout(self, keep: list[int], joining: list[Sequence]):
+        sequences = [self.sequences[row] for row in keep] + joining
+        lengths = [self._lengths[row] for row in keep] + [s.past[0][0].shape[2] for s in joining]
+        if not sequences:
+            self.sequences, self._lengths, self._width, self._cache = [], [], 0, None
+            return
+
+        width = max(lengths)
+        remaining = max(s.max_new_tokens - len(s.generated_ids) for s in sequences)
+        capacity = width + max(1, min(GROWTH, remaining))
+        old_layers = self._cache.layers if self._cache else []
+        layers = []
+        for layer in range(len(joining[0].past) if joining else len(old_layers)):
+            reference = joining[0].past[layer][0] if joining else old_layers[layer].keys
+            keys = reference.new_zeros(len(sequences), reference.shape[1], capacity, reference.shape[3])
+            values = torch.zeros_like(keys)
+            if keep:
+                # rows staying keep their right alignment, columns no row needs any more go
+                old = old_layers[layer]
+                columns = min(width, self._width)
+                rows = torch.tensor(keep, device=keys.device)
+                keys[:len(keep), :, width - columns:width] = old.keys.index_select(0, rows)[:, :, self._width - columns:]
+                values[:len(keep), :, width - columns:width] = old.values.index_select(0, rows)[:, :, self._width - columns:]
+            for row, sequence in enumerate(joining, start=len(keep)):
+                k, v = sequence.past[layer]
+                keys[row, :, width - k.shape[2]:width] = k[0]
+                values[row, :, width - v.shape[2]:width] = v[0]
+            layers.append(_BufferLayer(keys, values, width))
+
+        for sequence in joining:
+            sequence.past = None
+        self.sequences, self._lengths, self._width = sequences, lengths, width
+        self._cache = Cache(layers=layers)
+
+    def step(self, model, device):
+        # feeds each sequence's last token against the batch cache
+        start_time = time.perf_counter()
+        lengths = torch.tensor(self._lengths, device=device)
+
+        input_ids = torch.tensor([[s.generated_ids[-1]] for s in self.sequences], device=device)
+        attention_mask = (torch.arange(self._width + 1, device=device) >= (self._width - lengths).unsqueeze(1)).long()
+
+        outputs = model(input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=self._cache,
+            position_ids=lengths.unsqueeze(1),
+            use_cache=True)
+        self._lengths = [length + 1 for length in self._lengths]
+        self._width += 1
+
+        _sample(self.sequences, outputs.logits[:, -1, :])
+
+        DECODE_TOKEN.observe(time.perf_counter() - start_time)
+        BATCH_SIZE.observe(len(self.sequences), stage="decode")
+
+def release(sequence: Sequence):
+    # free the KV slot as soon as a sequence leaves the batch
+    sequence.past = None
+
+def generate_sequences(model, sequences: list[Sequence], device, prefix_cache=None):
+    running = [s for s in sequences if not s.finished]
+    if running:
+        prefill(model, running, device, prefix_cache)
+
+    batch = DecodeBatch()
+    joining = running
+    while True:
+        gone = [s for s in running if s.finished or s.cancelled]
+        for sequence in gone:
+            release(sequence)
+        batch.leave(gone)
+        running = [s for s in running if not s.finished and not s.cancelled]
+        batch.join([s for s in joining if s in running])
+        joining = []
+        if not running:
+            break
+        batch.step(model, device)
+
+    return sequences
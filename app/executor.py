@@ -0,0 +1,131 @@
+import os
+import time
+import asyncio
+import heapq
+import itertools
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from metrics import QUEUE_WAIT
+import scheduling
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    def __init__(self, depth: int, retry_after: int):
+        super().__init__(f"Inference queue is full ({depth} requests pending)")
+        self.depth = depth
+        self.retry_after = retry_after
+
+# Runs blocking inference on a dedicated thread pool so the event loop stays free for
+# health checks and new connections. Requests are admitted until `max_queue_depth` are
+# running or waiting, after which `submit` fails fast with `QueueFullError`. Waiting requests
+# get a worker in priority order, earliest deadline first within a priority class, and those
+# too close to their deadline by then for a first token are dropped with `DeadlineExceededError` instead.
+class InferenceExecutor:
+
+    def __init__(self, max_workers: int = None, max_queue_depth: int = None, retry_after: int = None, initializer=None):
+        # torch already parallelises a single forward pass across its intra-op threads,
+        # so one worker keeps those threads busy without oversubscribing the CPU
+        self.max_workers = max_workers or int(os.environ.get('INFERENCE_WORKERS', 1))
+        self.max_queue_depth = max_queue_depth or int(os.environ.get('MAX_QUEUE_DEPTH', 16))
+        self.retry_after = retry_after or int(os.environ.get('QUEUE_RETRY_AFTER', 1))
+
+        # the initializer runs in each worker thread as it starts, to pin it to its cores
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference", initializer=initializer)
+        self._depth = 0
+        # admitted requests waiting for a free worker, as (schedule key, arrival, schedule, turn)
+        self._waiting = []
+        self._order = itertools.count()
+        self._running = 0
+
+        logger.info(f"Inference executor started with {self.max_workers} worker(s) and max queue depth {self.max_queue_depth}")
+
+    @property
+    def depth(self) -> int:
+        # requests currently running or waiting for a worker
+        return self._depth
+
+    async def submit(self, fn, *args, **kwargs):
+        if self._depth >= self.max_queue_depth:
+            raise QueueFullError(self._depth, self.retry_after)
+
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        self._depth += 1
+        try:
+            await self._turn(loop, scheduling.current.get())
+        except BaseException:
+            self._depth -= 1
+            raise
+
+        # release the slot when the work is actually done, not when the caller stops waiting,
+        # so an abandoned request still counts against the queue while its thread is busy
+        # in the caller's context, so log lines from the worker thread keep the request id
+        context = contextvars.copy_context()
+        future = self._pool.submit(context.run, self._run, queued_at, fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self._release(loop))
+
+        return await asyncio.wrap_future(future)
+
+    async def _turn(self, loop, schedule):
+        # returns once a worker is reserved for the request
+        if self._running < self.max_workers and not self._waiting:
+            if schedule.too_late:
+                raise scheduling.shed(schedule)
+            self._running += 1
+            return
+
+        turn = loop.create_future()
+        heapq.heappush(self._waiting, (schedule.key(), next(self._order), schedule, turn))
+        try:
+            await turn
+        except asyncio.CancelledError:
+            # the worker was handed over just as the caller gave up, pass it on
+            if turn.done() and not turn.cancelled() and turn.exception() is None:
+                self._running -= 1
+                self._dispatch()
+            raise
+
+    def _dispatch(self):
+        # hands free workers to the most urgent waiting requests
+        while self._waiting and self._running < self.max_workers:
+            _, _, schedule, turn = heapq.heappop(self._waiting)
+            if turn.done():
+                # its caller gave up while waiting
+                continue
+            if schedule.too_late:
+                turn.set_exception(scheduling.shed(schedule))
+                continue
+            self._running += 1
+            turn.set_result(None)
+
+    @staticmethod
+    def _run(queued_at: float, fn, *args, **kwargs):
+        QUEUE_WAIT.observe(time.perf_counter() - queued_at)
+        return fn(*args, **kwargs)
+
+    def _release(self, loop):
+        try:
+            loop.call_soon_threadsafe(self._finished)
+        except RuntimeError:
+            # event loop already closed during shutdown
+            pass
+
+    def _finished(self):
+        self._depth -= 1
+        self._running -= 1
+        self._dispatch()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        logger.info("Inference executor has been shut down.")
+
+def queue_depth(state) -> int:
+    # requests running or waiting for inference, wherever the service queues them
+    batcher = getattr(state, 'batcher', None)
+    return batcher.pending if batcher else state.executor.depth
+
+def saturation(state) -> float:
+    # the fraction of the inference queue in use; at 1 new requests are rejected
+    return queue_depth(state) / state.executor.max_queue_depth
@@ -1,34 +1,110 @@
-import os
+import time
 import torch
+from dataclasses import dataclass
+from config import GenerationParams
+from decoding import Sequence, generate_sequences, sampling_processor
+from stopping import StopTokenCriterion, StopStringCriterion, DeadlineCriterion, truncate_at_stop
+from tokenization import encode
+from metrics import TOKENIZATION, DETOKENIZATION, PROMPT_TOKENS, GENERATED_TOKENS
+import scheduling
 
-def generate_text(prompt: str, tokenizer, model, device):
-    
-    inputs = tokenizer(prompt, 
-        return_tensors="pt", 
-        padding=False,
-        truncation=True, 
-        max_length=int(os.environ.get('MAX_LENGTH', 512)))
+@dataclass(frozen=True)
+class Generation:
+    text: str
+    # what ended the generation: eos, length, stop, stop_token or timeout
+    finish_reason: str
+    generated_tokens: int
+
+def stopping_criteria(tokenizer, params: GenerationParams, deadline: float = None) -> list:
+    criteria = []
+    if params.stop_token_ids:
+        criteria.append(StopTokenCriterion(params.stop_token_ids))
+    if params.stop:
+        criteria.append(StopStringCriterion(tokenizer, params.stop))
+    # the request's timeout, or its deadline when that comes first, a response after it is of no use
+    timeout = params.timeout or None
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        timeout = min(timeout, remaining) if timeout else remaining
+    if timeout is not None:
+        criteria.append(DeadlineCriterion(timeout))
+    return criteria
+
+def new_sequence(prompt_ids: list[int], tokenizer, params: GenerationParams, streamer=None, deadline: float = None):
+    PROMPT_TOKENS.inc(len(prompt_ids))
+    return Sequence(prompt_ids,
+        max_new_tokens = params.max_new_tokens,
+        eos_token_id = tokenizer.eos_token_id,
+        logits_processor = sampling_processor(
+            temperature = params.temperature,
+            top_k = params.top_k,
+            top_p = params.top_p,
+            repetition_penalty = params.repetition_penalty),
+        streamer = streamer,
+        do_sample = params.do_sample,
+        seed = params.seed,
+        stopping_criteria = stopping_criteria(tokenizer, params, deadline))
+
+def decode_generation(sequence: Sequence, tokenizer, stop: tuple = ()) -> Generation:
+    start_time = time.perf_counter()
+    text = tokenizer.decode(sequence.prompt_ids + sequence.output_ids, skip_special_tokens=True)
+    if stop:
+        prompt_text = tokenizer.decode(sequence.prompt_ids, skip_special_tokens=True)
+        text = truncate_at_stop(text, len(prompt_text), stop)
+    DETOKENIZATION.observe(time.perf_counter() - start_time)
+    GENERATED_TOKENS.inc(len(sequence.generated_ids))
+    return Generation(text, sequence.finish_reason, len(sequence.generated_ids))
+
+def decode_generations(sequences: list[Sequence], tokenizer, params: list[GenerationParams]) -> list[Generation]:
+    # several finished sequences decoded in one batched tokenizer call, in input order
+    start_time = time.perf_counter()
+    texts = tokenizer.batch_decode([s.prompt_ids + s.output_ids for s in sequences], skip_special_tokens=True)
+    if any(p.stop for p in params):
+        prompt_texts = tokenizer.batch_decode([s.prompt_ids for s in sequences], skip_special_tokens=True)
+        texts = [truncate_at_stop(text, len(prompt_text), p.stop) for text, prompt_text, p in zip(texts, prompt_texts, params)]
+    DETOKENIZATION.observe(time.perf_counter() - start_time)
+    GENERATED_TOKENS.inc(sum(len(s.generated_ids) for s in sequences))
+    return [Generation(text, s.finish_reason, len(s.generated_ids)) for text, s in zip(texts, sequences)]
+
+def generate_text(prompt: str, tokenizer, model, device, params: GenerationParams = GenerationParams(), streamer=None, prefix_cache=None, prompt_cache=None, speculative=None, prompt_ids: list[int] = None) -> Generation:
     
-    # move tensors to device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    # the prompt's token ids are taken as they are when the caller has encoded it already
+    if prompt_ids is None:
+        start_time = time.perf_counter()
+        prompt_ids = encode(tokenizer, prompt, params.max_length, prompt_cache)
+        TOKENIZATION.observe(time.perf_counter() - start_time)
     
-    input_ids = inputs['input_ids']
-    attention_mask = inputs['attention_mask']
+    sequence = new_sequence(prompt_ids, tokenizer, params, streamer, scheduling.current.get().deadline)
 
-    # Generate text with sampling
+    # Generate text with sampling, one token per step against the sequence's KV cache,
+    # or several per step when a draft model proposes them
     with torch.no_grad():
-        outputs = model.generate(
-            input_ids = input_ids, 
-            attention_mask = attention_mask,
-            do_sample = True,
-            num_return_sequences = 1,  
-            max_new_tokens = int(os.environ.get('MAX_NEW_TOKENS', 50)),               
-            temperature = float(os.environ.get('TEMPERATURE', 0.3)),                
-            top_k = int(os.environ.get('TOP_K', 20)),                       
-            top_p = float(os.environ.get('TOP_P', 0.9)),                      
-            repetition_penalty = float(os.environ.get('REPETITION_PENALTY', 1.2))
-        )
+        if speculative:
+            speculative.generate(model, sequence, device, prefix_cache)
+        else:
+            generate_sequences(model, [sequence], device, prefix_cache)
 
     # Decode the generated text
-    return tokenizer.decode(outputs[0], skip_special_tokens=True) 
-       
\ No newline at end of file
+    return decode_generation(sequence, tokenizer, params.stop)
+
+def generate_batch(prompts: list[str], tokenizer, model, device, params: list[GenerationParams] = None, prefix_cache=None, prompt_cache=None, input_ids: list[list[int]] = None, deadlines: list[float] = None) -> list[Generation]:
+    
+    params = params or [GenerationParams()] * len(prompts)
+    # each prompt's own request deadline, the batch's schedule is only its most urgent one's
+    deadlines = deadlines or [None] * len(prompts)
+    if input_ids is None:
+        start_time = time.perf_counter()
+        input_ids = encode(tokenizer, prompts, max(p.max_length for p in params), prompt_cache)
+        TOKENIZATION.observe(time.perf_counter() - start_time)
+    
+    sequences = [new_sequence(prompt_ids[:p.max_length], tokenizer, p, deadline=deadline)
+        for prompt_ids, p, deadline in zip(input_ids, params, deadlines)]
+
+    # Generate text for the whole batch together; prompts are left-padded for the
+    # shared forward pass and each sequence leaves the batch as soon as it is done
+    with torch.no_grad():
+        generate_sequences(model, sequences, device, prefix_cache)
+
+    # Decode the generated texts, one per prompt in input order
+    return decode_generations(sequences, tokenizer, params)
+
@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+from dataclasses import asdict
+from config import GenerationParams
+from generate import Generation, generate_text
+from batching import ContinuousBatcher
+from executor import QueueFullError, saturation
+from registry import generate_on
+from streaming import CancelToken
+from metrics import REGISTRY
+import scheduling
+import logs
+
+logger = logging.getLogger(__name__)
+
+# every message is a JSON object preceded by its length as a 4 byte big-endian integer
+_HEADER = struct.Struct(">I")
+
+async def read_message(reader) -> dict:
+    # the next message, or None once the other side has closed the connection
+    try:
+        header = await reader.readexactly(_HEADER.size)
+        return json.loads(await reader.readexactly(_HEADER.unpack(header)[0]))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+def write_message(writer, message: dict):
+    data = json.dumps(message).encode("utf-8")
+    writer.write(_HEADER.pack(len(data)) + data)
+
+def decode_params(data: dict) -> GenerationParams:
+    # JSON has no tuples, the frozen params keep theirs
+    return GenerationParams(**{**data, "stop": tuple(data["stop"]), "stop_token_ids": tuple(data["stop_token_ids"])})
+
+def encode_error(error: Exception) -> dict:
+    if isinstance(error, QueueFullError):
+        return {"type": "QueueFullError", "depth": error.depth, "retry_after": error.retry_after}
+    if isinstance(error, scheduling.DeadlineExceededError):
+        return {"type": "DeadlineExceededError"}
+    return {"type": "ValueError" if isinstance(error, ValueError) else "RuntimeError", "message": str(error)}
+
+def decode_error(error: dict) -> Exception:
+    # the exception types the request handlers map to status codes
+    if error["type"] == "QueueFullError":
+        return QueueFullError(error["depth"], error["retry_after"])
+    if error["type"] == "DeadlineExceededError":
+        return scheduling.DeadlineExceededError()
+    if error["type"] == "ValueError":
+        return ValueError(error["message"])
+    return RuntimeError(error["message"])
+
+# Stands in for an HTTP worker's TokenStreamer inside the inference process: the decode
+# thread's token ids are forwarded as they come, and the worker's own streamer turns them into text.
+class _StreamForwarder:
+
+    def __init__(self, send, request_id: int):
+        self.cancelled = False
+        self._send = send
+        self._id = request_id
+
+    # called from the decode thread
+    def put(self, token_id: int):
+        self._send({"id": self._id, "token": token_id})
+
+    # called from the decode thread
+    def end(self, finish_reason: str):
+        self._send({"id": self._id, "end": finish_reason})
+
+# Serves generations of the model-owning process to HTTP worker processes over a Unix
+# socket. Requests are routed exactly as a single-process service routes them, so admission
+# control, batching and the prefix cache are shared by all workers.
+class InferenceServer:
+
+    def __init__(self, state, path: str):
+        self.state = state
+        self.path = path
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+        logger.info(f"Inference server listening on {self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        logger.info("Inference server has been stopped.")
+
+    async def _serve(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        tasks = {}
+
+        def send(message):
+            if not writer.is_closing():
+                write_message(writer, message)
+
+        def send_threadsafe(message):
+            try:
+                loop.call_soon_threadsafe(send, message)
+            except RuntimeError:
+                # event loop already closed during shutdown
+                pass
+
+        try:
+            while (message := await read_message(reader)) is not None:
+                if message["op"] == "metric":
+                    # an update recorded by the worker, kept with this process's own metrics
+                    REGISTRY.apply(message["name"], message["method"], message["value"], message["labels"])
+                    continue
+
+                request_id = message["id"]
+                if message["op"] == "cancel":
+                    if request_id in tasks:
+                        tasks[request_id].cancel()
+                    continue
+
+                task = asyncio.create_task(self._handle(message, send, send_threadsafe))
+                tasks[request_id] = task
+                task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+        finally:
+            # the worker went away, nobody is waiting for its generations any more
+            for task in list(tasks.values()):
+                task.cancel()
+            writer.close()
+
+    async def _handle(self, message: dict, send, send_threadsafe):
+        request_id = message["id"]
+        # log lines of this generation carry the id of the worker's HTTP request
+        logs.request_id.set(message.get("request_id"))
+        # queued here by the priority and what is left of the deadline of the worker's request
+        scheduling.current.set(scheduling.Schedule.within(message.get("priority"), message.get("deadline")))
+        streamer = None
+        try:
+            if message["op"] == "info":
+                result = {"model_fingerprint": self.state.model_fingerprint}
+            elif message["op"] == "metrics":
+                result = REGISTRY.render()
+            elif message["op"] == "saturation":
+                result = saturation(self.state)
+            elif message["op"] == "models":
+                registry = getattr(self.state, 'registry', None)
+                result = registry.describe() if registry else []
+            elif message["op"] == "ready":
+                # answered once warm-up has finished, or failed for good
+                while not getattr(self.state, 'ready', False):
+                    if getattr(self.state, 'warmup_failed', False):
+                        raise RuntimeError("Warm-up of the inference process failed")
+                    await asyncio.sleep(0.1)
+                result = True
+            else:
+                if message.get("stream"):
+                    streamer = _StreamForwarder(send_threadsafe, request_id)
+                generation = await self._generate(message["prompt"], decode_params(message["params"]), streamer, message.get("model"),
+                    message.get("prompt_ids"))
+                result = asdict(generation)
+            send({"id": request_id, "result": result})
+
+        except asyncio.CancelledError:
+            # stop decoding a sequence whose client has gone
+            if streamer:
+                streamer.cancelled = True
+            raise
+
+        except Exception as e:
+            send({"id": request_id, "error": encode_error(e)})
+
+    async def _generate(self, prompt: str, params: GenerationParams, streamer, model: str = None, prompt_ids: list[int] = None):
+        if model:
+            return await generate_on(self.state, model, prompt, params, streamer)
+        batcher = self.state.batcher
+        if isinstance(batcher, ContinuousBatcher):
+            return await batcher.submit(prompt, params, streamer=streamer, prompt_ids=prompt_ids)
+        if batcher and streamer is None:
+            return await batcher.submit(prompt, params, prompt_ids=prompt_ids)
+
+        # stopped through the token when the worker cancels the request
+        streamer = streamer or CancelToken()
+        try:
+            return await self.state.executor.submit(generate_text,
+                prompt,
+                self.state.tokenizer,
+                self.state.model,
+                self.state.device,
+                params,
+                streamer,
+                self.state.prefix_cache,
+                prompt_cache=getattr(self.state, 'prompt_cache', None),
+                speculative=getattr(self.state, 'speculative', None),
+                prompt_ids=prompt_ids)
+        except asyncio.CancelledError:
+            streamer.cancelled = True
+            raise
+
+# Used by an HTTP worker process in place of a local batcher: `submit` sends the request
+# to the inference process and waits for its result, passing streamed token ids on to
+# the worker's streamer. Cancelling `submit` cancels the generation on the other side.
+class InferenceClient:
+
+    def __init__(self, path: str, connect_timeout: float = None):
+        self.path = path
+        self.connect_timeout = connect_timeout or float(os.environ.get('INFERENCE_CONNECT_TIMEOUT', 300))
+
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._closing = False
+        self._requests = {}
+        self._next_id = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._receiver is not None and not self._receiver.done()
+
+    @property
+    def pending(self) -> int:
+        # requests sent to the inference process and not answered yet
+        return len(self._requests)
+
+    async def connect(self):
+        # the inference process only opens its socket once the model has loaded
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Inference process did not open {self.path} within {self.connect_timeout}s")
+                await asyncio.sleep(0.1)
+
+        self._receiver = asyncio.create_task(self._receive())
+        logger.info(f"Connected to the inference process on {self.path}")
+
+    async def close(self):
+        self._closing = True
+        if self._writer:
+            self._writer.close()
+        if self._receiver:
+            await asyncio.gather(self._receiver, return_exceptions=True)
+
+    async def info(self) -> dict:
+        return await self._call({"op": "info"})
+
+    async def wait_ready(self):
+        await self._call({"op": "ready"})
+
+    async def metrics(self) -> str:
+        return await self._call({"op": "metrics"})
+
+    async def saturation(self) -> float:
+        # of the queue all workers share
+        return await self._call({"op": "saturation"})
+
+    async def models(self) -> list[dict]:
+        return await self._call({"op": "models"})
+
+    def record_metric(self, name: str, method: str, value: float, labels: dict):
+        # the registry's forward hook; nothing is sent back, so recording never waits
+        if self.connected:
+            write_message(self._writer, {"op": "metric", "name": name, "method": method, "value": value, "labels": labels})
+
+    async def submit(self, prompt: str, params: GenerationParams = GenerationParams(), streamer=None, model: str = None,
+            prompt_ids: list[int] = None) -> Generation:
+        result = await self._call({
+            "op": "generate",
+            "prompt": prompt,
+            # the token ids when the worker has encoded the prompt already, as for bulk batches
+            "prompt_ids": prompt_ids,
+            "model": model,
+            "params": asdict(params),
+            "stream": streamer is not None,
+            "request_id": logs.request_id.get(),
+            "priority": scheduling.current.get().priority,
+            "deadline": scheduling.current.get().remaining()
+        }, streamer)
+        return Generation(**result)
+
+    async def _call(self, message: dict, streamer=None):
+        if not self.connected:
+            raise RuntimeError("Inference process is not reachable")
+
+        request_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._requests[request_id] = (future, streamer)
+        try:
+            write_message(self._writer, {"id": request_id, **message})
+            await self._writer.drain()
+            return await future
+        except asyncio.CancelledError:
+            # the client went away, stop the generation in the inference process too
+            if self.connected:
+                write_message(self._writer, {"id": request_id, "op": "cancel"})
+            raise
+        finally:
+            self._requests.pop(request_id, None)
+
+    async def _receive(self):
+        try:
+            while (message := await read_message(self._reader)) is not None:
+                future, streamer = self._requests.get(message["id"], (None, None))
+                if future is None or future.done():
+                    # answer to a request that was cancelled meanwhile
+                    continue
+                if "token" in message:
+                    streamer.put(message["token"])
+                elif "end" in message:
+                    streamer.end(message["end"])
+                elif "error" in message:
+                    future.set_exception(decode_error(message["error"]))
+                else:
+                    future.set_result(message["result"])
+        finally:
+            if not self._closing:
+                logger.error("Connection to the inference process lost")
+            for future, _ in self._requests.values():
+                if not future.done():
+                    future.set_exception(RuntimeError("Connection to the inference process lost"))
@@ -0,0 +1,105 @@
+import os
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+# the request a log line belongs to; set per HTTP request and carried into executor
+# threads and the inference process
+request_id = contextvars.ContextVar("request_id", default=None)
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s"
+
+class RequestIdFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = request_id.get() or "-"
+        return True
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": None if record.request_id == "-" else record.request_id,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class _DeferredQueueHandler(QueueHandler):
+    # QueueHandler formats every record on the logging thread before queueing it; here the
+    # record goes onto the queue as is and the listener thread formats it
+    def prepare(self, record):
+        return record
+
+_listener = None
+
+# Log records are only queued on the request path; a background thread formats and
+# writes them. Returns the listener, which flushes what is left when stopped.
+def configure_logging() -> QueueListener:
+    global _listener
+    # a spawned worker runs main.py both as its entry point and as the imported app module
+    if _listener:
+        return _listener
+
+    handler = logging.StreamHandler()
+    if os.environ.get('LOG_FORMAT', 'json') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(records)
+    # the request id is read here, while the record is still on the thread that logged it
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+def sampled(rate: float) -> bool:
+    # whether to log the payload of this request, for a fraction `rate` of requests
+    return rate >= 1 or random.random() < rate
+
+def truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text)} chars)"
+
+# ASGI middleware giving each HTTP request an id, taken from its X-Request-ID header when
+# the client or a proxy sent one, and returning it in the response's X-Request-ID header
+class RequestIdMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        given = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")[:128]
+        current = given or uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", current.encode("latin-1"))]
+            await send(message)
+
+        token = request_id.set(current)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
@@ -1,32 +1,196 @@
+import time
+# taken before the heavy imports so the cold start figure includes them
+start_time = time.perf_counter()
+
 import os
+import signal
+import asyncio
+import multiprocessing
 import uvicorn    
 import logging
-from model_loader import load_model_and_tokenizer
+from model_loader import load_model_and_tokenizer, load_draft_model, load_tokenizer, model_dir, memory_usage
+from topology import configure_threads
+from executor import InferenceExecutor, queue_depth, saturation
+from batching import BatchScheduler, ContinuousBatcher
+from prefix_cache import PrefixCache
+from tokenization import PromptCache
+from speculative import SpeculativeDecoder
+from registry import ModelRegistry
+from response_cache import ResponseCache, RedisCacheBackend, model_fingerprint
+from config import ServiceConfig
+from warmup import warm_up
+from ipc import InferenceServer, InferenceClient
+from metrics import REGISTRY, QUEUE_DEPTH, QUEUE_SATURATION
+from logs import configure_logging, RequestIdMiddleware
+from starlette.datastructures import State
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 from api import router
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+async def start_inference(state):
+    # torch threads sized to the CPUs the container may use, before the model runs
+    threads = configure_threads()
+    
     # load model and tokenizer
     model, tokenizer, device = load_model_and_tokenizer()
     
-    app.state.model = model
-    app.state.tokenizer = tokenizer
-    app.state.device = device
+    state.model = model
+    state.tokenizer = tokenizer
+    state.device = device
     
-    yield
-    # shutdown - clean up model and tokenizer
-    del model, tokenizer
+    # dedicated thread pool and admission queue for inference
+    pin = threads.pinner()
+    state.executor = InferenceExecutor(initializer=pin)
+    
+    # reuse the KV cache of prompt prefixes seen before, disabled with a zero budget
+    state.prefix_cache = None
+    if int(os.environ.get('PREFIX_CACHE_MAX_BYTES', 64 * 1024 * 1024)) > 0:
+        state.prefix_cache = PrefixCache()
+    
+    # token ids of recently seen prompts, disabled with zero entries
+    state.prompt_cache = None
+    if int(os.environ.get('PROMPT_CACHE_MAX_ENTRIES', 4096)) > 0:
+        state.prompt_cache = PromptCache()
+    
+    # a smaller model drafting tokens the model verifies several at a time, for requests
+    # that are not batched with others
+    state.speculative = None
+    draft_model = load_draft_model(model, tokenizer, device)
+    if draft_model is not None:
+        state.speculative = SpeculativeDecoder(draft_model)
+    
+    # identifies the weights and numerics of cached responses
+    state.model_fingerprint = model_fingerprint(model, device, state.speculative)
+    
+    # further models requests can name, pinned ones loaded now and the rest on first use
+    state.registry = model_registry()
+    if state.registry:
+        state.registry.load_pinned()
+    
+    # optionally batch concurrent requests together
+    state.batcher = None
+    batching_mode = os.environ.get('BATCHING_MODE', 'none')
+    if batching_mode == 'static':
+        state.batcher = BatchScheduler(state.executor, tokenizer, model, device, 
+            prefix_cache=state.prefix_cache, prompt_cache=state.prompt_cache)
+    elif batching_mode == 'continuous':
+        state.batcher = ContinuousBatcher(state.executor, tokenizer, model, device, 
+            prefix_cache=state.prefix_cache, prompt_cache=state.prompt_cache, initializer=pin)
+    if state.batcher:
+        state.batcher.start()
+    
+    # read at scrape time; the saturation is what the autoscaler and readiness probe act on
+    QUEUE_DEPTH.set_function(lambda: queue_depth(state))
+    QUEUE_SATURATION.set_function(lambda: saturation(state))
+    
+    rss, file_backed = memory_usage()
+    logger.info(f"Cold start took {time.perf_counter() - start_time:.2f}s, "
+        f"resident memory {rss / 2**20:.0f}MiB of which {file_backed / 2**20:.0f}MiB file-backed")
+
+async def stop_inference(state):
+    # wait for in-flight inference, then clean up model and tokenizer
+    if state.batcher:
+        await state.batcher.stop()
+    state.executor.shutdown()
+    if state.prefix_cache:
+        state.prefix_cache.clear()
+    if state.registry:
+        state.registry.clear()
+    del state.model, state.tokenizer, state.speculative
     logger.info("Model and tokenizer have been cleaned up.")
 
+async def wait_ready(state):
+    # an HTTP worker is ready once the inference process has finished its warm-up, and
+    # unhealthy like it when its warm-up fails for good
+    try:
+        await state.batcher.wait_ready()
+        state.ready = True
+    except RuntimeError as e:
+        logger.error(f"Inference process is not ready: {str(e)}")
+        state.warmup_failed = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # what requests call the model MODEL_DIR_PATH points at
+    app.state.model_name = os.path.basename(os.path.normpath(model_dir()))
+    remote = http_workers() > 1
+    if remote:
+        # the model lives in the inference process; this worker only parses, logs and forwards
+        app.state.tokenizer = load_tokenizer(model_dir())
+        # registry models are loaded by the inference process, only their tokenizers here
+        app.state.registry = model_registry(pinned=[])
+        app.state.batcher = InferenceClient(inference_socket())
+        await app.state.batcher.connect()
+        # metrics recorded here are kept by the inference process, so a scrape of any worker sees them all
+        REGISTRY.forward = app.state.batcher.record_metric
+        app.state.model_fingerprint = (await app.state.batcher.info())['model_fingerprint']
+    else:
+        await start_inference(app.state)
+    
+    # cache responses of deterministic requests, optionally shared between replicas
+    app.state.response_cache = None
+    if int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1024)) > 0:
+        redis_url = os.environ.get('RESPONSE_CACHE_REDIS_URL')
+        app.state.response_cache = ResponseCache(backend=RedisCacheBackend(redis_url) if redis_url else None)
+    
+    # warm up in the background while /health already answers; /ready stays 503 until done
+    app.state.ready = False
+    warmup = asyncio.create_task(wait_ready(app.state) if remote else warm_up(app.state))
+    
+    yield
+    # shutdown
+    warmup.cancel()
+    await asyncio.gather(warmup, return_exceptions=True)
+    if remote:
+        REGISTRY.forward = None
+        await app.state.batcher.close()
+    else:
+        await stop_inference(app.state)
+
+async def serve_inference():
+    # the model-owning process in multi-worker mode, serving the HTTP workers over IPC
+    state = State()
+    state.config = app.state.config
+    await start_inference(state)
+    
+    server = InferenceServer(state, inference_socket())
+    await server.start()
+    
+    state.ready = False
+    warmup = asyncio.create_task(warm_up(state))
+    
+    stopped = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+    
+    await server.stop()
+    warmup.cancel()
+    await asyncio.gather(warmup, return_exceptions=True)
+    await stop_inference(state)
+
+def run_inference_process():
+    asyncio.run(serve_inference())
+
+def model_registry(pinned: list[str] = None):
+    root = os.environ.get('MODEL_ROOT_PATH')
+    return ModelRegistry(root, pinned=pinned) if root else None
+
+def http_workers() -> int:
+    return int(os.environ.get('HTTP_WORKERS', 1))
+
+def inference_socket() -> str:
+    return os.environ.get('INFERENCE_SOCKET', "/tmp/llm-inference.sock")
+
 app = FastAPI(openapi_url=None, lifespan=lifespan)
 app.include_router(router)
+app.add_middleware(RequestIdMiddleware)
 
-logging.basicConfig(
-    level=logging.INFO, 
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+# generation defaults and limits are read from the environment once, not per request
+app.state.config = ServiceConfig.from_env()
+
+# JSON lines written by a background thread, Uvicorn's own logs included
+configure_logging()
 
 ####################### log service configuration#########################
 configured_vars = [
@@ -35,7 +199,46 @@ configured_vars = [
     'TEMPERATURE',
     'TOP_K',
     'TOP_P',
-    'REPETITION_PENALTY'
+    'REPETITION_PENALTY',
+    'MAX_NEW_TOKENS_LIMIT',
+    'GENERATION_TIMEOUT',
+    'CPU_INFERENCE_MODE',
+    'DRAFT_MODEL_DIR_PATH',
+    'SPECULATIVE_DRAFT_TOKENS',
+    'MODEL_MMAP',
+    'MODEL_ROOT_PATH',
+    'MODEL_REGISTRY_MAX_BYTES',
+    'MODEL_REGISTRY_PINNED',
+    'MODEL_REGISTRY_RESCAN_SECONDS',
+    'WARMUP_BATCH_SIZES',
+    'WARMUP_PROMPT_LENGTHS',
+    'WARMUP_MAX_NEW_TOKENS',
+    'WARMUP_ATTEMPTS',
+    'WARMUP_RETRY_BACKOFF',
+    'HTTP_WORKERS',
+    'INFERENCE_SOCKET',
+    'INFERENCE_WORKERS',
+    'TORCH_THREADS',
+    'TORCH_INTEROP_THREADS',
+    'CPU_PINNING',
+    'THREAD_CALIBRATION_PATH',
+    'MAX_QUEUE_DEPTH',
+    'READY_MAX_SATURATION',
+    'QUEUE_RETRY_AFTER',
+    'BATCHING_MODE',
+    'BATCH_MAX_SIZE',
+    'BATCH_MAX_WAIT_MS',
+    'BATCH_MAX_TOKENS',
+    'PREFIX_CACHE_MAX_BYTES',
+    'PROMPT_CACHE_MAX_ENTRIES',
+    'BULK_MAX_PROMPTS',
+    'LOG_FORMAT',
+    'LOG_LEVEL',
+    'LOG_PAYLOAD_SAMPLE_RATE',
+    'LOG_PAYLOAD_MAX_CHARS',
+    'RESPONSE_CACHE_MAX_ENTRIES',
+    'RESPONSE_CACHE_TTL',
+    'RESPONSE_CACHE_REDIS_URL'
 ]
 logger = logging.getLogger(__name__)
 logger.info("LLM microservice environment variables:")
@@ -47,4 +250,18 @@ for key in configured_vars:
 #############################################################################
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    if http_workers() > 1:
+        # one process owns the model and the HTTP workers forward requests to it, so the
+        # weights are loaded once however many workers parse requests
+        inference = multiprocessing.get_context("spawn").Process(target=run_inference_process, name="inference")
+        inference.start()
+        try:
+            # workers import torch at startup, which can keep them from answering the
+            # supervisor's health pings for a while on a busy node
+            uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=http_workers(), 
+                app_dir=os.path.dirname(os.path.abspath(__file__)), timeout_worker_healthcheck=60, log_config=None)
+        finally:
+            inference.terminate()
+            inference.join()
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000, log_config=None)
\ No newline at end of file
@@ -0,0 +1,185 @@
+import math
+import threading
+
+# seconds, from a fast decode step to a long generation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+# A metric in the Prometheus text format, with one series per distinct set of labels.
+# Updates go to the registry's `forward` hook when one is set, so HTTP worker processes
+# can record into the inference process's metrics instead of keeping their own.
+class _Metric:
+    type = None
+
+    def __init__(self, registry, name: str, help: str):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self._series = {}
+
+    def _record(self, method: str, value: float, labels: dict):
+        if self.registry.forward:
+            self.registry.forward(self.name, method, value, labels)
+        else:
+            self.apply(method, value, labels)
+
+    def apply(self, method: str, value: float, labels: dict):
+        key = tuple(sorted(labels.items()))
+        with self.registry.lock:
+            getattr(self, "_" + method)(key, value)
+
+    def samples(self):
+        # (suffix, labels, value) triples for the exposition
+        for key, value in self._series.items():
+            yield "", key, value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        self._record("inc", amount, labels)
+
+    def _inc(self, key, amount):
+        self._series[key] = self._series.get(key, 0) + amount
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, registry, name: str, help: str):
+        super().__init__(registry, name, help)
+        self._function = None
+
+    def inc(self, amount: float = 1, **labels):
+        self._record("inc", amount, labels)
+
+    def dec(self, amount: float = 1, **labels):
+        self._record("inc", -amount, labels)
+
+    def set(self, value: float, **labels):
+        self._record("set", value, labels)
+
+    def set_function(self, function):
+        # read the value at scrape time, for state another component already keeps
+        self._function = function
+
+    def _inc(self, key, amount):
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def _set(self, key, value):
+        self._series[key] = value
+
+    def samples(self):
+        if self._function:
+            yield "", (), self._function()
+        else:
+            yield from super().samples()
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, registry, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(registry, name, help)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        self._record("observe", value, labels)
+
+    def _observe(self, key, value):
+        # per bucket counts, sum and count
+        series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", key + (("le", _format_value(bound)),), cumulative
+            yield "_sum", key, total
+            yield "_count", key, count
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.forward = None
+        self._metrics = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(self, name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._add(Gauge(self, name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(self, name, help, buckets))
+
+    def apply(self, name: str, method: str, value: float, labels: dict):
+        # an update recorded in another process
+        self._metrics[name].apply(method, value, labels)
+
+    def render(self) -> str:
+        with self.lock:
+            lines = [line for metric in self._metrics.values() for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# per stage latency of a request, all measured with time.perf_counter
+QUEUE_WAIT = REGISTRY.histogram("llm_queue_wait_seconds", "Time a request waits before inference starts")
+TOKENIZATION = REGISTRY.histogram("llm_tokenization_seconds", "Time spent tokenizing prompts")
+PREFILL = REGISTRY.histogram("llm_prefill_seconds", "Time of a prefill forward pass over newly admitted prompts")
+DECODE_TOKEN = REGISTRY.histogram("llm_decode_token_seconds", "Time of one decode step, which generates one token per running sequence")
+DETOKENIZATION = REGISTRY.histogram("llm_detokenization_seconds", "Time spent decoding generated token ids to text")
+REQUEST_DURATION = REGISTRY.histogram("llm_request_duration_seconds", "Total time to answer a generation request")
+
+PROMPT_TOKENS = REGISTRY.counter("llm_prompt_tokens_total", "Prompt tokens processed")
+GENERATED_TOKENS = REGISTRY.counter("llm_generated_tokens_total", "Tokens generated")
+TOKENS_PER_SECOND = REGISTRY.histogram("llm_request_tokens_per_second", "Generated tokens per second of a request", RATE_BUCKETS)
+BATCH_SIZE = REGISTRY.histogram("llm_batch_size", "Sequences in a prefill or decode forward pass", SIZE_BUCKETS)
+CACHE_LOOKUPS = REGISTRY.counter("llm_cache_lookups_total", "Response and prefix cache lookups by result")
+REQUESTS_SHED = REGISTRY.counter("llm_requests_shed_total", "Requests dropped unanswered, because their deadline would pass before a first token or their client disconnected")
+
+# speculative decoding, the acceptance rate is accepted over drafted tokens
+SPECULATIVE_STEP = REGISTRY.histogram("llm_speculative_step_seconds", "Time of one speculative decoding step, drafting tokens and verifying them in one forward pass")
+SPECULATIVE_DRAFT_TOKENS = REGISTRY.counter("llm_speculative_draft_tokens_total", "Tokens proposed by the draft model")
+SPECULATIVE_ACCEPTED_TOKENS = REGISTRY.counter("llm_speculative_accepted_tokens_total", "Draft tokens accepted by the model")
+
+# models of the registry under MODEL_ROOT_PATH, loaded on first use
+MODEL_LOADS = REGISTRY.counter("llm_model_loads_total", "Registry models loaded, by model")
+MODEL_EVICTIONS = REGISTRY.counter("llm_model_evictions_total", "Registry models evicted to stay within the memory budget, by model")
+MODEL_LOAD_DURATION = REGISTRY.histogram("llm_model_load_seconds", "Time to load a registry model on first use")
+
+REQUESTS_IN_FLIGHT = REGISTRY.gauge("llm_requests_in_flight", "Generation requests being answered")
+QUEUE_DEPTH = REGISTRY.gauge("llm_queue_depth", "Requests running or waiting for inference")
+QUEUE_SATURATION = REGISTRY.gauge("llm_queue_saturation", "Fraction of the inference queue in use, at 1 new requests are rejected")
+MODEL_REGISTRY_BYTES = REGISTRY.gauge("llm_model_registry_bytes", "Memory of the registry models currently loaded")
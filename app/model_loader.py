@@ -1,36 +1,206 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
+from transformers import LogitsProcessorList, SuppressTokensLogitsProcessor
+from transformers.pytorch_utils import Conv1D
 import os
+import time
 import torch
-import logging 
+import logging
+import resource
+from decoding import Sequence, generate_sequences
+from weights import safetensors_files, read_manifest, mmap_state_dict
 
 logger = logging.getLogger(__name__)
 
+CPU_INFERENCE_MODES = ('fp32', 'int8', 'bf16', 'compile')
+
+def cpu_supports_bf16() -> bool:
+    # bf16 is only faster than fp32 with native instructions, otherwise it is emulated
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def _conv1d_to_linear(model):
+    # GPT-2 style models implement their projections as transformers' Conv1D, which
+    # dynamic quantization does not recognise; nn.Linear is the same op with the weight transposed
+    for parent in list(model.modules()):
+        for name, child in parent.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous())
+                linear.bias = child.bias
+                setattr(parent, name, linear)
+    return model
+
+def quantize_int8(model):
+    # int8 weights with activations quantized on the fly; the output projection is left
+    # alone because it shares its weights with the input embeddings
+    model = _conv1d_to_linear(model)
+    output_embeddings = model.get_output_embeddings()
+    linears = {name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and module is not output_embeddings}
+    return torch.ao.quantization.quantize_dynamic(model, linears, dtype=torch.qint8, inplace=True)
+
+def compile_forward(model, tokenizer, device):
+    # compile at load time by decoding through the same code paths requests use, one
+    # sequence alone and two together, so the first requests do not pay for it
+    model.forward = torch.compile(model.forward, dynamic=True)
+    eos_token_id = tokenizer.eos_token_id
+    # EOS is suppressed so every warm-up sequence runs its decode steps
+    no_eos = LogitsProcessorList([SuppressTokensLogitsProcessor([eos_token_id], device=device)])
+    with torch.no_grad():
+        for lengths in ([4], [4, 6]):
+            sequences = [Sequence([eos_token_id] * length, 3, eos_token_id, no_eos, do_sample=False) for length in lengths]
+            generate_sequences(model, sequences, device)
+    return model
+
+def memory_usage() -> tuple[int, int]:
+    # resident bytes of this process and how many of them are file-backed; mapped weights
+    # are file-backed, so other processes mapping the same files share those pages
+    try:
+        with open('/proc/self/status') as status:
+            fields = dict(line.split(':', 1) for line in status.read().splitlines())
+        kb = lambda name: int(fields.get(name, '0 kB').split()[0]) * 1024
+        return kb('VmRSS'), kb('RssFile')
+    except OSError:
+        # peak rather than current RSS, reported in KiB on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 0
+
+def load_mmap_model(model_dir_path: str):
+    # the model with its weights mapped read-only from the safetensors files, or None when
+    # there are none or they do not cover every weight
+    if not os.path.isdir(model_dir_path) or not safetensors_files(model_dir_path):
+        return None
+
+    # build the model without allocating weights, then point it at the mapped tensors
+    config = AutoConfig.from_pretrained(model_dir_path)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config)
+    model.load_state_dict(mmap_state_dict(model_dir_path, read_manifest(model_dir_path)), strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    if missing:
+        logger.warning(f"Safetensors weights do not cover {', '.join(missing[:5])}, loading a private copy instead")
+        return None
+    return model.eval()
+
+def model_dir() -> str:
+    return os.environ.get(
+        'MODEL_DIR_PATH',   # used to run service natively on host
+        os.path.abspath("./model"))
+
+def load_tokenizer(model_dir_path: str):
+    # the Rust-backed tokenizer encodes and decodes batches in parallel and is several times
+    # faster than the Python one, which transformers silently falls back to without tokenizer.json
+    tokenizer = AutoTokenizer.from_pretrained(model_dir_path, use_fast=True)
+    if not tokenizer.is_fast:
+        raise ValueError(f"{type(tokenizer).__name__} is not a fast tokenizer, save one to {model_dir_path} "
+            "with scripts/model_download.py")
+    # set pad_token for the tokenizer
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+def load_model(model_dir_path: str):
+    # model, tokenizer and device of a model directory, in the configured CPU inference mode
+    mode = os.environ.get('CPU_INFERENCE_MODE', 'fp32')
+    if mode not in CPU_INFERENCE_MODES:
+        raise ValueError(f"CPU_INFERENCE_MODE must be one of {', '.join(CPU_INFERENCE_MODES)}, got {mode}")
+
+    start_time = time.perf_counter()
+
+    device = None
+    if torch.backends.mps.is_available():
+        device = torch.device("mps")
+    else:
+        device = "cpu"
+        if mode == 'bf16' and not cpu_supports_bf16():
+            logger.warning("CPU has no native bf16 support, falling back to fp32")
+            mode = 'fp32'
+
+    # map the weights so worker processes share them, unless they are converted right away
+    model = None
+    if os.environ.get('MODEL_MMAP', 'true').lower() == 'true' and device == "cpu" and mode != 'bf16':
+        model = load_mmap_model(model_dir_path)
+    mapped = model is not None
+
+    # load model and tokenizer, bf16 weights are loaded as such to avoid an fp32 copy
+    if model is None:
+        dtype = torch.bfloat16 if device == "cpu" and mode == 'bf16' else None
+        model = AutoModelForCausalLM.from_pretrained(model_dir_path, dtype=dtype)
+    tokenizer = load_tokenizer(model_dir_path)
+
+    if device != "cpu":
+        # Move model to device with half-precision if MPS is available
+        model = model.to(dtype=torch.float16, device=device)
+        mode = 'fp16'
+
+    # set pad_token for the model
+    model.config.pad_token_id = model.config.eos_token_id
+
+    if mode == 'int8':
+        model = quantize_int8(model)
+    elif mode == 'compile':
+        try:
+            model = compile_forward(model, tokenizer, device)
+        except Exception as e:
+            logger.warning(f"torch.compile failed, running eagerly instead. Error: {str(e)}")
+            del model.forward
+            mode = 'fp32'
+
+    # numerics differ between modes, which the response cache has to know about
+    model.inference_mode = mode
+
+    load_time = time.perf_counter() - start_time
+    weights = "mapped" if mapped else "private"
+    logger.info(f"Model and tokenizer successfully loaded from {model_dir_path} on device {device} "
+        f"in {mode} mode with {weights} weights in {load_time:.2f}s")
+    return model, tokenizer, device
+
 def load_model_and_tokenizer():
     try:
-        model_dir_path = os.environ.get(
-            'MODEL_DIR_PATH',   # used to run service natively on host
-            os.path.abspath("./model"))
-
-        # load model and tokenizer
-        model = AutoModelForCausalLM.from_pretrained(model_dir_path)
-        tokenizer = AutoTokenizer.from_pretrained(model_dir_path)
-
-        device = None  
-        if torch.backends.mps.is_available():
-            device = torch.device("mps") 
-            
-            # Move model to device with half-precision if MPS is available
-            model = model.to(dtype=torch.float16, device=device)
-        else:
-            device = "cpu"
-                
-        # set pad_token for the tokenizer and model
-        tokenizer.pad_token = tokenizer.eos_token
-        model.config.pad_token_id = model.config.eos_token_id
-
-        logger.info(f"Model and tokenizer successfully loaded from {model_dir_path} on device {device}")
-        return model, tokenizer, device
+        model_dir_path = model_dir()
+        return load_model(model_dir_path)
 
     except Exception as e:
         logger.error(f"Failed to load model or tokenizer from {model_dir_path}. Error: {str(e)}")
-        raise SystemExit("Model loading process failed. Exiting application.") from e
\ No newline at end of file
+        raise SystemExit("Model loading process failed. Exiting application.") from e
+
+def load_draft_model(model, tokenizer, device):
+    # the smaller model drafting tokens for speculative decoding, None unless DRAFT_MODEL_DIR_PATH
+    # is set; it is loaded in the model's mode and has to share its tokenizer
+    draft_dir_path = os.environ.get('DRAFT_MODEL_DIR_PATH')
+    if not draft_dir_path:
+        return None
+
+    try:
+        start_time = time.perf_counter()
+        mode = model.inference_mode
+        if load_tokenizer(draft_dir_path).get_vocab() != tokenizer.get_vocab():
+            raise ValueError(f"tokenizer of {draft_dir_path} differs from the model's")
+
+        draft = None
+        if os.environ.get('MODEL_MMAP', 'true').lower() == 'true' and device == "cpu" and mode != 'bf16':
+            draft = load_mmap_model(draft_dir_path)
+        if draft is None:
+            dtype = torch.bfloat16 if mode == 'bf16' else None
+            draft = AutoModelForCausalLM.from_pretrained(draft_dir_path, dtype=dtype).eval()
+        if draft.config.vocab_size != model.config.vocab_size:
+            raise ValueError(f"vocabulary of {draft.config.vocab_size} tokens differs from the model's {model.config.vocab_size}")
+
+        if device != "cpu":
+            draft = draft.to(dtype=torch.float16, device=device)
+        draft.config.pad_token_id = draft.config.eos_token_id
+        # a compiled model still drafts with an eager one, drafts are one token at a time
+        if mode == 'int8':
+            draft = quantize_int8(draft)
+
+        logger.info(f"Draft model successfully loaded from {draft_dir_path} in {time.perf_counter() - start_time:.2f}s")
+        return draft
+
+    except Exception as e:
+        logger.error(f"Failed to load draft model from {draft_dir_path}. Error: {str(e)}")
+        raise SystemExit("Draft model loading process failed. Exiting application.") from e
@@ -0,0 +1,146 @@
+import os
+import time
+import logging
+import threading
+import torch
+from metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+class _Node:
+
+    def __init__(self, tokens: tuple, kv, parent):
+        # `tokens` is the edge from the parent, `kv` holds one (key, value) pair per
+        # layer covering just those tokens
+        self.tokens = tokens
+        self.kv = kv
+        self.parent = parent
+        self.children = {}
+        self.last_access = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        if not self.kv:
+            return 0
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in self.kv)
+
+    def split(self, at: int):
+        # keep the first `at` tokens here and move the rest into a new child
+        # both halves are copied so each owns its memory and can be evicted on its own
+        child = _Node(self.tokens[at:], [(k[:, :, at:].clone(), v[:, :, at:].clone()) for k, v in self.kv], self)
+        child.children = self.children
+        child.last_access = self.last_access
+        for grandchild in child.children.values():
+            grandchild.parent = child
+
+        self.tokens = self.tokens[:at]
+        self.kv = [(k[:, :, :at].clone(), v[:, :, :at].clone()) for k, v in self.kv]
+        self.children = {child.tokens[0]: child}
+
+# Radix tree over prompt token ids whose edges carry the KV cache for their tokens, so
+# prompts sharing a prefix (system preambles, canned openers) only prefill the part that
+# differs. Entries are evicted least recently used, leaf first, once the cached tensors
+# exceed `max_bytes`.
+class PrefixCache:
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.environ.get('PREFIX_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+        self._root = _Node((), None, None)
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+
+        logger.info(f"Prefix cache enabled with a budget of {self.max_bytes} bytes")
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(self, token_ids: list[int]):
+        # longest cached prefix of `token_ids` as (length, per-layer (key, value) tensors)
+        with self._lock:
+            node, matched, segments = self._root, 0, []
+            now = time.monotonic()
+            while matched < len(token_ids):
+                child = node.children.get(token_ids[matched])
+                if child is None:
+                    break
+                common = self._common_length(child.tokens, token_ids[matched:])
+                child.last_access = now
+                segments.append([(k[:, :, :common], v[:, :, :common]) for k, v in child.kv])
+                matched += common
+                if common < len(child.tokens):
+                    break
+                node = child
+
+            if not matched:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache="prefix", result="miss")
+                return 0, None
+
+            self.hits += 1
+            CACHE_LOOKUPS.inc(cache="prefix", result="hit")
+            self.hit_tokens += matched
+
+        kv = [(torch.cat([s[layer][0] for s in segments], dim=2), torch.cat([s[layer][1] for s in segments], dim=2))
+            for layer in range(len(segments[0]))]
+        return matched, kv
+
+    def insert(self, token_ids: list[int], kv):
+        # cache the KV tensors of `token_ids`; `kv` covers exactly those tokens
+        with self._lock:
+            node, matched = self._root, 0
+            now = time.monotonic()
+            while matched < len(token_ids):
+                child = node.children.get(token_ids[matched])
+                if child is None:
+                    # clone so the cache does not pin the batch tensors the slice came from
+                    segment = [(k[:, :, matched:].clone(), v[:, :, matched:].clone()) for k, v in kv]
+                    leaf = _Node(tuple(token_ids[matched:]), segment, node)
+                    node.children[leaf.tokens[0]] = leaf
+                    self.size_bytes += leaf.nbytes
+                    break
+
+                common = self._common_length(child.tokens, token_ids[matched:])
+                if common < len(child.tokens):
+                    child.split(common)
+                child.last_access = now
+                matched += common
+                node = child
+
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._root = _Node((), None, None)
+            self.size_bytes = 0
+
+    def _evict(self):
+        while self.size_bytes > self.max_bytes:
+            leaves = []
+            stack = list(self._root.children.values())
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                else:
+                    leaves.append(node)
+            if not leaves:
+                break
+
+            victim = min(leaves, key=lambda n: n.last_access)
+            del victim.parent.children[victim.tokens[0]]
+            self.size_bytes -= victim.nbytes
+
+    @staticmethod
+    def _common_length(a, b) -> int:
+        length = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            length += 1
+        return length
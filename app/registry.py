@@ -0,0 +1,175 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from generate import Generation, generate_text
+from streaming import CancelToken
+from model_loader import load_model, load_tokenizer
+from weights import safetensors_files
+from metrics import MODEL_LOADS, MODEL_EVICTIONS, MODEL_LOAD_DURATION, MODEL_REGISTRY_BYTES
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class LoadedModel:
+    name: str
+    model: object
+    tokenizer: object
+    device: object
+    nbytes: int
+
+def _estimated_bytes(path: str) -> int:
+    # the size of the weight files, known before the model is loaded
+    files = safetensors_files(path) or [f for f in os.listdir(path) if f.endswith(".bin")]
+    return sum(os.path.getsize(os.path.join(path, f)) for f in files)
+
+# The models found under a root directory, one per subdirectory with a config.json, named
+# after the subdirectory, looked for again at most every `rescan_seconds` when a request
+# names a model not found before. A model is loaded on its first request and the least recently
+# used ones are evicted once the loaded models take more than `max_bytes`; pinned models
+# are loaded up front and never evicted. An evicted model's memory is freed once the
+# requests still running on it have finished.
+class ModelRegistry:
+
+    def __init__(self, root: str, max_bytes: int = None, pinned: list[str] = None, rescan_seconds: float = None):
+        self.root = root
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.environ.get('MODEL_REGISTRY_MAX_BYTES', 4 * 2**30))
+        # requests for unknown models are checked on the event loop, so they may not list
+        # the root directory each time
+        self.rescan_seconds = rescan_seconds if rescan_seconds is not None else float(os.environ.get('MODEL_REGISTRY_RESCAN_SECONDS', 10))
+        if pinned is None:
+            pinned = [name for name in os.environ.get('MODEL_REGISTRY_PINNED', "").split(",") if name.strip()]
+        self.pinned = set(name.strip() for name in pinned)
+
+        self._paths = {}
+        self._models = OrderedDict()
+        self._tokenizers = {}
+        # one lock per model so concurrent first requests load it once, and a registry
+        # lock held only briefly so loading one model never blocks requests for another
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._discovered_at = None
+        self.discover()
+
+        unknown = self.pinned - set(self._paths)
+        if unknown:
+            raise ValueError(f"Pinned models {', '.join(sorted(unknown))} not found under {root}")
+        logger.info(f"Model registry found {len(self._paths)} models under {root} "
+            f"with a budget of {self.max_bytes / 2**20:.0f}MiB")
+
+    def discover(self):
+        # picks up model directories added since the last look
+        paths = {}
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if os.path.isfile(os.path.join(path, "config.json")):
+                paths[name] = path
+        with self._lock:
+            self._paths = paths
+            self._discovered_at = time.monotonic()
+            for name in paths:
+                self._locks.setdefault(name, threading.Lock())
+
+    def __contains__(self, name: str) -> bool:
+        if name not in self._paths and time.monotonic() - self._discovered_at >= self.rescan_seconds:
+            self.discover()
+        return name in self._paths
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(loaded.nbytes for loaded in self._models.values())
+
+    def describe(self) -> list[dict]:
+        with self._lock:
+            return [{"name": name, "loaded": name in self._models, "pinned": name in self.pinned,
+                "bytes": self._models[name].nbytes if name in self._models else None} for name in self._paths]
+
+    def load_pinned(self):
+        for name in sorted(self.pinned):
+            self.get(name)
+        if self.used_bytes > self.max_bytes:
+            logger.warning(f"Pinned models take {self.used_bytes / 2**20:.0f}MiB, "
+                f"more than the registry budget of {self.max_bytes / 2**20:.0f}MiB")
+
+    def tokenizer(self, name: str):
+        # loaded on its own, so HTTP workers can stream without loading the model
+        if name not in self:
+            raise ValueError(f"Unknown model {name}")
+        with self._locks[name]:
+            if name not in self._tokenizers:
+                self._tokenizers[name] = load_tokenizer(self._paths[name])
+            return self._tokenizers[name]
+
+    def get(self, name: str) -> LoadedModel:
+        # blocks while the model loads, so call it off the event loop
+        if name not in self:
+            raise ValueError(f"Unknown model {name}")
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+
+        with self._locks[name]:
+            # loaded by a concurrent request while this one waited for the lock
+            with self._lock:
+                if name in self._models:
+                    self._models.move_to_end(name)
+                    return self._models[name]
+                # make room before loading so the budget holds at the peak too
+                self._evict(_estimated_bytes(self._paths[name]))
+
+            start_time = time.perf_counter()
+            try:
+                model, tokenizer, device = load_model(self._paths[name])
+            except Exception as e:
+                logger.error(f"Failed to load model {name}. Error: {str(e)}")
+                raise RuntimeError(f"Model {name} could not be loaded") from e
+            loaded = LoadedModel(name, model, self._tokenizers.setdefault(name, tokenizer), device, model.get_memory_footprint())
+
+            with self._lock:
+                self._models[name] = loaded
+                self._evict(0)
+                MODEL_REGISTRY_BYTES.set(self.used_bytes)
+            MODEL_LOADS.inc(model=name)
+            MODEL_LOAD_DURATION.observe(time.perf_counter() - start_time)
+            logger.info(f"Model {name} loaded into the registry, {self.used_bytes / 2**20:.0f}MiB "
+                f"of {self.max_bytes / 2**20:.0f}MiB in use")
+            return loaded
+
+    def _evict(self, needed: int):
+        # least recently used first; called with the registry lock held
+        for name in list(self._models):
+            if self.used_bytes + needed <= self.max_bytes:
+                break
+            if name in self.pinned or (needed == 0 and name == next(reversed(self._models))):
+                continue
+            del self._models[name]
+            MODEL_EVICTIONS.inc(model=name)
+            logger.info(f"Model {name} evicted from the registry")
+        MODEL_REGISTRY_BYTES.set(self.used_bytes)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+        MODEL_REGISTRY_BYTES.set(0)
+
+async def generate_on(state, name: str, prompt: str, params, streamer=None) -> Generation:
+    # a generation on a registry model, unbatched and without the default model's caches,
+    # on the same executor so admission control covers every model
+    loaded = await asyncio.to_thread(state.registry.get, name)
+    streamer = streamer or CancelToken()
+    try:
+        return await state.executor.submit(generate_text,
+            prompt,
+            loaded.tokenizer,
+            loaded.model,
+            loaded.device,
+            params,
+            streamer)
+    except asyncio.CancelledError:
+        # the caller gave up, stop decoding
+        streamer.cancelled = True
+        raise
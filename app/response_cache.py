@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+from dataclasses import asdict, replace
+from config import GenerationParams
+from metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+def model_fingerprint(model, device, speculative=None) -> str:
+    # identifies the weights and numerics a cached response was produced with; a draft model
+    # changes which tokens a seed samples, not their distribution
+    config = model.config.to_json_string(use_diff=False)
+    mode = getattr(model, 'inference_mode', '')
+    source = f"{getattr(model.config, '_name_or_path', '')}|{model.dtype}|{mode}|{device}|{config}"
+    if speculative:
+        source += f"|{getattr(speculative.draft_model.config, '_name_or_path', '')}|{speculative.draft_tokens}"
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+def cache_key(fingerprint: str, prompt: str, params: GenerationParams) -> str:
+    data = {
+        "model": fingerprint,
+        "prompt": unicodedata.normalize("NFC", prompt),
+        # the deadline does not change the output, timed out responses are never cached
+        "params": asdict(replace(params, timeout=None))
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Interface for a cache shared between replicas
+class CacheBackend:
+
+    async def get(self, key: str):
+        raise NotImplementedError
+
+    async def set(self, key: str, value, ttl: int):
+        raise NotImplementedError
+
+class RedisCacheBackend(CacheBackend):
+
+    def __init__(self, url: str, prefix: str = "llm-response:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise ImportError("RESPONSE_CACHE_REDIS_URL is set but the `redis` package is not installed") from e
+
+        self._client = redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    async def get(self, key: str):
+        value = await self._client.get(self._prefix + key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value, ttl: int):
+        await self._client.set(self._prefix + key, json.dumps(value), ex=ttl)
+
+# In-process LRU cache of generated responses for deterministic requests, optionally backed
+# by a shared store. Identical requests arriving while one is already being generated
+# wait for that generation instead of starting their own, which is cancelled once every
+# request waiting for it has gone away.
+class ResponseCache:
+
+    def __init__(self, max_entries: int = None, ttl: int = None, backend: CacheBackend = None):
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1024))
+        self.ttl = ttl if ttl is not None else int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+        self.backend = backend
+
+        self._entries = OrderedDict()
+        self._inflight = {}
+        # requests waiting for each in-flight generation
+        self._waiters = {}
+        self.hits = 0
+        self.misses = 0
+
+        logger.info(f"Response cache enabled with {self.max_entries} entries and a {self.ttl}s TTL")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get_or_generate(self, key: str, generate, cacheable=None):
+        value = self._get_local(key)
+        if value is not None:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(cache="response", result="hit")
+            return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            # generate in its own task, so a caller going away leaves it running for the
+            # others waiting on the same key
+            task = asyncio.ensure_future(self._fill(key, generate, cacheable))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(cache="response", result="hit")
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                # the last caller has gone, stop generating a response nobody waits for
+                if not task.done():
+                    task.cancel()
+
+    def _finish(self, key: str, task):
+        self._inflight.pop(key, None)
+        # mark a failure as seen even when every waiting caller has gone away
+        if not task.cancelled():
+            task.exception()
+
+    async def _fill(self, key: str, generate, cacheable=None):
+        if self.backend:
+            try:
+                value = await self.backend.get(key)
+                if value is not None:
+                    self.hits += 1
+                    CACHE_LOOKUPS.inc(cache="response", result="hit")
+                    self._set_local(key, value)
+                    return value
+            except Exception as e:
+                logger.warning(f"Response cache backend read failed: {str(e)}")
+
+        self.misses += 1
+        CACHE_LOOKUPS.inc(cache="response", result="miss")
+        value = await generate()
+        # waiting callers still share an uncacheable value, it is just not kept
+        if cacheable is not None and not cacheable(value):
+            return value
+        self._set_local(key, value)
+
+        if self.backend:
+            try:
+                await self.backend.set(key, value, self.ttl)
+            except Exception as e:
+                logger.warning(f"Response cache backend write failed: {str(e)}")
+        return value
+
+    def _get_local(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
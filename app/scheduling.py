@@ -0,0 +1,55 @@
+import math
+import time
+import contextvars
+from dataclasses import dataclass
+from metrics import REQUESTS_SHED
+
+# priority classes, most urgent first
+PRIORITIES = ("interactive", "bulk")
+
+# weight of the latest prefill in the smoothed prefill time
+PREFILL_SMOOTHING = 0.2
+_prefill_seconds = 0.0
+
+def observe_prefill(seconds: float):
+    # recent prefills, from generation starting to the first token, smoothed
+    global _prefill_seconds
+    _prefill_seconds = seconds if not _prefill_seconds else _prefill_seconds + PREFILL_SMOOTHING * (seconds - _prefill_seconds)
+
+def prefill_seconds() -> float:
+    return _prefill_seconds
+
+class DeadlineExceededError(Exception):
+    def __init__(self):
+        super().__init__("Request deadline would pass before generation could produce a first token")
+
+@dataclass(frozen=True)
+class Schedule:
+    priority: str = "interactive"
+    # time.monotonic() by which the client needs its response, None when it waits for as long as it takes
+    deadline: float | None = None
+
+    @classmethod
+    def within(cls, priority: str = None, seconds: float = None):
+        return cls(priority or "interactive", time.monotonic() + seconds if seconds is not None else None)
+
+    def key(self) -> tuple:
+        # the more urgent priority class first, earliest deadline first within a class
+        return PRIORITIES.index(self.priority), self.deadline if self.deadline is not None else math.inf
+
+    def remaining(self) -> float | None:
+        return self.deadline - time.monotonic() if self.deadline is not None else None
+
+    @property
+    def too_late(self) -> bool:
+        # started now, it would not even have its first token by the deadline
+        return self.deadline is not None and self.remaining() <= _prefill_seconds
+
+# the schedule of the request being handled; set per request, like the request id of log
+# lines, and carried into executor threads and the inference process
+current = contextvars.ContextVar("schedule", default=Schedule())
+
+def shed(schedule: Schedule) -> DeadlineExceededError:
+    # the error a request gets when it is dropped instead of started
+    REQUESTS_SHED.inc(priority=schedule.priority, reason="deadline")
+    return DeadlineExceededError()
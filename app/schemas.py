@@ -0,0 +1,24 @@
+from typing import Annotated, Literal
+from pydantic import BaseModel, Field
+
+class GenerationOverrides(BaseModel):
+    max_new_tokens: int | None = Field(None, ge=1, description="Tokens to generate, capped at the server limit")
+    temperature: float | None = Field(None, ge=0.0, le=2.0, description="Sampling temperature, 0 for greedy decoding")
+    top_k: int | None = Field(None, ge=0, description="Top-K sampling, 0 disables it")
+    top_p: float | None = Field(None, gt=0.0, le=1.0, description="Nucleus sampling threshold")
+    repetition_penalty: float | None = Field(None, gt=0.0, le=2.0, description="Penalises repeated tokens")
+    stop: list[Annotated[str, Field(min_length=1)]] | None = Field(None, max_length=4, description="Stop generating at the first of these strings")
+    stop_token_ids: list[Annotated[int, Field(ge=0)]] | None = Field(None, max_length=8, description="Stop generating after any of these token ids")
+    timeout: float | None = Field(None, gt=0, description="Seconds after which generation stops, capped at the server limit")
+    seed: int | None = Field(None, ge=0, description="Seed for reproducible sampling")
+
+class GenerateRequest(GenerationOverrides):
+    # a missing prompt is reported by the handler as a 400, not a schema error
+    prompt: str | None = None
+    model: str | None = Field(None, description="Model to generate with, one of GET /models; the default model when not set")
+    priority: Literal["interactive", "bulk"] | None = Field(None, description="Priority class, interactive requests are started before bulk ones")
+    deadline: float | None = Field(None, gt=0, description="Seconds within which the response is needed; the request is dropped if it cannot get a first token by then, and generation stops there")
+
+class BatchGenerateRequest(GenerationOverrides):
+    # one set of overrides for every prompt; empty prompts are reported per item
+    prompts: list[str] = Field(min_length=1, description="Prompts to generate for, answered by index")
@@ -0,0 +1,131 @@
+import os
+import time
+import logging
+import threading
+import torch
+from transformers import DynamicCache
+from decoding import Sequence, prefill, release, _cache_tensors
+from metrics import SPECULATIVE_STEP, SPECULATIVE_DRAFT_TOKENS, SPECULATIVE_ACCEPTED_TOKENS
+
+logger = logging.getLogger(__name__)
+
+def _forward(model, token_ids: list[int], past, device):
+    # run `token_ids` on from a cache of the tokens before them, one row of logits per token
+    length = past[0][0].shape[2] if past else 0
+    outputs = model(input_ids=torch.tensor([token_ids], device=device),
+        attention_mask=torch.ones(1, length + len(token_ids), dtype=torch.long, device=device),
+        past_key_values=DynamicCache(ddp_cache_data=past) if past else None,
+        position_ids=torch.arange(length, length + len(token_ids), device=device).unsqueeze(0),
+        use_cache=True)
+    return outputs.logits[0].float(), _cache_tensors(outputs.past_key_values)
+
+def _truncate(past, length: int):
+    return [(k[:, :, :length], v[:, :, :length]) for k, v in past]
+
+def _scores(sequence: Sequence, token_ids: list[int], logits):
+    # the sequence's own repetition penalty and warpers, as if `token_ids` had been generated
+    return sequence.logits_processor(torch.tensor([token_ids], device=logits.device), logits.unsqueeze(0))[0]
+
+def verify_draft(p, q, token: int, generator=None) -> int:
+    # Keeps a token drawn from the draft distribution `q` with probability min(1, p/q),
+    # otherwise draws a replacement from what is left of `p` once `q` is taken away. The
+    # token that comes out follows `p`, the target model's distribution, whatever `q` is.
+    if torch.rand(1, generator=generator, device=p.device) * q[token] < p[token]:
+        return token
+    residual = (p - q).clamp(min=0)
+    if residual.sum() <= 0:
+        residual = p
+    return int(torch.multinomial(residual, num_samples=1, generator=generator))
+
+# Speculative decoding: a small draft model sharing the tokenizer proposes `draft_tokens`
+# tokens one at a time, and the model checks all of them in a single forward pass. Accepted
+# drafts cost one draft forward pass each instead of a pass of the large model, and every
+# step still yields at least the one token the model would have produced itself. Greedy
+# requests get the same tokens as without a draft model, sampled ones the same distribution.
+class SpeculativeDecoder:
+
+    def __init__(self, draft_model, draft_tokens: int = None):
+        self.draft_model = draft_model
+        self.draft_tokens = draft_tokens if draft_tokens is not None else int(os.environ.get('SPECULATIVE_DRAFT_TOKENS', 4))
+
+        # drafted and accepted tokens since start, their ratio is the acceptance rate
+        self._lock = threading.Lock()
+        self.drafted = 0
+        self.accepted = 0
+
+        logger.info(f"Speculative decoding enabled with {self.draft_tokens} draft tokens per step")
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def generate(self, model, sequence: Sequence, device, prefix_cache=None) -> Sequence:
+        if sequence.finished:
+            return sequence
+        prefill(model, [sequence], device, prefix_cache)
+
+        # the draft model's own cache, covering the first `drafted` tokens of the sequence
+        draft_past, drafted = None, 0
+        while not sequence.finished and not sequence.cancelled:
+            draft_past, drafted = self._step(model, sequence, device, draft_past, drafted)
+
+        release(sequence)
+        return sequence
+
+    def _step(self, model, sequence: Sequence, device, draft_past, drafted: int):
+        start_time = time.perf_counter()
+        context = sequence.token_ids
+        # no more drafts than could be kept, the model adds one token of its own
+        k = max(0, min(self.draft_tokens, sequence.max_new_tokens - len(sequence.generated_ids) - 1))
+        if sequence.do_sample and sequence.seed is not None and sequence.generator is None:
+            sequence.generator = torch.Generator(device=device).manual_seed(sequence.seed)
+
+        drafts, draft_probs = [], []
+        feed = context[drafted:]
+        for _ in range(k):
+            logits, draft_past = _forward(self.draft_model, feed, draft_past, device)
+            scores = _scores(sequence, context + drafts, logits[-1])
+            if sequence.do_sample:
+                probs = torch.softmax(scores, dim=-1)
+                token = int(torch.multinomial(probs, num_samples=1, generator=sequence.generator))
+                draft_probs.append(probs)
+            else:
+                token = int(scores.argmax())
+            drafts.append(token)
+            feed = [token]
+
+        # the last token and every draft through the model at once, one row of logits for
+        # each draft to check and one more for the token after them all
+        logits, past = _forward(model, context[-1:] + drafts, sequence.past, device)
+        tokens = []
+        for i in range(k + 1):
+            scores = _scores(sequence, context + tokens, logits[i])
+            if not sequence.do_sample:
+                token = int(scores.argmax())
+            elif i < k:
+                token = verify_draft(torch.softmax(scores, dim=-1), draft_probs[i], drafts[i], sequence.generator)
+            else:
+                token = int(torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1, generator=sequence.generator))
+            tokens.append(token)
+            if i == k or token != drafts[i]:
+                break
+        accepted = len(tokens) - 1
+
+        for token in tokens:
+            sequence.append(token)
+            if sequence.finished:
+                break
+
+        # drop the cache entries of rejected drafts
+        sequence.past = _truncate(past, len(context) + accepted)
+        if draft_past:
+            drafted = min(draft_past[0][0].shape[2], len(context) + accepted)
+            draft_past = _truncate(draft_past, drafted)
+
+        with self._lock:
+            self.drafted += k
+            self.accepted += accepted
+        SPECULATIVE_DRAFT_TOKENS.inc(k)
+        SPECULATIVE_ACCEPTED_TOKENS.inc(accepted)
+        SPECULATIVE_STEP.observe(time.perf_counter() - start_time)
+        return draft_past, drafted
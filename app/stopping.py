@@ -0,0 +1,57 @@
+import time
+
+# Conditions that end a sequence early, checked after every generated token. They play
+# the role of transformers' `StoppingCriteria`, but are evaluated per sequence on its
+# token ids so each sequence in a running batch stops on its own. `reason` is reported
+# as the sequence's finish reason.
+class StoppingCriterion:
+    reason = None
+
+    def __call__(self, sequence) -> bool:
+        raise NotImplementedError
+
+class StopTokenCriterion(StoppingCriterion):
+    reason = "stop_token"
+
+    def __init__(self, token_ids):
+        self.token_ids = frozenset(token_ids)
+
+    def __call__(self, sequence) -> bool:
+        return sequence.generated_ids[-1] in self.token_ids
+
+class StopStringCriterion(StoppingCriterion):
+    reason = "stop"
+
+    def __init__(self, tokenizer, stop: tuple):
+        self.tokenizer = tokenizer
+        self.stop = tuple(stop)
+        # every token decodes to at least one character, so a stop string that the
+        # newest token completed lies within this many trailing tokens
+        self.window = max(len(s) for s in self.stop) + 1
+
+    def __call__(self, sequence) -> bool:
+        # only the decoded tail is checked, so the cost per step does not grow with the output
+        tail = self.tokenizer.decode(sequence.generated_ids[-self.window:], skip_special_tokens=True)
+        return any(s in tail for s in self.stop)
+
+class DeadlineCriterion(StoppingCriterion):
+    reason = "timeout"
+
+    def __init__(self, timeout: float):
+        self.deadline = time.monotonic() + timeout
+
+    def __call__(self, sequence) -> bool:
+        return time.monotonic() >= self.deadline
+
+def truncate_at_stop(text: str, start: int, stop: tuple) -> str:
+    # cut the text at the first stop string found at or after `start`, so a stop
+    # string inside the prompt is left alone
+    cuts = [i for i in (text.find(s, start) for s in stop) if i != -1]
+    return text[:min(cuts)] if cuts else text
+
+def held_back(text: str, stop: tuple) -> int:
+    # length of the longest tail of `text` that could still grow into a stop string
+    for length in range(min(len(text), max(len(s) for s in stop) - 1), 0, -1):
+        if any(s.startswith(text[-length:]) for s in stop):
+            return length
+    return 0
@@ -0,0 +1,116 @@
+import json
+import time
+import asyncio
+from stopping import truncate_at_stop, held_back
+
+_END = object()
+
+# Bridges tokens from the decode thread to an async HTTP response. The decode loop calls
+# `put` for every new token and `end` when the sequence finishes; the request handler
+# iterates over text chunks. Setting `cancelled` stops the decode loop at its next step.
+# Text that might be the start of a stop string is held back until it is known not to be.
+class TokenStreamer:
+
+    def __init__(self, tokenizer, stop: tuple = ()):
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.cancelled = False
+        self.finish_reason = None
+        self.first_token_time = None
+        self.num_tokens = 0
+
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._token_ids = []
+        # tokens are decoded in a window from `_prefix`, whose text up to `_read` is already
+        # out, so a step costs the same however long the output is; the tokens before the
+        # window only give the new ones their context, like leading spaces
+        self._prefix = 0
+        self._read = 0
+        # decoded text not sent yet, held back as a possible stop string
+        self._unsent = ""
+        self._stopped = False
+
+    def _decode(self, final: bool = False) -> str:
+        # text of the tokens after `_read`, empty while it may end in an incomplete
+        # multi-byte character, whose remaining bytes come with later tokens
+        prefix_text = self.tokenizer.decode(self._token_ids[self._prefix:self._read], skip_special_tokens=True)
+        text = self.tokenizer.decode(self._token_ids[self._prefix:], skip_special_tokens=True)
+        new_text = text[len(prefix_text):]
+        if not final and (len(text) <= len(prefix_text) or "\ufffd" in new_text):
+            return ""
+        self._prefix, self._read = self._read, len(self._token_ids)
+        return new_text
+
+    # called from the decode thread
+    def put(self, token_id: int):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.num_tokens += 1
+        self._token_ids.append(token_id)
+        if not self._stopped:
+            self._unsent += self._decode()
+            self._flush(hold_back=True)
+
+    # called from the decode thread
+    def end(self, finish_reason: str):
+        self.finish_reason = finish_reason
+        if not self._stopped:
+            self._unsent += self._decode(final=True)
+            self._flush(hold_back=False)
+        self._emit(_END)
+
+    def _flush(self, hold_back: bool):
+        # sent text never ends in the start of a stop string, so only unsent text can hold one
+        text = self._unsent
+        if self.stop:
+            text = truncate_at_stop(text, 0, self.stop)
+            self._stopped = len(text) < len(self._unsent)
+            if hold_back and not self._stopped:
+                text = text[:len(text) - held_back(text, self.stop)]
+        self._send(text)
+        self._unsent = self._unsent[len(text):]
+
+    def fail(self, error: BaseException):
+        self._emit(error)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _send(self, chunk: str):
+        if chunk:
+            self._emit(chunk)
+
+    def _emit(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # event loop already closed during shutdown
+            pass
+
+    async def get(self):
+        # next text chunk, None once the sequence has finished, or the error that stopped it
+        item = await self._queue.get()
+        return None if item is _END else item
+
+# Stands in for a TokenStreamer when the response goes out in one piece: tokens are not
+# forwarded anywhere, but cancelling it still stops the decode loop at its next step.
+class CancelToken:
+
+    def __init__(self):
+        self.cancelled = False
+
+    def put(self, token_id: int):
+        pass
+
+    def end(self, finish_reason: str):
+        pass
+
+    def cancel(self):
+        self.cancelled = True
+
+def format_event(data: dict, sse: bool, event: str = None) -> str:
+    if sse:
+        prefix = f"event: {event}\n" if event else ""
+        return f"{prefix}data: {json.dumps(data)}\n\n"
+    return json.dumps(data) + "\n"
@@ -0,0 +1,64 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+# LRU cache of prompt token ids, keyed by the prompt text and the length it was truncated
+# to. Short prompts repeat often (canned openers, retries, warm-up), and re-encoding them
+# is a noticeable share of a short request's time.
+class PromptCache:
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get('PROMPT_CACHE_MAX_ENTRIES', 4096))
+
+        self._entries = OrderedDict()
+        # used from the event loop, executor threads and the batcher thread
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        logger.info(f"Prompt cache enabled with {self.max_entries} entries")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, prompt: str, max_length: int):
+        with self._lock:
+            token_ids = self._entries.get((prompt, max_length))
+            if token_ids is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache="prompt", result="miss")
+                return None
+            self._entries.move_to_end((prompt, max_length))
+            self.hits += 1
+        CACHE_LOOKUPS.inc(cache="prompt", result="hit")
+        # a copy, so callers can never change the cached ids
+        return list(token_ids)
+
+    def put(self, prompt: str, max_length: int, token_ids: list[int]):
+        with self._lock:
+            self._entries[(prompt, max_length)] = tuple(token_ids)
+            self._entries.move_to_end((prompt, max_length))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+def encode(tokenizer, prompts, max_length: int, cache: PromptCache = None):
+    # token ids of one prompt, or of each of a list of prompts; prompts missing from the
+    # cache are encoded together in one call, which the fast tokenizer parallelises
+    if cache is None:
+        return tokenizer(prompts, padding=False, truncation=True, max_length=max_length)['input_ids']
+
+    batch = [prompts] if isinstance(prompts, str) else prompts
+    token_ids = [cache.get(prompt, max_length) for prompt in batch]
+
+    misses = list(dict.fromkeys(prompt for prompt, ids in zip(batch, token_ids) if ids is None))
+    if misses:
+        encoded = dict(zip(misses, tokenizer(misses, padding=False, truncation=True, max_length=max_length)['input_ids']))
+        for prompt, ids in encoded.items():
+            cache.put(prompt, max_length, ids)
+        token_ids = [ids if ids is not None else list(encoded[prompt]) for prompt, ids in zip(batch, token_ids)]
+
+    return token_ids[0] if isinstance(prompts, str) else token_ids
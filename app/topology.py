@@ -0,0 +1,134 @@
+import os
+import json
+import logging
+import platform
+import itertools
+import threading
+import torch
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+def cgroup_cpu_limit(root: str = "/sys/fs/cgroup") -> float | None:
+    # CPUs the container's CFS quota allows, None without a limit
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>" without a limit
+        with open(os.path.join(root, "cpu.max")) as cpu_max:
+            quota, period = cpu_max.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1, a quota of -1 without a limit
+        with open(os.path.join(root, "cpu", "cpu.cfs_quota_us")) as quota, \
+                open(os.path.join(root, "cpu", "cpu.cfs_period_us")) as period:
+            quota, period = int(quota.read()), int(period.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+def available_cpus() -> list[int]:
+    # the cores this process may run on, fewer than the host's under a cpuset
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # not on Linux
+        return list(range(os.cpu_count() or 1))
+
+def cpu_budget(cpus: list[int], limit: float | None) -> int:
+    # whole CPUs only, a thread on a fraction of one is throttled for the rest of each period
+    return min(len(cpus), max(1, int(limit))) if limit else len(cpus)
+
+def node_type(budget: int) -> str:
+    # what a calibration holds for: the CPU model and how many of its cores there are to use
+    model = platform.processor() or platform.machine()
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            model = next(line.split(':', 1)[1].strip() for line in cpuinfo if line.startswith('model name'))
+    except (OSError, StopIteration):
+        pass
+    return f"{model} x{budget}"
+
+def calibrated_threads(path: str, node: str) -> int | None:
+    # the best intra-op thread count measured on this node type, see calibrate.py
+    if not path:
+        return None
+    try:
+        with open(path) as calibration:
+            return json.load(calibration).get(node, {}).get("threads")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Thread calibration {path} could not be read. Error: {str(e)}")
+        return None
+
+@dataclass(frozen=True)
+class ThreadSettings:
+    intra_op: int
+    inter_op: int
+    # the cores inference may use, and whether each inference thread is pinned to its share
+    cpus: tuple
+    pinned: bool
+    # what the intra-op thread count was taken from
+    source: str
+
+    def worker_cpus(self, worker: int) -> set[int]:
+        # the cores of the `worker`th inference thread, `intra_op` of them with wrap-around
+        start = worker * self.intra_op % len(self.cpus)
+        return set((self.cpus * 2)[start:start + self.intra_op])
+
+    def pinner(self):
+        # a thread pool initializer pinning each new worker thread to its own cores, the
+        # intra-op threads it starts inherit them; None when pinning is off
+        if not self.pinned:
+            return None
+        workers = itertools.count()
+        lock = threading.Lock()
+        def pin():
+            with lock:
+                worker = next(workers)
+            os.sched_setaffinity(0, self.worker_cpus(worker))
+        return pin
+
+# Torch sizes its thread pools by the host's cores, which inside a container limited to
+# one CPU means dozens of threads contending for it. The intra-op threads are sized to the
+# CPUs the cgroup quota and affinity actually allow, shared between the inference threads,
+# unless a calibration for the node type or TORCH_THREADS says otherwise. With continuous
+# batching a single thread runs every forward pass, whatever INFERENCE_WORKERS says.
+def thread_settings(workers: int = None) -> ThreadSettings:
+    if not workers:
+        continuous = os.environ.get('BATCHING_MODE', 'none') == 'continuous'
+        workers = 1 if continuous else int(os.environ.get('INFERENCE_WORKERS', 1))
+    cpus = available_cpus()
+    limit = cgroup_cpu_limit()
+    budget = cpu_budget(cpus, limit)
+
+    intra_op = max(1, budget // workers)
+    source = f"a CPU quota of {limit:g}" if limit else f"{len(cpus)} available cores"
+    node = node_type(budget)
+    calibrated = calibrated_threads(os.environ.get('THREAD_CALIBRATION_PATH'), node)
+    if calibrated:
+        intra_op, source = calibrated, f"the calibration for {node}"
+    if os.environ.get('TORCH_THREADS'):
+        intra_op, source = int(os.environ['TORCH_THREADS']), "TORCH_THREADS"
+
+    # requests run their forward passes one op at a time, so inter-op threads only sit idle
+    inter_op = int(os.environ.get('TORCH_INTEROP_THREADS', 1))
+    pinned = os.environ.get('CPU_PINNING', 'false').lower() == 'true' and hasattr(os, 'sched_setaffinity')
+    return ThreadSettings(intra_op, inter_op, tuple(cpus[:budget]), pinned, source)
+
+def configure_threads(workers: int = None) -> ThreadSettings:
+    # call before the model runs, torch fixes the inter-op pool on first use
+    settings = thread_settings(workers)
+    torch.set_num_threads(settings.intra_op)
+    try:
+        torch.set_num_interop_threads(settings.inter_op)
+    except RuntimeError:
+        # already started, in a process that loaded a model before
+        pass
+    if settings.pinned:
+        # threads started from here on, the inference threads included, stay on these cores
+        os.sched_setaffinity(0, settings.cpus)
+
+    pinning = f", inference threads pinned to cores {list(settings.cpus)}" if settings.pinned else ""
+    logger.info(f"Torch uses {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} "
+        f"inter-op threads, sized by {settings.source}{pinning}")
+    return settings
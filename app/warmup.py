@@ -0,0 +1,70 @@
+import os
+import time
+import asyncio
+import logging
+from dataclasses import replace
+from generate import generate_text
+
+logger = logging.getLogger(__name__)
+
+_TEXT = "The quick brown fox jumps over the lazy dog while the band plays on. "
+
+def _sizes(name: str, default: str) -> list[int]:
+    return [int(size) for size in os.environ.get(name, default).split(",") if size.strip()]
+
+def synthetic_prompt(tokenizer, length: int) -> str:
+    # a prompt of about `length` tokens, decoded from real text so it tokenizes the same way
+    text = _TEXT * (length // 8 + 1)
+    return tokenizer.decode(tokenizer(text)['input_ids'][:length])
+
+async def _generate(state, prompt: str, params):
+    # the same route a /generate request takes, so batched shapes are warmed up too
+    if state.batcher:
+        return await state.batcher.submit(prompt, params)
+    return await state.executor.submit(generate_text,
+        prompt,
+        state.tokenizer,
+        state.model,
+        state.device,
+        params,
+        prefix_cache=state.prefix_cache,
+        prompt_cache=getattr(state, 'prompt_cache', None),
+        speculative=getattr(state, 'speculative', None))
+
+# Runs synthetic prompts at the batch sizes and prompt lengths the service is expected to
+# serve, so lazy allocations, kernel selection and tokenizer caches are done before the
+# pod reports ready. A failed warm-up is retried with exponential backoff; once the last
+# attempt has failed the pod stays unready and /health fails, so the kubelet restarts it.
+async def warm_up(state):
+    batch_sizes = _sizes('WARMUP_BATCH_SIZES', "1,4")
+    prompt_lengths = _sizes('WARMUP_PROMPT_LENGTHS', "16,128")
+    params = replace(state.config.defaults, max_new_tokens=int(os.environ.get('WARMUP_MAX_NEW_TOKENS', 8)), seed=0)
+    attempts = int(os.environ.get('WARMUP_ATTEMPTS', 3))
+    backoff = float(os.environ.get('WARMUP_RETRY_BACKOFF', 1))
+
+    for attempt in range(1, attempts + 1):
+        start_time = time.perf_counter()
+        try:
+            for length in prompt_lengths:
+                prompt = synthetic_prompt(state.tokenizer, min(length, params.max_length))
+                for batch_size in batch_sizes:
+                    # stay below the admission limit so warm-up never sees a full queue
+                    batch_size = min(batch_size, state.executor.max_queue_depth)
+                    await asyncio.gather(*(_generate(state, prompt, params) for _ in range(batch_size)))
+            logger.info(f"Warm-up finished in {time.perf_counter() - start_time:.2f}s "
+                f"for batch sizes {batch_sizes} and prompt lengths {prompt_lengths}")
+            state.ready = True
+            return
+        except Exception as e:
+            if attempt == attempts:
+                # the liveness probe fails from now on, a restart may get the pod going again
+                logger.error(f"Warm-up failed {attempts} times, the service is unhealthy: {str(e)}")
+                state.warmup_failed = True
+                return
+            delay = backoff * 2 ** (attempt - 1)
+            logger.warning(f"Warm-up attempt {attempt} of {attempts} failed, retrying in {delay:g}s: {str(e)}")
+            await asyncio.sleep(delay)
+        finally:
+            # synthetic prompts are not worth keeping in the prefix cache
+            if state.prefix_cache:
+                state.prefix_cache.clear()
@@ -0,0 +1,101 @@
+import os
+import json
+import mmap
+import struct
+import hashlib
+import warnings
+import torch
+
+MANIFEST_FILE = "model_manifest.json"
+
+_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+def safetensors_files(model_dir: str) -> list[str]:
+    return sorted(f for f in os.listdir(model_dir) if f.endswith(".safetensors"))
+
+def _read_header(path: str) -> tuple[int, dict]:
+    # a safetensors file is an 8 byte little-endian header length, a JSON header and
+    # then the raw tensor bytes at the offsets the header gives
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    return 8 + header_size, header
+
+def build_manifest(model_dir: str, checksums: bool = True) -> dict:
+    # where every tensor lives, so the loader can map the weights without parsing headers
+    files, tensors = {}, {}
+    for name in safetensors_files(model_dir):
+        path = os.path.join(model_dir, name)
+        data_start, header = _read_header(path)
+        files[name] = {"size": os.path.getsize(path)}
+        if checksums:
+            with open(path, "rb") as f:
+                files[name]["sha256"] = hashlib.file_digest(f, "sha256").hexdigest()
+
+        for key, info in header.items():
+            start, end = info["data_offsets"]
+            tensors[key] = {
+                "file": name,
+                "dtype": info["dtype"],
+                "shape": info["shape"],
+                "offset": data_start + start,
+                "nbytes": end - start
+            }
+
+    return {
+        "files": files,
+        "tensors": tensors,
+        "total_bytes": sum(t["nbytes"] for t in tensors.values())
+    }
+
+def write_manifest(model_dir: str) -> dict:
+    manifest = build_manifest(model_dir)
+    with open(os.path.join(model_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def read_manifest(model_dir: str) -> dict:
+    # the saved manifest if it still matches the weight files, otherwise one built from
+    # their headers; checksums are left to the download script, hashing would undo the gain
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if all(os.path.exists(os.path.join(model_dir, name)) and os.path.getsize(os.path.join(model_dir, name)) == info["size"]
+                for name, info in manifest["files"].items()):
+            return manifest
+    return build_manifest(model_dir, checksums=False)
+
+def mmap_state_dict(model_dir: str, manifest: dict) -> dict:
+    # tensors backed directly by a read-only shared mapping of the weight files, so every
+    # process loading the same files shares one page cache copy instead of a private one
+    maps = {}
+    for name in manifest["files"]:
+        with open(os.path.join(model_dir, name), "rb") as f:
+            maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    state_dict = {}
+    with warnings.catch_warnings():
+        # the mapping is read-only on purpose; inference never writes to weights
+        warnings.filterwarnings("ignore", message="The given buffer is not writable")
+        for key, info in manifest["tensors"].items():
+            dtype = _DTYPES[info["dtype"]]
+            count = info["nbytes"] // torch.empty((), dtype=dtype).element_size()
+            if not count:
+                state_dict[key] = torch.empty(info["shape"], dtype=dtype)
+                continue
+            tensor = torch.frombuffer(maps[info["file"]], dtype=dtype, count=count, offset=info["offset"])
+            state_dict[key] = tensor.view(info["shape"])
+    return state_dict
@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import multiprocessing
+import torch
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from transformers import GPT2Config, GPT2LMHeadModel
+
+# benchmarks the service's own generation code, not a copy of it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from config import GenerationParams
+from generate import generate_text, new_sequence, decode_generations
+from tokenization import encode
+from speculative import SpeculativeDecoder
+from decoding import generate_sequences
+from model_loader import CPU_INFERENCE_MODES, quantize_int8, compile_forward, load_tokenizer
+
+# lower is better for latencies, higher for throughput
+LATENCIES = ('ttft_ms', 'inter_token_ms', 'latency_ms')
+
+class NumberTokenizer:
+    # Token ids written out as space separated numbers, so prompts of an exact length can
+    # be built for a random-weight model without downloading a tokenizer
+
+    def __init__(self, vocab_size: int):
+        self.eos_token_id = vocab_size - 1
+
+    def __call__(self, text, return_tensors=None, padding=False, truncation=False, max_length=None):
+        texts = [text] if isinstance(text, str) else text
+        input_ids = [[int(token) for token in t.split()][:max_length if truncation else None] for t in texts]
+        if return_tensors == "pt":
+            input_ids = torch.tensor(input_ids)
+        return {'input_ids': input_ids[0] if isinstance(text, str) and return_tensors is None else input_ids}
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return " ".join(str(token) for token in token_ids if not skip_special_tokens or token != self.eos_token_id)
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return [self.decode(token_ids, skip_special_tokens) for token_ids in sequences]
+
+class TimingStreamer:
+    # records when each token of a sequence comes out of the decode loop
+
+    def __init__(self, start_time: float):
+        self.cancelled = False
+        self.start_time = start_time
+        self.token_times = []
+        self.end_time = None
+
+    def put(self, token_id: int):
+        self.token_times.append(time.perf_counter())
+
+    def end(self, finish_reason: str):
+        self.end_time = time.perf_counter()
+
+def percentiles(values: list) -> dict:
+    # nearest-rank percentiles, in the unit of the values
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+    rank = lambda p: ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))]
+    return {"p50": rank(50), "p95": rank(95), "p99": rank(99)}
+
+def peak_rss_mib() -> float:
+    # peak since process start, reported in KiB on Linux and bytes on macOS; each mode runs
+    # in a process of its own, so this is the peak of that mode alone
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+def tiny_model(args):
+    # random weights with GPT-2's vocabulary and layout, so no download is needed
+    torch.manual_seed(0)
+    config = GPT2Config(n_layer=args.layers, n_head=args.heads, n_embd=args.hidden, n_positions=1024,
+        vocab_size=50257, bos_token_id=50256, eos_token_id=50256)
+    return GPT2LMHeadModel(config).eval(), NumberTokenizer(config.vocab_size)
+
+def load(args, mode: str):
+    # a fresh model per mode, since int8 and compile modify it in place
+    if args.model_dir:
+        from transformers import AutoModelForCausalLM
+        model, tokenizer = AutoModelForCausalLM.from_pretrained(args.model_dir).eval(), load_tokenizer(args.model_dir)
+    else:
+        model, tokenizer = tiny_model(args)
+    model.config.pad_token_id = model.config.eos_token_id
+
+    if mode == 'int8':
+        model = quantize_int8(model)
+    elif mode == 'bf16':
+        model = model.to(dtype=torch.bfloat16)
+    elif mode == 'compile':
+        model = compile_forward(model, tokenizer, "cpu")
+    return model, tokenizer
+
+def load_speculative(args, mode: str):
+    # the draft model in the same mode as the model, drafting for single prompts as in the service
+    if not args.draft_model_dir:
+        return None
+    from transformers import AutoModelForCausalLM
+    draft = AutoModelForCausalLM.from_pretrained(args.draft_model_dir).eval()
+    if mode == 'int8':
+        draft = quantize_int8(draft)
+    elif mode == 'bf16':
+        draft = draft.to(dtype=torch.bfloat16)
+    return SpeculativeDecoder(draft, args.draft_tokens)
+
+def prompt_of(tokenizer, length: int, offset: int) -> str:
+    # `length` tokens, different for every prompt of a batch so none shares a prefix
+    if isinstance(tokenizer, NumberTokenizer):
+        return " ".join(str((offset * 7919 + i * 31) % tokenizer.eos_token_id) for i in range(length))
+    text = "The quick brown fox jumps over the lazy dog while the band plays on. " * (length // 8 + 1)
+    return tokenizer.decode(tokenizer(f"{offset}. {text}")['input_ids'][:length])
+
+def generate(model, tokenizer, prompts: list, params: GenerationParams, speculative=None) -> list:
+    # one prompt goes through generate_text as a request does; several run as one batch
+    # through the same decode loop generate_batch uses, with a streamer per sequence
+    start_time = time.perf_counter()
+    streamers = [TimingStreamer(start_time) for _ in prompts]
+    if len(prompts) == 1:
+        generations = [generate_text(prompts[0], tokenizer, model, "cpu", params, streamers[0], speculative=speculative)]
+    else:
+        input_ids = encode(tokenizer, prompts, params.max_length)
+        sequences = [new_sequence(ids, tokenizer, params, streamer) for ids, streamer in zip(input_ids, streamers)]
+        with torch.no_grad():
+            generate_sequences(model, sequences, "cpu")
+        generations = decode_generations(sequences, tokenizer, [params] * len(sequences))
+    return [(generation, streamer, time.perf_counter() - start_time) for generation, streamer in zip(generations, streamers)]
+
+def run(model, tokenizer, mode: str, batch_size: int, prompt_length: int, max_new_tokens: int, repeats: int, speculative=None) -> dict:
+    # greedy, so every repeat generates the same tokens
+    params = replace(GenerationParams(), max_length=prompt_length, max_new_tokens=max_new_tokens, temperature=0, timeout=None)
+    prompts = [prompt_of(tokenizer, prompt_length, i) for i in range(batch_size)]
+
+    # the first pass pays for lazy allocations and is left out
+    generate(model, tokenizer, prompts, params, speculative)
+    drafted, accepted = (speculative.drafted, speculative.accepted) if speculative else (0, 0)
+
+    ttft, inter_token, latency = [], [], []
+    generated, elapsed = 0, 0.0
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        results = generate(model, tokenizer, prompts, params, speculative)
+        elapsed += time.perf_counter() - start_time
+        for generation, streamer, seconds in results:
+            generated += generation.generated_tokens
+            latency.append(seconds * 1000)
+            if streamer.token_times:
+                ttft.append((streamer.token_times[0] - streamer.start_time) * 1000)
+                inter_token += [(b - a) * 1000 for a, b in zip(streamer.token_times, streamer.token_times[1:])]
+
+    result = {
+        "mode": mode,
+        "batch_size": batch_size,
+        "prompt_length": prompt_length,
+        "max_new_tokens": max_new_tokens,
+        "repeats": repeats,
+        "generated_tokens": generated,
+        "tokens_per_second": round(generated / elapsed, 2),
+        "ttft_ms": {name: round(value, 3) for name, value in percentiles(ttft).items() if value is not None},
+        "inter_token_ms": {name: round(value, 3) for name, value in percentiles(inter_token).items() if value is not None},
+        "latency_ms": {name: round(value, 3) for name, value in percentiles(latency).items() if value is not None},
+        "peak_rss_mib": peak_rss_mib()
+    }
+    if speculative and speculative.drafted > drafted:
+        result["acceptance_rate"] = round((speculative.accepted - accepted) / (speculative.drafted - drafted), 3)
+    return result
+
+def run_mode(args, mode: str) -> list[dict]:
+    # every run of one mode, in a child process so no mode's memory shows in another's peak RSS
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    try:
+        model, tokenizer = load(args, mode)
+        speculative = load_speculative(args, mode)
+    except Exception as e:
+        print(f"skipping {mode} mode: {e}")
+        return []
+
+    runs = []
+    for batch_size, prompt_length, max_new_tokens in product(args.batch_sizes, args.prompt_lengths, args.max_new_tokens):
+        result = run(model, tokenizer, mode, batch_size, prompt_length, max_new_tokens, args.repeats, speculative)
+        runs.append(result)
+        print(f"mode={mode} batch_size={batch_size} prompt_length={prompt_length} max_new_tokens={max_new_tokens}: "
+            f"{result['tokens_per_second']} tokens/s, ttft p50 {result['ttft_ms'].get('p50')}ms, "
+            f"inter-token p50 {result['inter_token_ms'].get('p50')}ms, peak rss {result['peak_rss_mib']}MiB", flush=True)
+    return runs
+
+def run_key(run: dict) -> tuple:
+    return run["mode"], run["batch_size"], run["prompt_length"], run["max_new_tokens"]
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    # runs slower than the baseline by more than `tolerance`, as a fraction
+    regressions = []
+    previous = {run_key(run): run for run in baseline["runs"]}
+    for run in results["runs"]:
+        before = previous.get(run_key(run))
+        if before is None:
+            continue
+        name = "mode={} batch_size={} prompt_length={} max_new_tokens={}".format(*run_key(run))
+        if run["tokens_per_second"] < before["tokens_per_second"] * (1 - tolerance):
+            regressions.append(f"{name}: tokens_per_second {before['tokens_per_second']} -> {run['tokens_per_second']}")
+        for metric in LATENCIES:
+            for p in ("p50", "p95"):
+                old, new = before[metric].get(p), run[metric].get(p)
+                if old and new and new > old * (1 + tolerance):
+                    regressions.append(f"{name}: {metric} {p} {old} -> {new}")
+    return regressions
+
+def sizes(value: str) -> list[int]:
+    return [int(size) for size in value.split(",") if size.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark generation offline, sweeping batch size, prompt length, max_new_tokens and CPU inference mode")
+    parser.add_argument("--model-dir", type=str, default=None, help="Model to benchmark (default: a random-weight GPT-2, nothing is downloaded)")
+    parser.add_argument("--layers", type=int, default=2, help="Layers of the random-weight model (default: 2)")
+    parser.add_argument("--heads", type=int, default=4, help="Attention heads of the random-weight model (default: 4)")
+    parser.add_argument("--hidden", type=int, default=128, help="Hidden size of the random-weight model (default: 128)")
+    parser.add_argument("--batch-sizes", type=sizes, default="1,4", help="Prompts generated together (default: 1,4)")
+    parser.add_argument("--prompt-lengths", type=sizes, default="16,128", help="Prompt lengths in tokens (default: 16,128)")
+    parser.add_argument("--max-new-tokens", type=sizes, default="16,64", help="Tokens generated per prompt (default: 16,64)")
+    parser.add_argument("--modes", type=str, default="fp32,int8", help=f"CPU inference modes out of {', '.join(CPU_INFERENCE_MODES)} (default: fp32,int8)")
+    parser.add_argument("--draft-model-dir", type=str, default=None, help="Draft model for speculative decoding of single prompts, sharing the tokenizer of --model-dir")
+    parser.add_argument("--draft-tokens", type=int, default=4, help="Tokens drafted per speculative decoding step (default: 4)")
+    parser.add_argument("--repeats", type=int, default=3, help="Measured passes per run, after one warm-up pass (default: 3)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads (default: torch's own)")
+    parser.add_argument("--output", type=str, default="benchmark.json", help="Where to write the results (default: benchmark.json)")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier results to compare against; exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown against the baseline as a fraction (default: 0.1)")
+    args = parser.parse_args()
+
+    modes = [mode for mode in args.modes.split(",") if mode.strip()]
+    unknown = set(modes) - set(CPU_INFERENCE_MODES)
+    if unknown:
+        parser.error(f"unknown modes {', '.join(sorted(unknown))}")
+    if args.draft_model_dir and not args.model_dir:
+        parser.error("--draft-model-dir needs --model-dir")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "threads": torch.get_num_threads(),
+            "model": args.model_dir or f"random gpt2 layers={args.layers} heads={args.heads} hidden={args.hidden}",
+            "draft_model": args.draft_model_dir,
+            "draft_tokens": args.draft_tokens if args.draft_model_dir else None
+        },
+        "runs": []
+    }
+
+    for mode in modes:
+        # a fresh process per mode, started clean rather than forked from one holding torch state
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results["runs"] += pool.submit(run_mode, args, mode).result()
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"results for {len(results['runs'])} runs written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"regression {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline} beyond {args.tolerance:.0%}")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,7 +1,12 @@
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import os
+import sys
 import argparse
 
+# the manifest format is shared with the service's loader
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from weights import write_manifest
+
 def main():
     parser = argparse.ArgumentParser(description="Download and save a transformer model and tokenizer from https://huggingface.co/")
     parser.add_argument(
@@ -26,11 +31,15 @@ def main():
     save_directory = f"./models/{model_dir_name}"
     os.makedirs(save_directory, exist_ok=True)
 
-    # save the model and tokenizer to disk
+    # save the model and tokenizer to disk, weights as safetensors which the service maps
     model.save_pretrained(save_directory)
     tokenizer.save_pretrained(save_directory)
 
+    # where each tensor lives in the weight files, with checksums of the files
+    manifest = write_manifest(save_directory)
+
     print(f"model and tokenizer saved to {save_directory}")
+    print(f"manifest written for {len(manifest['tensors'])} tensors, {manifest['total_bytes'] / 2**20:.1f}MiB of weights")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
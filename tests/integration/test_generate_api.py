@@ -1,3 +1,5 @@
+import json
+import time
 from fastapi.testclient import TestClient
 from main import app
 
@@ -25,6 +27,36 @@ def test_generate_api_no_prompt():
         assert response.status_code == 400
         assert response.json() == {"detail": "No prompt provided in payload"}
         
+def test_generate_batch_api():
+    with TestClient(app) as client:
+        payload = {
+            "prompts": ["Once upon a time ", "", "The weather today is"],
+            "max_new_tokens": 5
+        }
+        response = client.post("/generate/batch", json=payload)
+        assert response.status_code == 200
+        
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        results = {line['index']: line for line in lines[:-1]}
+        
+        # every prompt is answered by index, the empty one with an error
+        assert set(results) == {0, 1, 2}
+        assert results[1]['error'] == "No prompt provided in payload"
+        assert results[0]['generated_text'].startswith("Once upon a time")
+        assert lines[-1]['completed'] == 2
+        assert lines[-1]['failed'] == 1
+
+def test_metrics_api():
+    with TestClient(app) as client:
+        client.post("/generate", json={"prompt": "Once upon a time "})
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        
+        # every stage of the request was timed
+        for name in ("llm_tokenization_seconds", "llm_prefill_seconds", "llm_decode_token_seconds", "llm_detokenization_seconds"):
+            assert f"{name}_count " in response.text
+        assert 'llm_request_duration_seconds_count{endpoint="/generate"}' in response.text
+
 def test_docs_handler():
     with TestClient(app) as client:
         response = client.get("/docs")
@@ -40,4 +72,13 @@ def test_health_check_healthy():
     with TestClient(app) as client:
         response = client.get("/health")
         assert response.status_code == 200
-        assert response.json() == {"status": "healthy"}
\ No newline at end of file
+        assert response.json() == {"status": "healthy"}
+
+def test_ready_after_warm_up():
+    with TestClient(app) as client:
+        for _ in range(600):
+            response = client.get("/ready")
+            if response.status_code == 200:
+                break
+            time.sleep(0.1)
+        assert response.json() == {"status": "ready"}
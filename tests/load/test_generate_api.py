@@ -1,4 +1,5 @@
-from locust import HttpUser, task, between
+from locust import HttpUser, LoadTestShape, task, between
+import os
 import time
 import random
 
@@ -58,4 +59,22 @@ class GenerateApiLoadTest(HttpUser):
                 response_time = response_time,
                 exception = e
             )
-            print(f"Error for input: {case['prompt']}. Time: {response_time:.2f}ms. Error: {str(e)}")
\ No newline at end of file
+            print(f"Error for input: {case['prompt']}. Time: {response_time:.2f}ms. Error: {str(e)}")
+
+if os.environ.get('LOAD_SHAPE') == 'step':
+    # The same stepped load on every run, so autoscaling policies can be compared by how
+    # soon replicas are added after each step and how many requests fail meanwhile
+    class StepLoadShape(LoadTestShape):
+        step_users = int(os.environ.get('STEP_USERS', 20))
+        step_seconds = int(os.environ.get('STEP_SECONDS', 60))
+        max_users = int(os.environ.get('MAX_USERS', 100))
+
+        def tick(self):
+            run_time = self.get_run_time()
+            users = self.step_users * (int(run_time // self.step_seconds) + 1)
+            if users > self.max_users:
+                # hold the peak for one more step, then stop
+                if run_time > self.step_seconds * (self.max_users // self.step_users + 1):
+                    return None
+                users = self.max_users
+            return users, self.step_users
\ No newline at end of file
@@ -0,0 +1,195 @@
+import asyncio
+import threading
+import pytest
+from unittest.mock import MagicMock, patch
+from batching import BatchScheduler, ContinuousBatcher
+from transformers import GPT2Config, GPT2LMHeadModel
+import torch
+from executor import InferenceExecutor, QueueFullError
+from config import GenerationParams
+from scheduling import Schedule, DeadlineExceededError
+import scheduling
+
+@pytest.fixture
+def executor():
+    executor = InferenceExecutor(max_workers=1, max_queue_depth=4, retry_after=1)
+    yield executor
+    executor.shutdown()
+
+@pytest.fixture
+def tokenizer():
+    # one token per character keeps token budgets easy to reason about
+    tokenizer = MagicMock(side_effect=lambda prompt, **kwargs: {'input_ids': list(prompt)})
+    return tokenizer
+
+def echo_batch(prompts, tokenizer, model, device, params=None, prefix_cache=None, prompt_cache=None, input_ids=None, deadlines=None):
+    return [f"{prompt} generated" for prompt in prompts]
+
+@pytest.mark.asyncio
+async def test_concurrent_prompts_share_one_batch(executor, tokenizer):
+    mock_generate_batch = MagicMock(side_effect=echo_batch)
+    scheduler = BatchScheduler(executor, tokenizer, "model", "cpu", max_batch_size=4, max_wait_ms=50, max_batch_tokens=100)
+    
+    with patch('batching.generate_batch', new=mock_generate_batch):
+        scheduler.start()
+        results = await asyncio.gather(*(scheduler.submit(p) for p in ["a", "bb", "ccc"]))
+        await scheduler.stop()
+    
+    # each caller gets its own output back, from a single batched call on the ids encoded at submit
+    assert results == ["a generated", "bb generated", "ccc generated"]
+    mock_generate_batch.assert_called_once_with(["a", "bb", "ccc"], tokenizer, "model", "cpu", [GenerationParams()] * 3, None,
+        input_ids=[["a"], ["b", "b"], ["c", "c", "c"]], deadlines=[None] * 3)
+    assert tokenizer.call_count == 3
+    assert scheduler.pending == 0
+
+@pytest.mark.asyncio
+async def test_batch_respects_max_batch_size(executor, tokenizer):
+    mock_generate_batch = MagicMock(side_effect=echo_batch)
+    scheduler = BatchScheduler(executor, tokenizer, "model", "cpu", max_batch_size=2, max_wait_ms=50, max_batch_tokens=100)
+    
+    with patch('batching.generate_batch', new=mock_generate_batch):
+        scheduler.start()
+        results = await asyncio.gather(*(scheduler.submit(p) for p in ["a", "b", "c"]))
+        await scheduler.stop()
+    
+    assert results == ["a generated", "b generated", "c generated"]
+    assert [call.args[0] for call in mock_generate_batch.call_args_list] == [["a", "b"], ["c"]]
+
+@pytest.mark.asyncio
+async def test_batch_respects_max_batch_tokens(executor, tokenizer):
+    mock_generate_batch = MagicMock(side_effect=echo_batch)
+    scheduler = BatchScheduler(executor, tokenizer, "model", "cpu", max_batch_size=8, max_wait_ms=50, max_batch_tokens=10)
+    
+    with patch('batching.generate_batch', new=mock_generate_batch):
+        scheduler.start()
+        # two padded 4-token prompts fit, a third would need 12 tokens
+        results = await asyncio.gather(*(scheduler.submit(p) for p in ["aaaa", "bbbb", "cccc"]))
+        await scheduler.stop()
+    
+    assert results == ["aaaa generated", "bbbb generated", "cccc generated"]
+    assert [call.args[0] for call in mock_generate_batch.call_args_list] == [["aaaa", "bbbb"], ["cccc"]]
+
+@pytest.mark.asyncio
+async def test_batch_failure_is_reported_to_every_request(executor, tokenizer):
+    mock_generate_batch = MagicMock(side_effect=RuntimeError("Model generation error"))
+    scheduler = BatchScheduler(executor, tokenizer, "model", "cpu", max_batch_size=4, max_wait_ms=50, max_batch_tokens=100)
+    
+    with patch('batching.generate_batch', new=mock_generate_batch):
+        scheduler.start()
+        results = await asyncio.gather(*(scheduler.submit(p) for p in ["a", "b"]), return_exceptions=True)
+        await scheduler.stop()
+    
+    assert all(isinstance(r, RuntimeError) for r in results)
+    mock_generate_batch.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_submit_rejects_when_queue_full(executor, tokenizer):
+    scheduler = BatchScheduler(executor, tokenizer, "model", "cpu")
+    scheduler._pending = executor.max_queue_depth
+    
+    with pytest.raises(QueueFullError):
+        await scheduler.submit("a")
+
+@pytest.fixture(scope="module")
+def tiny_model():
+    torch.manual_seed(0)
+    config = GPT2Config(n_layer=2, n_head=2, n_embd=32, n_positions=128, vocab_size=64, bos_token_id=63, eos_token_id=63)
+    return GPT2LMHeadModel(config).eval()
+
+@pytest.fixture
+def id_tokenizer():
+    # prompts are comma separated token ids, outputs are decoded back the same way
+    tokenizer = MagicMock(side_effect=lambda prompt, **kwargs: {'input_ids': [int(t) for t in prompt.split(",")]})
+    tokenizer.eos_token_id = 63
+    tokenizer.decode.side_effect = lambda ids, **kwargs: ",".join(str(i) for i in ids)
+    tokenizer.batch_decode.side_effect = lambda sequences, **kwargs: [",".join(str(i) for i in ids) for ids in sequences]
+    return tokenizer
+
+@pytest.mark.asyncio
+async def test_continuous_batcher_returns_each_generation(executor, id_tokenizer, tiny_model):
+    batcher = ContinuousBatcher(executor, id_tokenizer, tiny_model, "cpu", max_batch_size=2, max_batch_tokens=100)
+    
+    params = GenerationParams(max_new_tokens=4)
+    batcher.start()
+    results = await asyncio.gather(*(batcher.submit(p, params) for p in ["1,2,3", "4", "5,6"]))
+    await batcher.stop()
+    
+    # every prompt gets its own continuation, even the one that waited for a free slot
+    for prompt, result in zip(["1,2,3", "4", "5,6"], results):
+        assert result.text.startswith(prompt + ",")
+        assert len(result.text.split(",")) <= len(prompt.split(",")) + 4
+        assert 1 <= result.generated_tokens <= 4
+    assert batcher.pending == 0
+
+@pytest.mark.asyncio
+async def test_continuous_batcher_pins_its_decode_thread(executor, id_tokenizer, tiny_model):
+    threads = []
+    pin = MagicMock(side_effect=lambda: threads.append(threading.current_thread().name))
+    batcher = ContinuousBatcher(executor, id_tokenizer, tiny_model, "cpu", initializer=pin)
+    
+    batcher.start()
+    await batcher.submit("1,2", GenerationParams(max_new_tokens=2))
+    await batcher.stop()
+    
+    # once, in the thread that runs every forward pass
+    assert threads == ["continuous-batcher"]
+
+@pytest.mark.asyncio
+async def test_continuous_batcher_drops_cancelled_requests(executor, id_tokenizer, tiny_model):
+    batcher = ContinuousBatcher(executor, id_tokenizer, tiny_model, "cpu", max_batch_size=2, max_batch_tokens=100)
+    
+    params = GenerationParams(max_new_tokens=100)
+    batcher.start()
+    abandoned = asyncio.ensure_future(batcher.submit("1,2", params))
+    await asyncio.sleep(0)
+    abandoned.cancel()
+    result = await batcher.submit("3", params)
+    await batcher.stop()
+    
+    assert abandoned.cancelled()
+    assert result.text.startswith("3,")
+    # the abandoned sequence was never decoded back to text
+    assert all(not ids[:2] == [1, 2] for call in id_tokenizer.batch_decode.call_args_list for ids in call.args[0])
+
+
+@pytest.mark.asyncio
+async def test_sequences_finishing_together_are_decoded_in_one_call(executor, id_tokenizer, tiny_model):
+    batcher = ContinuousBatcher(executor, id_tokenizer, tiny_model, "cpu", max_batch_size=2, max_batch_tokens=100)
+    # outside the vocabulary, so both sequences run their full 3 tokens
+    id_tokenizer.eos_token_id = 64
+    
+    # queued before the batcher starts, so both join the batch on the same step
+    pending = [asyncio.ensure_future(batcher.submit(p, GenerationParams(max_new_tokens=3))) for p in ["1,2", "3,4"]]
+    await asyncio.sleep(0)
+    batcher.start()
+    results = await asyncio.gather(*pending)
+    await batcher.stop()
+    
+    assert [result.finish_reason for result in results] == ["length", "length"]
+    id_tokenizer.batch_decode.assert_called_once()
+    assert len(id_tokenizer.batch_decode.call_args.args[0]) == 2
+
+async def submit_as(batcher, schedule, prompt, params):
+    scheduling.current.set(schedule)
+    return await batcher.submit(prompt, params)
+
+@pytest.mark.asyncio
+async def test_continuous_batcher_admits_by_priority_and_sheds_expired(executor, id_tokenizer, tiny_model):
+    batcher = ContinuousBatcher(executor, id_tokenizer, tiny_model, "cpu", max_batch_size=1, max_batch_tokens=100)
+    params = GenerationParams(max_new_tokens=2)
+    
+    # queued before the batcher starts, the interactive prompt overtakes the bulk one
+    bulk = asyncio.ensure_future(submit_as(batcher, Schedule("bulk"), "1,2", params))
+    expired = asyncio.ensure_future(submit_as(batcher, Schedule.within("interactive", 0.01), "3,4", params))
+    interactive = asyncio.ensure_future(submit_as(batcher, Schedule("interactive"), "5,6", params))
+    await asyncio.sleep(0.05)
+    batcher.start()
+    
+    with pytest.raises(DeadlineExceededError):
+        await expired
+    first_done, _ = await asyncio.wait({bulk, interactive}, return_when=asyncio.FIRST_COMPLETED)
+    await asyncio.gather(bulk, interactive)
+    await batcher.stop()
+    
+    assert first_done == {interactive}
+    assert batcher.pending == 0
@@ -0,0 +1,133 @@
+import unittest
+from unittest.mock import patch
+from decoding import Sequence, DecodeBatch, generate_sequences, prefill, sampling_processor
+from prefix_cache import PrefixCache
+from stopping import StopTokenCriterion, DeadlineCriterion
+from transformers import GPT2Config, GPT2LMHeadModel
+import torch
+
+EOS = 63
+
+class TestDecoding(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        config = GPT2Config(n_layer=2, n_head=2, n_embd=32, n_positions=128, vocab_size=64, bos_token_id=EOS, eos_token_id=EOS)
+        cls.model = GPT2LMHeadModel(config).eval()
+
+    def greedy(self, prompt_ids, max_new_tokens):
+        # top_k=1 makes sampling deterministic so the loop can be compared with `model.generate`
+        return Sequence(prompt_ids, max_new_tokens, EOS, sampling_processor(1.0, 1, 1.0, 1.0))
+
+    def reference(self, prompt_ids, max_new_tokens):
+        with torch.no_grad():
+            outputs = self.model.generate(torch.tensor([prompt_ids]), do_sample=False,
+                max_new_tokens=max_new_tokens, pad_token_id=EOS)
+        return outputs[0].tolist()
+
+    def test_single_sequence_matches_generate(self):
+        sequence = self.greedy([1, 2, 3, 4], 8)
+        
+        with torch.no_grad():
+            generate_sequences(self.model, [sequence], "cpu")
+        
+        self.assertEqual(sequence.token_ids, self.reference([1, 2, 3, 4], 8))
+        self.assertEqual(sequence.finish_reason, "length")
+        self.assertIsNone(sequence.past)
+
+    def test_batched_sequences_match_unbatched_and_exit_early(self):
+        prompts = [[1, 2, 3, 4, 5, 6], [7], [8, 9, 10]]
+        limits = [2, 8, 5]
+        sequences = [self.greedy(p, n) for p, n in zip(prompts, limits)]
+        
+        with torch.no_grad():
+            generate_sequences(self.model, sequences, "cpu")
+        
+        for sequence, prompt_ids, limit in zip(sequences, prompts, limits):
+            self.assertEqual(len(sequence.generated_ids), limit)
+            self.assertEqual(sequence.token_ids, self.reference(prompt_ids, limit))
+
+    def test_sequences_joining_and_leaving_a_running_batch_match_unbatched(self):
+        prompts = [[1, 2, 3, 4, 5, 6], [7], [8, 9, 10]]
+        limits = [100, 2, 5]
+        first, second, third = [self.greedy(p, n) for p, n in zip(prompts, limits)]
+        batch = DecodeBatch()
+        
+        with torch.no_grad():
+            prefill(self.model, [first, second], "cpu")
+            batch.join([first, second])
+            keys = batch._cache.layers[0]._keys
+            batch.step(self.model, "cpu")
+            # a step writes into the batch cache's free columns, it copies nothing
+            self.assertIs(batch._cache.layers[0]._keys, keys)
+            
+            prefill(self.model, [third], "cpu")
+            batch.join([third])
+            while len(batch):
+                batch.leave([s for s in batch.sequences if s.finished])
+                if len(batch):
+                    batch.step(self.model, "cpu")
+        
+        # the first sequence outgrew the batch cache's free columns on the way
+        for sequence, prompt_ids, limit in zip((first, second, third), prompts, limits):
+            self.assertEqual(sequence.token_ids, self.reference(prompt_ids, limit))
+
+    def test_cached_prefix_gives_same_output(self):
+        cache = PrefixCache(max_bytes=10**7)
+        prompts = [[1, 2, 3, 4, 5], [1, 2, 3, 4, 6, 7], [1, 2, 3, 4, 5]]
+        
+        for prompt_ids in prompts:
+            sequence = self.greedy(prompt_ids, 6)
+            with torch.no_grad():
+                generate_sequences(self.model, [sequence], "cpu", cache)
+            self.assertEqual(sequence.token_ids, self.reference(prompt_ids, 6))
+        
+        # the second and third prompts reuse the cached [1, 2, 3, 4] prefix
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(cache.hit_tokens, 8)
+
+    def test_sequence_stops_at_eos(self):
+        sequence = self.greedy([1, 2], 10)
+        
+        sequence.append(5)
+        self.assertFalse(sequence.finished)
+        sequence.append(EOS)
+        self.assertEqual(sequence.finish_reason, "eos")
+
+    def test_stop_token_ends_sequence_early(self):
+        expected = self.reference([1, 2, 3, 4], 8)[4:]
+        stop_token = expected[3]
+        sequence = Sequence([1, 2, 3, 4], 8, EOS, sampling_processor(1.0, 1, 1.0, 1.0),
+            stopping_criteria=[StopTokenCriterion([stop_token])])
+        
+        with torch.no_grad():
+            generate_sequences(self.model, [sequence], "cpu")
+        
+        # decoding stops on the first occurrence, which is left out of the output
+        first = expected.index(stop_token)
+        self.assertEqual(sequence.generated_ids, expected[:first + 1])
+        self.assertEqual(sequence.output_ids, expected[:first])
+        self.assertEqual(sequence.finish_reason, "stop_token")
+
+    def test_expired_deadline_stops_after_one_token(self):
+        sequence = Sequence([1, 2, 3], 8, EOS, sampling_processor(1.0, 1, 1.0, 1.0),
+            stopping_criteria=[DeadlineCriterion(0)])
+        
+        with torch.no_grad():
+            generate_sequences(self.model, [sequence], "cpu")
+        
+        self.assertEqual(len(sequence.generated_ids), 1)
+        self.assertEqual(sequence.finish_reason, "timeout")
+
+    def test_empty_prompt_is_finished_without_decoding(self):
+        sequence = self.greedy([], 10)
+        
+        with patch.object(self.model, 'forward') as mock_forward:
+            generate_sequences(self.model, [sequence], "cpu")
+        
+        self.assertEqual(sequence.finish_reason, "length")
+        mock_forward.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
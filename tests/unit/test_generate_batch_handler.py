@@ -0,0 +1,151 @@
+import json
+import pytest
+from dataclasses import replace
+from fastapi.testclient import TestClient
+from unittest.mock import patch, MagicMock
+from main import app
+from executor import InferenceExecutor, QueueFullError
+from generate import Generation
+
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def mock_model_and_tokenizer():
+    mock_model = MagicMock()
+    # one token per character keeps prompt lengths easy to reason about
+    mock_tokenizer = MagicMock(side_effect=lambda prompts, **kwargs: {'input_ids': [list(p) for p in prompts]})
+    mock_device = MagicMock()
+    
+    app.state.model = mock_model
+    app.state.tokenizer = mock_tokenizer
+    app.state.device = mock_device
+    app.state.executor = InferenceExecutor(max_workers=1, max_queue_depth=4, retry_after=2)
+    
+    yield mock_model, mock_tokenizer, mock_device
+    
+    app.state.executor.shutdown()
+    del app.state.model, app.state.tokenizer, app.state.device, app.state.executor
+
+def echo_batch(prompts, tokenizer, model, device, params=None, prefix_cache=None, prompt_cache=None, input_ids=None, deadlines=None):
+    return [Generation(f"{prompt} generated", "length", 2) for prompt in prompts]
+
+def read_lines(response) -> list[dict]:
+    return [json.loads(line) for line in response.text.splitlines()]
+
+@pytest.mark.asyncio
+async def test_batch_runs_prompts_shortest_first_in_padded_batches(mock_model_and_tokenizer):
+    _, mock_tokenizer, _ = mock_model_and_tokenizer
+    mock_generate_batch = MagicMock(side_effect=echo_batch)
+    
+    with patch('bulk.generate_batch', new=mock_generate_batch), patch.dict('os.environ', {'BATCH_MAX_SIZE': '2'}):
+        response = client.post("/generate/batch", json={"prompts": ["ccc", "a", "dddd", "bb"], "max_new_tokens": 2})
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = read_lines(response)
+    
+    # each result carries its input index, and the prompts were batched by length
+    assert {line["index"]: line["generated_text"] for line in lines[:-1]} == {
+        0: "ccc generated", 1: "a generated", 2: "dddd generated", 3: "bb generated"}
+    assert [call.args[0] for call in mock_generate_batch.call_args_list] == [["a", "bb"], ["ccc", "dddd"]]
+    # the prompts were tokenized once, to sort them, and generated from those ids
+    assert mock_tokenizer.call_count == 1
+    assert mock_generate_batch.call_args.kwargs["input_ids"] == [list("ccc"), list("dddd")]
+    params = replace(app.state.config.defaults, max_new_tokens=2)
+    assert mock_generate_batch.call_args.args[4] == [params, params]
+    assert lines[-1]["completed"] == 4
+    assert lines[-1]["failed"] == 0
+
+@pytest.mark.asyncio
+async def test_ndjson_upload_reports_bad_lines_per_item():
+    body = "\n".join([
+        json.dumps({"prompt": "a"}),
+        json.dumps({"prompt": "b", "temperature": 5}),
+        "not json",
+        json.dumps({"max_new_tokens": 3}),
+        json.dumps({"prompt": "e", "seed": 1})
+    ])
+    
+    with patch('bulk.generate_batch', side_effect=echo_batch):
+        response = client.post("/generate/batch", content=body, headers={"Content-Type": "application/x-ndjson"})
+    
+    assert response.status_code == 200
+    lines = {line["index"]: line for line in read_lines(response)[:-1]}
+    assert lines[0]["generated_text"] == "a generated"
+    assert lines[1]["error"].startswith("Invalid request: temperature")
+    assert lines[2]["error"].startswith("Invalid request")
+    assert lines[3]["error"] == "No prompt provided in payload"
+    assert lines[4]["generated_text"] == "e generated"
+    assert read_lines(response)[-1]["failed"] == 3
+
+@pytest.mark.asyncio
+async def test_failing_prompt_does_not_fail_its_batch():
+    def failing_batch(prompts, *args, **kwargs):
+        if "bad" in prompts:
+            raise RuntimeError("boom")
+        return echo_batch(prompts, *args, **kwargs)
+    
+    with patch('bulk.generate_batch', side_effect=failing_batch):
+        response = client.post("/generate/batch", json={"prompts": ["good", "bad", "fine"]})
+    
+    lines = {line["index"]: line for line in read_lines(response)[:-1]}
+    assert lines[0]["generated_text"] == "good generated"
+    assert lines[1] == {"index": 1, "error": "Model generation failed: boom"}
+    assert lines[2]["generated_text"] == "fine generated"
+
+@pytest.mark.asyncio
+async def test_batch_waits_when_the_queue_is_full():
+    mock_generate_batch = MagicMock(side_effect=echo_batch)
+    executor = app.state.executor
+    submit = executor.submit
+    attempts = []
+    
+    async def full_once(*args, **kwargs):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise QueueFullError(4, 0)
+        return await submit(*args, **kwargs)
+    
+    with patch('bulk.generate_batch', new=mock_generate_batch), patch.object(executor, 'submit', side_effect=full_once):
+        response = client.post("/generate/batch", json={"prompts": ["a"]})
+    
+    assert read_lines(response)[0]["generated_text"] == "a generated"
+    assert len(attempts) == 2
+
+@pytest.mark.asyncio
+async def test_batch_uses_the_batcher_when_there_is_one():
+    batcher = MagicMock()
+    async def submit(prompt, params, prompt_ids):
+        return Generation(f"{prompt} batched", "eos", 1)
+    batcher.submit.side_effect = submit
+    app.state.batcher = batcher
+    
+    try:
+        response = client.post("/generate/batch", json={"prompts": ["bb", "a"]})
+    finally:
+        del app.state.batcher
+    
+    assert [call.args[0] for call in batcher.submit.call_args_list] == ["a", "bb"]
+    assert [call.kwargs["prompt_ids"] for call in batcher.submit.call_args_list] == [["a"], ["b", "b"]]
+    assert {line["index"] for line in read_lines(response)[:-1]} == {0, 1}
+
+@pytest.mark.asyncio
+async def test_batch_rejects_invalid_payloads():
+    assert client.post("/generate/batch", json={"prompts": []}).status_code == 422
+    assert client.post("/generate/batch", json={"prompts": ["a"], "top_p": 0}).status_code == 422
+    
+    response = client.post("/generate/batch", content="", headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "No prompts provided in payload"}
+
+@pytest.mark.asyncio
+async def test_batch_rejects_too_many_prompts():
+    config = app.state.config
+    app.state.config = replace(config, bulk_max_prompts=2)
+    try:
+        response = client.post("/generate/batch", json={"prompts": ["a", "b", "c"]})
+    finally:
+        app.state.config = config
+    
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Too many prompts: 3 given, at most 2 allowed"}
@@ -1,7 +1,16 @@
+import asyncio
 import pytest
+from dataclasses import replace
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 from main import app
+from executor import InferenceExecutor, QueueFullError
+from response_cache import ResponseCache
+from config import GenerationParams, ServiceConfig
+from generate import Generation
+from scheduling import DeadlineExceededError
+from api import _unless_disconnected
+import scheduling
 
 client = TestClient(app)
     
@@ -15,16 +24,18 @@ def mock_model_and_tokenizer():
     app.state.model = mock_model
     app.state.tokenizer = mock_tokenizer
     app.state.device = mock_device
+    app.state.executor = InferenceExecutor(max_workers=1, max_queue_depth=4, retry_after=2)
     
     yield mock_model, mock_tokenizer, mock_device
     
     # Clean up after the test
-    del app.state.model, app.state.tokenizer, app.state.device
+    app.state.executor.shutdown()
+    del app.state.model, app.state.tokenizer, app.state.device, app.state.executor
     
 @pytest.mark.asyncio
 async def test_generate_handler_valid_payload(mock_model_and_tokenizer):
     expected_response = "generated text"
-    mock_generate_text = MagicMock(return_value = expected_response)
+    mock_generate_text = MagicMock(return_value = Generation(expected_response, "eos", 3))
     mock_model, mock_tokenizer, mock_device = mock_model_and_tokenizer
     
     with patch('api.logger') as mock_logger:
@@ -36,16 +47,17 @@ async def test_generate_handler_valid_payload(mock_model_and_tokenizer):
             # verify response content
             result = response.json()
             assert result['generated_text'] == expected_response
+            assert result['finish_reason'] == "eos"
+            assert result['generated_tokens'] == 3
             assert 'response_time' in result
             assert isinstance(result['response_time'], float)
             
             # verify logger calls
-            mock_logger.info.assert_any_call(f"Received payload: {payload}")
-            mock_logger.info.assert_any_call(f"Prompt extracted: {payload['prompt']}")
-            mock_logger.info.assert_any_call(f"Response: {result['generated_text']}")
+            mock_logger.info.assert_any_call("Received payload: %s", str(payload))
+            mock_logger.info.assert_any_call("Response: %s", result['generated_text'])
             
             # verify `generate_text` was called with correct arguments
-            mock_generate_text.assert_called_once_with("test prompt", mock_tokenizer, mock_model, mock_device)
+            mock_generate_text.assert_called_once_with("test prompt", mock_tokenizer, mock_model, mock_device, app.state.config.defaults, ANY, prefix_cache=None, prompt_cache=None, speculative=None)
         
 @pytest.mark.asyncio
 async def test_generate_handler_no_prompt():
@@ -81,7 +93,7 @@ async def test_generate_handler_value_error(mock_model_and_tokenizer):
             mock_logger.error.assert_called_once_with(expected_error_response)
 
             # verify `generate_text` was called with correct arguments
-            mock_generate_text.assert_called_once_with("test prompt", mock_tokenizer, mock_model, mock_device)
+            mock_generate_text.assert_called_once_with("test prompt", mock_tokenizer, mock_model, mock_device, app.state.config.defaults, ANY, prefix_cache=None, prompt_cache=None, speculative=None)
             
 @pytest.mark.asyncio
 async def test_generate_handler_runtime_error(mock_model_and_tokenizer):
@@ -103,7 +115,7 @@ async def test_generate_handler_runtime_error(mock_model_and_tokenizer):
             mock_logger.error.assert_called_once_with(expected_error_response)
             
             # verify `generate_text` was called with correct arguments
-            mock_generate_text.assert_called_once_with("test prompt", mock_tokenizer, mock_model, mock_device)
+            mock_generate_text.assert_called_once_with("test prompt", mock_tokenizer, mock_model, mock_device, app.state.config.defaults, ANY, prefix_cache=None, prompt_cache=None, speculative=None)
             
 @pytest.mark.asyncio
 async def test_generate_handler_unexpected_error(mock_model_and_tokenizer):
@@ -125,4 +137,203 @@ async def test_generate_handler_unexpected_error(mock_model_and_tokenizer):
             mock_logger.critical.assert_called_once_with(expected_error_response, exc_info=True)
             
             # verify `generate_text` was called with correct arguments
-            mock_generate_text.assert_called_once_with("test prompt", mock_tokenizer, mock_model, mock_device)
\ No newline at end of file
+            mock_generate_text.assert_called_once_with("test prompt", mock_tokenizer, mock_model, mock_device, app.state.config.defaults, ANY, prefix_cache=None, prompt_cache=None, speculative=None)
+            
+@pytest.mark.asyncio
+async def test_generate_handler_queue_full(mock_model_and_tokenizer):
+    expected_error_response = "Service overloaded: Inference queue is full (4 requests pending)"
+    mock_generate_text = MagicMock(return_value = Generation("generated text", "length", 5))
+    
+    with patch('api.logger') as mock_logger:
+        with patch('api.generate_text', new=mock_generate_text):
+            with patch.object(app.state.executor, 'submit', side_effect=QueueFullError(4, 2)):
+                payload = {"prompt": "test prompt"}
+                response = client.post("/generate", json=payload)
+                
+                # verify fast 503 with a retry hint, without running generation
+                assert response.status_code == 503
+                assert response.headers["Retry-After"] == "2"
+                assert response.json() == {"detail": expected_error_response}
+                mock_logger.warning.assert_called_once_with(expected_error_response)
+                mock_generate_text.assert_not_called()
+
+            
+@pytest.mark.asyncio
+@pytest.mark.parametrize("overrides", [
+    {"seed": "abc"},
+    {"seed": -1},
+    {"temperature": 3.0},
+    {"top_p": 0},
+    {"max_new_tokens": 0},
+    {"stop": [""]},
+    {"stop": ["a", "b", "c", "d", "e"]}
+])
+async def test_generate_handler_invalid_params(overrides):
+    mock_generate_text = MagicMock(return_value = Generation("generated text", "length", 5))
+    
+    with patch('api.generate_text', new=mock_generate_text):
+        payload = {"prompt": "test prompt", **overrides}
+        response = client.post("/generate", json=payload)
+    
+    # rejected by the request schema before any generation
+    assert response.status_code == 422
+    mock_generate_text.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_generate_handler_applies_request_params(mock_model_and_tokenizer):
+    mock_generate_text = MagicMock(return_value = Generation("generated text", "length", 5))
+    config = app.state.config
+    app.state.config = ServiceConfig(GenerationParams(max_new_tokens=50), max_new_tokens_limit=100)
+    
+    try:
+        with patch('api.generate_text', new=mock_generate_text):
+            payload = {"prompt": "test prompt", "max_new_tokens": 500, "temperature": 0, "stop": ["\n"], "seed": 7}
+            response = client.post("/generate", json=payload)
+        
+        assert response.status_code == 200
+        
+        # overrides replace the server defaults, max_new_tokens is clamped to the server limit
+        params = mock_generate_text.call_args.args[4]
+        assert params == GenerationParams(max_new_tokens=100, temperature=0, stop=("\n",), seed=7)
+    finally:
+        app.state.config = config
+            
+@pytest.mark.asyncio
+async def test_generate_handler_caches_seeded_requests(mock_model_and_tokenizer):
+    mock_generate_text = MagicMock(return_value = Generation("generated text", "length", 5))
+    mock_model, mock_tokenizer, mock_device = mock_model_and_tokenizer
+    app.state.response_cache = ResponseCache(max_entries=8, ttl=60)
+    app.state.model_fingerprint = "test-model"
+    
+    try:
+        with patch('api.generate_text', new=mock_generate_text):
+            payload = {"prompt": "test prompt", "seed": 42}
+            first = client.post("/generate", json=payload)
+            second = client.post("/generate", json=payload)
+            unseeded = client.post("/generate", json={"prompt": "test prompt"})
+        
+        assert first.json()['generated_text'] == second.json()['generated_text'] == "generated text"
+        assert unseeded.status_code == 200
+        
+        # the repeated seeded request is served from the cache, the unseeded one is not cacheable
+        assert mock_generate_text.call_count == 2
+        mock_generate_text.assert_any_call("test prompt", mock_tokenizer, mock_model, mock_device, 
+            replace(app.state.config.defaults, seed=42), ANY, prefix_cache=None, prompt_cache=None, speculative=None)
+        assert app.state.response_cache.hits == 1
+    finally:
+        del app.state.response_cache, app.state.model_fingerprint
+
+@pytest.mark.asyncio
+async def test_generate_handler_does_not_cache_timed_out_requests(mock_model_and_tokenizer):
+    mock_generate_text = MagicMock(return_value = Generation("generated", "timeout", 2))
+    app.state.response_cache = ResponseCache(max_entries=8, ttl=60)
+    app.state.model_fingerprint = "test-model"
+    
+    try:
+        with patch('api.generate_text', new=mock_generate_text):
+            payload = {"prompt": "test prompt", "temperature": 0}
+            first = client.post("/generate", json=payload)
+            second = client.post("/generate", json=payload)
+        
+        # a cut-short response depends on timing, so the repeat generates again
+        assert first.json()['finish_reason'] == second.json()['finish_reason'] == "timeout"
+        assert mock_generate_text.call_count == 2
+        assert len(app.state.response_cache) == 0
+    finally:
+        del app.state.response_cache, app.state.model_fingerprint
+
+@pytest.mark.asyncio
+async def test_generate_handler_samples_and_truncates_payload_logs():
+    config = app.state.config
+    
+    try:
+        with patch('api.logger') as mock_logger, patch('api.generate_text', return_value=Generation("x" * 50, "length", 3)):
+            app.state.config = replace(config, log_sample_rate=0)
+            assert client.post("/generate", json={"prompt": "test prompt"}).status_code == 200
+            assert all("Received payload" not in call.args[0] for call in mock_logger.info.call_args_list)
+            
+            app.state.config = replace(config, log_sample_rate=1, log_max_chars=10)
+            assert client.post("/generate", json={"prompt": "test prompt"}).status_code == 200
+            mock_logger.info.assert_any_call("Response: %s", "xxxxxxxxxx... (50 chars)")
+    finally:
+        app.state.config = config
+
+@pytest.mark.asyncio
+async def test_generate_handler_routes_named_models_to_the_registry(mock_model_and_tokenizer):
+    mock_generate_on = MagicMock(return_value=Generation("registry text", "length", 4))
+    registry = MagicMock()
+    registry.__contains__.side_effect = lambda name: name == "gpt2"
+    app.state.registry = registry
+    app.state.model_name = "distilgpt2"
+    
+    async def fake_generate_on(state, name, prompt, params, streamer=None):
+        return mock_generate_on(name, prompt, params)
+    
+    try:
+        with patch('api.generate_on', side_effect=fake_generate_on), \
+                patch('api.generate_text', return_value=Generation("default text", "length", 4)):
+            named = client.post("/generate", json={"prompt": "test prompt", "model": "gpt2"})
+            default = client.post("/generate", json={"prompt": "test prompt", "model": "distilgpt2"})
+            unknown = client.post("/generate", json={"prompt": "test prompt", "model": "llama"})
+        
+        assert named.json()['generated_text'] == "registry text"
+        mock_generate_on.assert_called_once_with("gpt2", "test prompt", app.state.config.defaults)
+        assert default.json()['generated_text'] == "default text"
+        assert unknown.status_code == 404
+        assert unknown.json() == {"detail": "Unknown model llama"}
+    finally:
+        del app.state.registry, app.state.model_name
+
+@pytest.mark.asyncio
+async def test_generate_handler_deadline_exceeded(mock_model_and_tokenizer):
+    expected_error_response = "Deadline exceeded: Request deadline would pass before generation could produce a first token"
+    schedules = []
+    
+    async def shed(*args, **kwargs):
+        schedules.append(scheduling.current.get())
+        raise DeadlineExceededError()
+    
+    with patch('api.logger') as mock_logger:
+        with patch.object(app.state.executor, 'submit', side_effect=shed):
+            response = client.post("/generate", json={"prompt": "test prompt", "priority": "bulk", "deadline": 5})
+            
+            assert response.status_code == 504
+            assert response.json() == {"detail": expected_error_response}
+            mock_logger.warning.assert_called_once_with(expected_error_response)
+            # queued with the request's priority and a deadline counting from its arrival
+            assert schedules[0].priority == "bulk"
+            assert 0 < schedules[0].remaining() <= 5
+
+@pytest.mark.asyncio
+async def test_generation_is_cancelled_when_the_client_disconnects():
+    request = MagicMock()
+    async def receive():
+        await asyncio.sleep(0.05)
+        return {"type": "http.disconnect"}
+    request.receive = receive
+    
+    generation = asyncio.ensure_future(asyncio.sleep(10))
+    assert await _unless_disconnected(request, generation) is None
+    await asyncio.sleep(0)
+    assert generation.cancelled()
+    
+    # a generation finishing first is returned as is
+    request.receive = lambda: asyncio.sleep(10)
+    assert await _unless_disconnected(request, asyncio.sleep(0, result="done")) == "done"
+
+@pytest.mark.asyncio
+async def test_models_handler_names_the_default_model_apart_from_the_registry(mock_model_and_tokenizer):
+    registry = MagicMock()
+    registry.describe.return_value = [
+        {"name": "distilgpt2", "loaded": False, "pinned": False, "bytes": None},
+        {"name": "gpt2", "loaded": True, "pinned": False, "bytes": 100}]
+    app.state.registry = registry
+    app.state.model_name = "distilgpt2"
+    
+    try:
+        response = client.get("/models")
+    finally:
+        del app.state.registry, app.state.model_name
+    
+    # the default model's directory under MODEL_ROOT_PATH is not listed as an unloaded registry model
+    assert response.json() == {"default": "distilgpt2", "models": [{"name": "gpt2", "loaded": True, "pinned": False, "bytes": 100}]}
@@ -0,0 +1,177 @@
+import json
+import time
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import patch, MagicMock
+from main import app
+from executor import InferenceExecutor, QueueFullError
+from generate import Generation
+from streaming import TokenStreamer
+
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def mock_model_and_tokenizer():
+    mock_model = MagicMock()
+    mock_tokenizer = MagicMock()
+    mock_device = MagicMock()
+    
+    # token ids decode to letters so streamed chunks are easy to check
+    mock_tokenizer.decode.side_effect = lambda ids, **kwargs: "".join(chr(ord('a') + i) for i in ids)
+    
+    app.state.model = mock_model
+    app.state.tokenizer = mock_tokenizer
+    app.state.device = mock_device
+    app.state.executor = InferenceExecutor(max_workers=1, max_queue_depth=4, retry_after=2)
+    
+    yield mock_model, mock_tokenizer, mock_device
+    
+    app.state.executor.shutdown()
+    del app.state.model, app.state.tokenizer, app.state.device, app.state.executor
+
+def fake_generate_text(prompt, tokenizer, model, device, params=None, streamer=None, prefix_cache=None, prompt_cache=None, speculative=None):
+    for token_id in range(3):
+        streamer.put(token_id)
+    streamer.end("length")
+    return Generation(prompt + "abc", "length", 3)
+
+@pytest.mark.asyncio
+async def test_generate_stream_ndjson():
+    with patch('api.generate_text', new=fake_generate_text):
+        response = client.post("/generate/stream", json={"prompt": "test prompt"})
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[:3] == [{"token": "a"}, {"token": "b"}, {"token": "c"}]
+    
+    # the final event carries the full text and timings
+    final = events[-1]
+    assert final["generated_text"] == "test promptabc"
+    assert final["finish_reason"] == "length"
+    assert final["generated_tokens"] == 3
+    assert isinstance(final["time_to_first_token"], float)
+    assert isinstance(final["response_time"], float)
+
+@pytest.mark.asyncio
+async def test_generate_stream_sse():
+    with patch('api.generate_text', new=fake_generate_text):
+        response = client.post("/generate/stream", json={"prompt": "test prompt"}, 
+            headers={"Accept": "text/event-stream"})
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    
+    events = response.text.strip().split("\n\n")
+    assert events[0] == 'data: {"token": "a"}'
+    assert events[-1].startswith("event: done\ndata: ")
+    assert json.loads(events[-1].split("data: ", 1)[1])["generated_text"] == "test promptabc"
+
+@pytest.mark.asyncio
+async def test_generate_stream_no_prompt():
+    with patch('api.logger') as mock_logger:
+        response = client.post("/generate/stream", json={})
+        
+        assert response.status_code == 400
+        assert response.json() == {"detail": "No prompt provided in payload"}
+        mock_logger.warning.assert_called_once_with("No prompt provided in payload")
+
+@pytest.mark.asyncio
+async def test_generate_stream_queue_full():
+    with patch.object(app.state.executor, 'submit', side_effect=QueueFullError(4, 2)):
+        response = client.post("/generate/stream", json={"prompt": "test prompt"})
+    
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+
+@pytest.mark.asyncio
+async def test_generate_stream_holds_back_stop_strings():
+    def stopping_generate_text(prompt, tokenizer, model, device, params=None, streamer=None, prefix_cache=None, prompt_cache=None, speculative=None):
+        # "abcde" where "cd" is a stop string: "c" waits until "d" shows it is a match
+        for token_id in range(4):
+            streamer.put(token_id)
+        streamer.end("stop")
+        return Generation(prompt + "ab", "stop", 4)
+    
+    with patch('api.generate_text', new=stopping_generate_text):
+        response = client.post("/generate/stream", json={"prompt": "test prompt", "stop": ["cd"]})
+    
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert "".join(e["token"] for e in events[:-1]) == "ab"
+    assert events[-1]["finish_reason"] == "stop"
+    assert events[-1]["generated_tokens"] == 4
+
+@pytest.mark.asyncio
+async def test_generate_stream_runtime_error():
+    def failing_generate_text(prompt, tokenizer, model, device, params=None, streamer=None, prefix_cache=None, prompt_cache=None, speculative=None):
+        raise RuntimeError("runtime error")
+    
+    with patch('api.generate_text', new=failing_generate_text):
+        response = client.post("/generate/stream", json={"prompt": "test prompt"})
+    
+    assert response.status_code == 500
+    assert response.json() == {"detail": "Model generation failed: runtime error"}
+
+@pytest.mark.asyncio
+async def test_generate_stream_cancels_generation_on_disconnect():
+    cancelled = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    
+    def endless_generate_text(prompt, tokenizer, model, device, params=None, streamer=None, prefix_cache=None, prompt_cache=None, speculative=None):
+        token_id = 0
+        while not streamer.cancelled:
+            streamer.put(token_id % 20)
+            token_id += 1
+            time.sleep(0.001)
+        loop.call_soon_threadsafe(cancelled.set)
+        return Generation(prompt, "length", token_id)
+    
+    first_chunk_sent = asyncio.Event()
+    received = []
+    
+    async def receive():
+        if not received:
+            received.append(True)
+            return {"type": "http.request", "body": b'{"prompt": "test prompt"}', "more_body": False}
+        # the client hangs up as soon as it has seen the first token
+        await first_chunk_sent.wait()
+        return {"type": "http.disconnect"}
+    
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            first_chunk_sent.set()
+    
+    scope = {"type": "http", "method": "POST", "path": "/generate/stream", "raw_path": b"/generate/stream",
+        "query_string": b"", "headers": [(b"content-type", b"application/json")], "app": app}
+    
+    with patch('api.generate_text', new=endless_generate_text):
+        await app(scope, receive, send)
+        await asyncio.wait_for(cancelled.wait(), timeout=5)
+    
+    assert cancelled.is_set()
+
+@pytest.mark.asyncio
+async def test_streamer_decodes_a_window_and_holds_back_incomplete_characters():
+    # token 1 and 2 are the two halves of "é"; while only the first has arrived, the
+    # tokenizer shows a replacement character followed by a space it adds on its own
+    pieces = {0: "a", 1: "\ufffd ", 2: "é"}
+    def decode(ids, **kwargs):
+        text = "".join(pieces[i] for i in ids)
+        return text.replace("\ufffd é", "é")
+    tokenizer = MagicMock()
+    tokenizer.decode.side_effect = decode
+    streamer = TokenStreamer(tokenizer)
+    
+    token_ids = [0] * 50 + [1, 2] + [0] * 50
+    for token_id in token_ids:
+        streamer.put(token_id)
+    streamer.end("length")
+    
+    chunks = []
+    while (chunk := await streamer.get()) is not None:
+        chunks.append(chunk)
+    assert "".join(chunks) == "a" * 50 + "é" + "a" * 50
+    # each step decodes a few tokens, not the whole output
+    assert max(len(call.args[0]) for call in tokenizer.decode.call_args_list) <= 3
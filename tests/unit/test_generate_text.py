@@ -1,72 +1,119 @@
 import unittest
 from unittest.mock import Mock, patch
-from generate import generate_text
+from generate import generate_text, generate_batch
+from config import GenerationParams
+import scheduling
+from transformers import GPT2Config, GPT2LMHeadModel
 import torch
 
 class TestGenerateText(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # tiny random-weight GPT-2 so the decode loop runs against a real model
+        torch.manual_seed(0)
+        config = GPT2Config(n_layer=2, n_head=2, n_embd=32, n_positions=128, vocab_size=64, bos_token_id=63, eos_token_id=63)
+        cls.real_model = GPT2LMHeadModel(config).eval()
+
     def setUp(self):
         self.tokenizer = Mock()
+        self.tokenizer.eos_token_id = 63
         self.model = Mock()
         self.device = torch.device("cpu")
 
-        # Mock `.to(device)` to return the tensor itself
-        def mock_to_device(tensor, _=None, **kwargs):
-            return tensor  # Simply return the tensor unchanged
-        self.mock_tensor = lambda _: Mock(spec=torch.Tensor, to=Mock(side_effect=mock_to_device))
-
-        self.model.generate.reset_mock()
+        self.model.reset_mock()
         self.tokenizer.reset_mock()
 
     def test_generate_text_with_valid_input(self):
         prompt = "test prompt"
         expectedGeneration = "test generation"
         
-        self.tokenizer.return_value = {
-            'input_ids': torch.tensor([[1, 2, 3]], device=self.device),
-            'attention_mask': torch.tensor([[1, 1, 1]], device=self.device)
-        }
-
-        self.model.generate.return_value = torch.tensor([[4, 5, 6]], device=self.device)
+        self.tokenizer.return_value = {'input_ids': [1, 2, 3]}
         self.tokenizer.decode.return_value = expectedGeneration
         
-        result = generate_text(prompt, self.tokenizer, self.model, self.device)
-        self.assertEqual(result, expectedGeneration)
-        self.tokenizer.assert_called_once_with(prompt, return_tensors="pt", padding=False, truncation=True, max_length=512)
-        self.model.generate.assert_called_once()
+        result = generate_text(prompt, self.tokenizer, self.real_model, self.device, GenerationParams(max_new_tokens=5))
+        
+        self.assertEqual(result.text, expectedGeneration)
+        self.assertTrue(1 <= result.generated_tokens <= 5)
+        self.tokenizer.assert_called_once_with(prompt, padding=False, truncation=True, max_length=512)
+        
+        # decoded output is the prompt followed by at most max_new_tokens new tokens
+        token_ids = self.tokenizer.decode.call_args.args[0]
+        self.assertEqual(token_ids[:3], [1, 2, 3])
+        self.assertTrue(4 <= len(token_ids) <= 8)
+        self.assertEqual(self.tokenizer.decode.call_args.kwargs, {'skip_special_tokens': True})
 
     def test_generate_text_with_empty_prompt(self):
-        self.tokenizer.return_value = {
-            'input_ids': torch.tensor([[]], device=self.device), 
-            'attention_mask': torch.tensor([[]], device=self.device)
-        }
-        self.model.generate.return_value = torch.tensor([[]], device=self.device)
+        self.tokenizer.return_value = {'input_ids': []}
         self.tokenizer.decode.return_value = ""
 
         result = generate_text("", self.tokenizer, self.model, self.device)
         
-        self.assertEqual(result, "")
+        self.assertEqual(result.text, "")
+        self.assertEqual(result.generated_tokens, 0)
+        self.model.assert_not_called()
 
     def test_generate_text_raises_runtime_error(self):
-        self.tokenizer.return_value = {
-            'input_ids': torch.tensor([[1, 2, 3]], device=self.device), 
-            'attention_mask': torch.tensor([[1, 1, 1]], device=self.device)
-        }
-        self.model.generate.side_effect = RuntimeError("Model generation error")
+        self.tokenizer.return_value = {'input_ids': [1, 2, 3]}
+        self.model.side_effect = RuntimeError("Model generation error")
 
         with self.assertRaises(RuntimeError):
             generate_text("prompt", self.tokenizer, self.model, self.device)
 
     @patch('torch.no_grad')
     def test_context_manager_for_no_grad(self, mock_no_grad):
-        self.tokenizer.return_value = {
-            'input_ids': torch.tensor([[1, 2, 3]], device=self.device), 
-            'attention_mask': torch.tensor([[1, 1, 1]], device=self.device)
-        }
-        self.model.generate.return_value = torch.tensor([[4, 5, 6]], device=self.device)
+        self.tokenizer.return_value = {'input_ids': [1, 2, 3]}
         
-        generate_text("test", self.tokenizer, self.model, self.device)
+        generate_text("test", self.tokenizer, self.real_model, self.device, GenerationParams(max_new_tokens=2))
         mock_no_grad.assert_called_once()
 
+    def test_generate_batch_decodes_each_prompt(self):
+        prompts = ["first prompt", "second"]
+        expectedGenerations = ["first generation", "second generation"]
+        
+        self.tokenizer.return_value = {'input_ids': [[1, 2, 3], [4]]}
+        self.tokenizer.batch_decode.return_value = expectedGenerations
+        
+        result = generate_batch(prompts, self.tokenizer, self.real_model, self.device, [GenerationParams(max_new_tokens=4)] * 2)
+        
+        self.assertEqual([r.text for r in result], expectedGenerations)
+        self.tokenizer.assert_called_once_with(prompts, padding=False, truncation=True, max_length=512)
+        
+        # one decoded sequence per prompt, in input order
+        first, second = self.tokenizer.batch_decode.call_args.args[0]
+        self.assertEqual(first[:3], [1, 2, 3])
+        self.assertEqual(second[:1], [4])
+        self.assertTrue(len(first) <= 7 and len(second) <= 5)
+
+    def test_generate_text_stops_at_stop_string(self):
+        self.tokenizer.return_value = {'input_ids': [1, 2, 3]}
+        # one character per token id
+        self.tokenizer.decode.side_effect = lambda ids, **kwargs: "".join(chr(ord('A') + i) for i in ids)
+
+        full = generate_text("BCD", self.tokenizer, self.real_model, self.device, GenerationParams(max_new_tokens=6, temperature=0))
+        stop = full.text[5]
+        position = full.text.index(stop, 3)
+
+        result = generate_text("BCD", self.tokenizer, self.real_model, self.device, GenerationParams(max_new_tokens=6, temperature=0, stop=(stop,)))
+
+        # decoding ends on the token that completes the stop string, which is cut from the text
+        self.assertEqual(result.text, full.text[:position])
+        self.assertEqual(result.finish_reason, "stop")
+        self.assertEqual(result.generated_tokens, position - 2)
+
+    def test_generation_stops_at_the_request_deadline(self):
+        self.tokenizer.return_value = {'input_ids': [1, 2, 3]}
+        self.tokenizer.decode.return_value = "text"
+        
+        # a deadline already reached cuts the generation short, a long timeout notwithstanding
+        token = scheduling.current.set(scheduling.Schedule.within("interactive", 0))
+        try:
+            result = generate_text("BCD", self.tokenizer, self.real_model, self.device, GenerationParams(max_new_tokens=6, timeout=60))
+        finally:
+            scheduling.current.reset(token)
+        
+        self.assertEqual(result.finish_reason, "timeout")
+        self.assertEqual(result.generated_tokens, 1)
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -2,6 +2,7 @@ import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import patch, Mock
 from main import app
+from ipc import InferenceClient
 
 @pytest.fixture
 def client():
@@ -38,4 +39,40 @@ async def test_health_check_tokenizer_unhealthy(client):
         response = client.get("/health")
         assert response.status_code == 503
         assert response.json() == {"status": "unhealthy", "detail": "Model or tokenizer not loaded"}
-        mock_logger.info.assert_called_once_with("Health check failed - Model or tokenizer not loaded")
\ No newline at end of file
+        mock_logger.info.assert_called_once_with("Health check failed - Model or tokenizer not loaded")
+
+@pytest.mark.asyncio
+async def test_health_check_inference_process_unreachable(client):
+    if hasattr(app.state, 'model'):
+        del app.state.model
+    tokenizer = getattr(app.state, 'tokenizer', None)
+    app.state.tokenizer = Mock()
+    app.state.batcher = InferenceClient("/tmp/missing.sock")
+    
+    try:
+        with patch('api.logger') as mock_logger:
+            response = client.get("/health")
+            assert response.status_code == 503
+            assert response.json() == {"status": "unhealthy", "detail": "Inference process not reachable"}
+            mock_logger.info.assert_called_once_with("Health check failed - Inference process not reachable")
+    finally:
+        del app.state.batcher
+        if tokenizer is None:
+            del app.state.tokenizer
+        else:
+            app.state.tokenizer = tokenizer
+
+@pytest.mark.asyncio
+async def test_health_check_fails_after_warm_up_failed(client):
+    app.state.model = Mock()
+    app.state.tokenizer = Mock()
+    app.state.warmup_failed = True
+    
+    try:
+        with patch('api.logger') as mock_logger:
+            response = client.get("/health")
+            assert response.status_code == 503
+            assert response.json() == {"status": "unhealthy", "detail": "Warm-up failed"}
+            mock_logger.info.assert_called_once_with("Health check failed - Warm-up failed")
+    finally:
+        del app.state.warmup_failed
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+import pytest
+from executor import InferenceExecutor, QueueFullError
+from scheduling import Schedule, DeadlineExceededError
+import scheduling
+
+@pytest.fixture
+def executor():
+    executor = InferenceExecutor(max_workers=1, max_queue_depth=2, retry_after=3)
+    yield executor
+    executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_submit_runs_off_event_loop(executor):
+    loop_thread = threading.get_ident()
+    
+    result, worker_thread = await executor.submit(lambda x: (x * 2, threading.get_ident()), 21)
+    
+    assert result == 42
+    assert worker_thread != loop_thread
+    assert executor.depth == 0
+
+@pytest.mark.asyncio
+async def test_submit_rejects_when_queue_full(executor):
+    release = threading.Event()
+    
+    # occupy the single worker and the one waiting slot
+    running = asyncio.ensure_future(executor.submit(release.wait))
+    waiting = asyncio.ensure_future(executor.submit(lambda: "done"))
+    await asyncio.sleep(0)
+    assert executor.depth == 2
+    
+    with pytest.raises(QueueFullError) as excinfo:
+        await executor.submit(lambda: "rejected")
+    assert excinfo.value.retry_after == 3
+    
+    release.set()
+    assert await running is True
+    assert await waiting == "done"
+    
+    # slots are released once the work completes
+    await asyncio.sleep(0)
+    assert executor.depth == 0
+
+@pytest.mark.asyncio
+async def test_submit_propagates_exceptions(executor):
+    def fail():
+        raise RuntimeError("generation failed")
+    
+    with pytest.raises(RuntimeError, match="generation failed"):
+        await executor.submit(fail)
+
+async def submit_as(executor, schedule, fn):
+    scheduling.current.set(schedule)
+    return await executor.submit(fn)
+
+@pytest.mark.asyncio
+async def test_waiting_requests_start_by_priority_then_deadline():
+    executor = InferenceExecutor(max_workers=1, max_queue_depth=4, retry_after=3)
+    release = threading.Event()
+    started = []
+    now = time.monotonic()
+    
+    running = asyncio.ensure_future(executor.submit(release.wait))
+    await asyncio.sleep(0)
+    waiting = [asyncio.ensure_future(submit_as(executor, schedule, lambda name=name: started.append(name)))
+        for name, schedule in [("bulk", Schedule("bulk")), ("late", Schedule("interactive", now + 60)),
+            ("soon", Schedule("interactive", now + 30))]]
+    await asyncio.sleep(0)
+    
+    release.set()
+    await asyncio.gather(running, *waiting)
+    executor.shutdown()
+    assert started == ["soon", "late", "bulk"]
+
+@pytest.mark.asyncio
+async def test_requests_past_their_deadline_are_shed_before_starting(executor):
+    release = threading.Event()
+    ran = []
+    
+    running = asyncio.ensure_future(executor.submit(release.wait))
+    await asyncio.sleep(0)
+    expiring = asyncio.ensure_future(submit_as(executor, Schedule.within("interactive", 0.05), lambda: ran.append("expiring")))
+    await asyncio.sleep(0.1)
+    
+    release.set()
+    with pytest.raises(DeadlineExceededError):
+        await expiring
+    assert await running is True
+    assert ran == []
+    
+    # the shed request gave its place back
+    await asyncio.sleep(0)
+    assert executor.depth == 0
+
+@pytest.mark.asyncio
+async def test_requests_that_cannot_get_a_first_token_in_time_are_shed(executor, monkeypatch):
+    # recent prompts took a second to their first token
+    monkeypatch.setattr(scheduling, '_prefill_seconds', 1.0)
+    ran = []
+    
+    with pytest.raises(DeadlineExceededError):
+        await submit_as(executor, Schedule.within("interactive", 0.5), lambda: ran.append("short"))
+    assert await submit_as(executor, Schedule.within("interactive", 5), lambda: "long") == "long"
+    assert ran == []
+    
+    scheduling.observe_prefill(2.0)
+    assert scheduling.prefill_seconds() == pytest.approx(1.2)
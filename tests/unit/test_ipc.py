@@ -0,0 +1,188 @@
+import asyncio
+import threading
+import pytest
+import pytest_asyncio
+from unittest.mock import MagicMock, patch, ANY
+from starlette.datastructures import State
+from ipc import InferenceServer, InferenceClient, decode_params
+from dataclasses import asdict
+from executor import InferenceExecutor, QueueFullError
+from config import GenerationParams
+from generate import Generation
+from streaming import TokenStreamer
+from scheduling import Schedule, DeadlineExceededError
+import scheduling
+
+@pytest.fixture
+def state():
+    state = State()
+    state.model = MagicMock()
+    state.tokenizer = MagicMock()
+    state.device = "cpu"
+    state.batcher = None
+    state.prefix_cache = None
+    state.model_fingerprint = "abc123"
+    state.executor = InferenceExecutor(max_workers=1, max_queue_depth=2, retry_after=3)
+    yield state
+    state.executor.shutdown()
+
+@pytest_asyncio.fixture
+async def connection(state, tmp_path):
+    server = InferenceServer(state, str(tmp_path / "inference.sock"))
+    await server.start()
+    client = InferenceClient(server.path, connect_timeout=1)
+    await client.connect()
+    yield server, client
+    await client.close()
+    await server.stop()
+
+def fake_generate_text(prompt, tokenizer, model, device, params=None, streamer=None, prefix_cache=None, prompt_cache=None, speculative=None, prompt_ids=None):
+    if streamer:
+        for token_id in range(3):
+            streamer.put(token_id)
+        streamer.end("length")
+    return Generation(prompt + " generated", "length", 3)
+
+def test_params_survive_json():
+    params = GenerationParams(stop=("\n",), stop_token_ids=(7,), seed=1, timeout=2.5)
+    
+    assert decode_params(asdict(params)) == params
+
+@pytest.mark.asyncio
+async def test_generation_runs_in_the_server_process(connection, state):
+    _, client = connection
+    params = GenerationParams(max_new_tokens=3, stop=("\n",))
+    
+    with patch('ipc.generate_text', side_effect=fake_generate_text) as mock_generate_text:
+        generation = await client.submit("Hello", params)
+    
+    assert generation == Generation("Hello generated", "length", 3)
+    assert mock_generate_text.call_args.args == ("Hello", state.tokenizer, state.model, "cpu", params, ANY, None)
+    assert mock_generate_text.call_args.kwargs["prompt_ids"] is None
+    
+    # ids the worker encoded already are generated from as they are
+    with patch('ipc.generate_text', side_effect=fake_generate_text) as mock_generate_text:
+        await client.submit("Hello", params, prompt_ids=[1, 2])
+    assert mock_generate_text.call_args.kwargs["prompt_ids"] == [1, 2]
+    assert await client.info() == {"model_fingerprint": "abc123"}
+    assert client.pending == 0
+
+@pytest.mark.asyncio
+async def test_streamed_token_ids_reach_the_worker_streamer(connection):
+    _, client = connection
+    tokenizer = MagicMock()
+    tokenizer.decode.side_effect = lambda ids, **kwargs: "".join(chr(ord('a') + i) for i in ids)
+    streamer = TokenStreamer(tokenizer)
+    
+    with patch('ipc.generate_text', side_effect=fake_generate_text):
+        generation = await client.submit("Hello", GenerationParams(), streamer=streamer)
+    
+    chunks = []
+    while (chunk := await streamer.get()) is not None:
+        chunks.append(chunk)
+    assert chunks == ["a", "b", "c"]
+    assert streamer.finish_reason == "length"
+    assert generation.text == "Hello generated"
+
+@pytest.mark.asyncio
+async def test_queue_full_error_crosses_the_socket(connection, state):
+    _, client = connection
+    state.executor._depth = state.executor.max_queue_depth
+    
+    with pytest.raises(QueueFullError) as error:
+        await client.submit("Hello")
+    assert error.value.retry_after == 3
+    state.executor._depth = 0
+
+@pytest.mark.asyncio
+async def test_schedule_crosses_the_socket(connection, state):
+    _, client = connection
+    schedules = []
+    
+    async def shed(*args, **kwargs):
+        schedules.append(scheduling.current.get())
+        raise DeadlineExceededError()
+    
+    scheduling.current.set(Schedule.within("bulk", 5))
+    with patch.object(state.executor, 'submit', side_effect=shed):
+        with pytest.raises(DeadlineExceededError):
+            await client.submit("Hello")
+    
+    # the inference process queues it by what is left of the worker's deadline
+    assert schedules[0].priority == "bulk"
+    assert 0 < schedules[0].remaining() <= 5
+
+@pytest.mark.asyncio
+async def test_cancelled_request_stops_the_server_side_generation(connection):
+    _, client = connection
+    started, stopped = threading.Event(), threading.Event()
+    
+    def slow_generate_text(prompt, tokenizer, model, device, params=None, streamer=None, prefix_cache=None, prompt_cache=None, speculative=None, prompt_ids=None):
+        started.set()
+        while not streamer.cancelled:
+            pass
+        stopped.set()
+        return Generation("", "length", 0)
+    
+    with patch('ipc.generate_text', side_effect=slow_generate_text):
+        task = asyncio.create_task(client.submit("Hello", streamer=MagicMock(cancelled=False)))
+        await asyncio.to_thread(started.wait, 1)
+        task.cancel()
+        assert await asyncio.to_thread(stopped.wait, 1)
+
+@pytest.mark.asyncio
+async def test_lost_connection_fails_pending_requests(connection):
+    server, client = connection
+    release = threading.Event()
+    
+    def blocking_generate_text(*args, **kwargs):
+        release.wait(1)
+        return Generation("", "length", 0)
+    
+    with patch('ipc.generate_text', side_effect=blocking_generate_text):
+        task = asyncio.create_task(client.submit("Hello"))
+        await asyncio.sleep(0.1)
+        client._writer.transport.abort()
+    
+        with pytest.raises(RuntimeError, match="Connection to the inference process lost"):
+            await task
+        release.set()
+    assert not client.connected
+
+@pytest.mark.asyncio
+async def test_ready_waits_for_the_server_warm_up(connection, state):
+    _, client = connection
+    state.ready = False
+    
+    ready = asyncio.create_task(client.wait_ready())
+    await asyncio.sleep(0.2)
+    assert not ready.done()
+    
+    state.ready = True
+    await asyncio.wait_for(ready, 1)
+    
+    # a warm-up that failed for good fails the workers' wait too
+    state.ready = False
+    state.warmup_failed = True
+    with pytest.raises(RuntimeError, match="Warm-up of the inference process failed"):
+        await asyncio.wait_for(client.wait_ready(), 1)
+
+@pytest.mark.asyncio
+async def test_worker_metrics_are_recorded_in_the_server_process(connection):
+    _, client = connection
+    registry = MagicMock()
+    
+    with patch('ipc.REGISTRY', new=registry):
+        registry.render.return_value = "# metrics\n"
+        client.record_metric("llm_requests_in_flight", "inc", 1, {})
+        assert await client.metrics() == "# metrics\n"
+    
+    registry.apply.assert_called_once_with("llm_requests_in_flight", "inc", 1, {})
+
+@pytest.mark.asyncio
+async def test_saturation_is_of_the_server_queue(connection, state):
+    _, client = connection
+    state.executor._depth = 1
+    
+    assert await client.saturation() == 0.5
+    state.executor._depth = 0
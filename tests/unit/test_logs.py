@@ -0,0 +1,47 @@
+import json
+import logging
+import pytest
+from fastapi.testclient import TestClient
+from main import app
+from logs import JsonFormatter, RequestIdFilter, request_id, truncate
+from executor import InferenceExecutor
+
+client = TestClient(app)
+
+def test_json_lines_carry_the_request_id():
+    record = logging.LogRecord("api", logging.INFO, __file__, 1, "Generated %d tokens", (3,), None)
+    token = request_id.set("abc")
+    try:
+        RequestIdFilter().filter(record)
+    finally:
+        request_id.reset(token)
+    
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "Generated 3 tokens"
+    assert entry["request_id"] == "abc"
+    assert entry["level"] == "INFO"
+
+def test_long_payloads_are_truncated():
+    assert truncate("short", 10) == "short"
+    assert truncate("a" * 12, 10) == "aaaaaaaaaa... (12 chars)"
+
+def test_request_id_is_returned_and_taken_from_the_client():
+    app.state.ready = True
+    try:
+        generated = client.get("/ready")
+        given = client.get("/ready", headers={"X-Request-ID": "trace-1"})
+    finally:
+        del app.state.ready
+    
+    assert len(generated.headers["x-request-id"]) == 32
+    assert given.headers["x-request-id"] == "trace-1"
+
+@pytest.mark.asyncio
+async def test_request_id_reaches_executor_threads():
+    executor = InferenceExecutor(max_workers=1, max_queue_depth=2, retry_after=1)
+    token = request_id.set("abc")
+    try:
+        assert await executor.submit(request_id.get) == "abc"
+    finally:
+        request_id.reset(token)
+        executor.shutdown()
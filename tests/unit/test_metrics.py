@@ -0,0 +1,90 @@
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import patch, MagicMock
+from main import app
+from metrics import Registry, REGISTRY
+from executor import InferenceExecutor
+from generate import Generation
+
+client = TestClient(app)
+
+def test_counter_series_per_label_set():
+    registry = Registry()
+    lookups = registry.counter("lookups_total", "Lookups by result")
+    lookups.inc(result="hit")
+    lookups.inc(2, result="hit")
+    lookups.inc(result="miss")
+    
+    assert registry.render().splitlines() == [
+        "# HELP lookups_total Lookups by result",
+        "# TYPE lookups_total counter",
+        'lookups_total{result="hit"} 3',
+        'lookups_total{result="miss"} 1'
+    ]
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        latency.observe(value)
+    
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 6.05',
+        'latency_seconds_count 4'
+    ]
+
+def test_gauge_reads_its_function_at_scrape_time():
+    registry = Registry()
+    depth = registry.gauge("depth", "Queue depth")
+    pending = [3]
+    depth.set_function(lambda: pending[0])
+    
+    assert registry.render().splitlines()[-1] == "depth 3"
+    pending[0] = 5
+    assert registry.render().splitlines()[-1] == "depth 5"
+
+def test_forwarded_updates_are_not_kept_locally():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests")
+    registry.forward = MagicMock()
+    
+    requests.inc(endpoint="/generate")
+    
+    registry.forward.assert_called_once_with("requests_total", "inc", 1, {"endpoint": "/generate"})
+    registry.forward = None
+    assert "requests_total{" not in registry.render()
+    
+    registry.apply("requests_total", "inc", 1, {"endpoint": "/generate"})
+    assert 'requests_total{endpoint="/generate"} 1' in registry.render()
+
+@pytest.mark.asyncio
+async def test_metrics_handler_reports_request_stages():
+    app.state.model = MagicMock()
+    app.state.tokenizer = MagicMock()
+    app.state.device = MagicMock()
+    app.state.executor = InferenceExecutor(max_workers=1, max_queue_depth=4, retry_after=2)
+    
+    def count(name):
+        lines = [line for line in REGISTRY.render().splitlines() if line.startswith(name)]
+        return float(lines[0].split()[-1]) if lines else 0
+    
+    before = count('llm_request_duration_seconds_count{endpoint="/generate"}')
+    try:
+        with patch('api.generate_text', return_value=Generation("text", "length", 4)):
+            assert client.post("/generate", json={"prompt": "hi", "temperature": 0.5}).status_code == 200
+        response = client.get("/metrics")
+    finally:
+        app.state.executor.shutdown()
+        del app.state.model, app.state.tokenizer, app.state.device, app.state.executor
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    for name in ("llm_queue_wait_seconds", "llm_tokenization_seconds", "llm_prefill_seconds", "llm_decode_token_seconds",
+            "llm_detokenization_seconds", "llm_prompt_tokens_total", "llm_generated_tokens_total", "llm_batch_size",
+            "llm_cache_lookups_total", "llm_requests_in_flight", "llm_queue_depth", "llm_queue_saturation"):
+        assert f"# TYPE {name} " in response.text
+    assert count('llm_request_duration_seconds_count{endpoint="/generate"}') == before + 1
+    assert count("llm_requests_in_flight") == 0
@@ -0,0 +1,97 @@
+import pytest
+import torch
+from unittest.mock import patch, MagicMock
+from transformers import GPT2Config, GPT2LMHeadModel
+from model_loader import load_model_and_tokenizer, load_draft_model, load_tokenizer, quantize_int8, _conv1d_to_linear
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = GPT2Config(n_layer=2, n_head=2, n_embd=32, n_positions=128, vocab_size=64, bos_token_id=63, eos_token_id=63)
+    return GPT2LMHeadModel(config).eval()
+
+@pytest.fixture
+def loader():
+    tokenizer = MagicMock()
+    tokenizer.eos_token_id = 63
+    with patch('model_loader.AutoModelForCausalLM.from_pretrained', side_effect=lambda path, **kwargs: tiny_model()) as from_pretrained, \
+            patch('model_loader.AutoTokenizer.from_pretrained', return_value=tokenizer), \
+            patch('torch.backends.mps.is_available', return_value=False):
+        yield from_pretrained
+
+def test_conv1d_to_linear_keeps_outputs():
+    model = tiny_model()
+    input_ids = torch.tensor([[1, 2, 3, 4]])
+    with torch.no_grad():
+        expected = model(input_ids).logits
+        converted = _conv1d_to_linear(model)(input_ids).logits
+    
+    assert torch.allclose(expected, converted, atol=1e-5)
+
+def test_quantize_int8_replaces_projections_but_not_output_head():
+    model = quantize_int8(tiny_model())
+    
+    quantized = [name for name, module in model.named_modules() if isinstance(module, torch.ao.nn.quantized.dynamic.Linear)]
+    assert len(quantized) == 2 * 4
+    assert isinstance(model.lm_head, torch.nn.Linear)
+    with torch.no_grad():
+        assert model(torch.tensor([[1, 2, 3]])).logits.shape == (1, 3, 64)
+
+def test_load_in_int8_mode(loader):
+    with patch.dict('os.environ', {'CPU_INFERENCE_MODE': 'int8'}):
+        model, tokenizer, device = load_model_and_tokenizer()
+    
+    assert device == "cpu"
+    assert model.inference_mode == "int8"
+    assert isinstance(model.transformer.h[0].mlp.c_fc, torch.ao.nn.quantized.dynamic.Linear)
+
+def test_bf16_falls_back_to_fp32_without_cpu_support(loader):
+    with patch.dict('os.environ', {'CPU_INFERENCE_MODE': 'bf16'}), patch('model_loader.cpu_supports_bf16', return_value=False):
+        model, _, _ = load_model_and_tokenizer()
+    
+    assert model.inference_mode == "fp32"
+    assert loader.call_args.kwargs['dtype'] is None
+
+def test_unknown_mode_stops_the_service(loader):
+    with patch.dict('os.environ', {'CPU_INFERENCE_MODE': 'int4'}):
+        with pytest.raises(SystemExit):
+            load_model_and_tokenizer()
+
+def test_draft_model_is_loaded_in_the_model_mode(loader):
+    with patch.dict('os.environ', {'CPU_INFERENCE_MODE': 'int8', 'DRAFT_MODEL_DIR_PATH': '/models/distilgpt2', 'MODEL_MMAP': 'false'}):
+        model, tokenizer, device = load_model_and_tokenizer()
+        draft = load_draft_model(model, tokenizer, device)
+    
+    assert loader.call_args.args == ('/models/distilgpt2',)
+    assert isinstance(draft.transformer.h[0].mlp.c_fc, torch.ao.nn.quantized.dynamic.Linear)
+
+def test_draft_model_with_another_tokenizer_stops_the_service(loader):
+    model, _, device = load_model_and_tokenizer()
+    other_tokenizer = MagicMock()
+    other_tokenizer.get_vocab.return_value = {"hello": 0}
+    
+    with patch.dict('os.environ', {'DRAFT_MODEL_DIR_PATH': '/models/other'}):
+        with pytest.raises(SystemExit):
+            load_draft_model(model, other_tokenizer, device)
+    
+    assert load_draft_model(model, other_tokenizer, device) is None
+
+def test_slow_tokenizer_is_rejected():
+    with patch('model_loader.AutoTokenizer.from_pretrained', return_value=MagicMock(is_fast=False)) as from_pretrained:
+        with pytest.raises(ValueError, match="is not a fast tokenizer"):
+            load_tokenizer("/models/gpt2")
+    
+    assert from_pretrained.call_args.kwargs == {'use_fast': True}
+
+def test_mmap_load_matches_private_load(tmp_path, caplog):
+    tiny_model().save_pretrained(tmp_path)
+    tokenizer = MagicMock()
+    with patch.dict('os.environ', {'MODEL_DIR_PATH': str(tmp_path)}), \
+            patch('model_loader.AutoTokenizer.from_pretrained', return_value=tokenizer), \
+            patch('torch.backends.mps.is_available', return_value=False), \
+            caplog.at_level('INFO'):
+        model, _, _ = load_model_and_tokenizer()
+    
+    input_ids = torch.tensor([[1, 2, 3, 4]])
+    with torch.no_grad():
+        assert torch.allclose(model(input_ids).logits, tiny_model()(input_ids).logits, atol=1e-5)
+    assert "with mapped weights" in caplog.text
@@ -0,0 +1,73 @@
+import unittest
+import torch
+from prefix_cache import PrefixCache
+
+def fake_kv(token_ids, layers=2):
+    # per-layer (key, value) tensors shaped (batch, heads, tokens, head_dim), with each
+    # position holding its token id so slices can be checked
+    values = torch.tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1).expand(1, 2, -1, 4).contiguous()
+    return [(values.clone(), values.clone()) for _ in range(layers)]
+
+def kv_bytes(num_tokens, layers=2):
+    return layers * 2 * (2 * num_tokens * 4) * 4
+
+class TestPrefixCache(unittest.TestCase):
+
+    def test_lookup_miss_on_empty_cache(self):
+        cache = PrefixCache(max_bytes=10**6)
+        
+        self.assertEqual(cache.lookup([1, 2, 3]), (0, None))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_lookup_returns_longest_cached_prefix(self):
+        cache = PrefixCache(max_bytes=10**6)
+        cache.insert([1, 2, 3, 4], fake_kv([1, 2, 3, 4]))
+        
+        matched, kv = cache.lookup([1, 2, 3, 9, 9])
+        
+        self.assertEqual(matched, 3)
+        self.assertEqual(len(kv), 2)
+        self.assertEqual(kv[0][0][0, 0, :, 0].tolist(), [1, 2, 3])
+        self.assertEqual((cache.hits, cache.misses, cache.hit_tokens), (1, 0, 3))
+
+    def test_shared_prefix_is_stored_once(self):
+        cache = PrefixCache(max_bytes=10**6)
+        cache.insert([1, 2, 3, 4], fake_kv([1, 2, 3, 4]))
+        cache.insert([1, 2, 5], fake_kv([1, 2, 5]))
+        
+        # the tree splits at the shared [1, 2] prefix instead of duplicating it
+        self.assertEqual(cache.size_bytes, kv_bytes(5))
+        
+        matched, kv = cache.lookup([1, 2, 5, 6])
+        self.assertEqual(matched, 3)
+        self.assertEqual(kv[1][1][0, 0, :, 0].tolist(), [1, 2, 5])
+        
+        matched, kv = cache.lookup([1, 2, 3, 4])
+        self.assertEqual(matched, 4)
+        self.assertEqual(kv[0][0][0, 0, :, 0].tolist(), [1, 2, 3, 4])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = PrefixCache(max_bytes=kv_bytes(6))
+        cache.insert([1, 2, 3], fake_kv([1, 2, 3]))
+        cache.insert([4, 5, 6], fake_kv([4, 5, 6]))
+        
+        # touch the first entry so the second becomes least recently used
+        cache.lookup([1, 2, 3])
+        cache.insert([7, 8, 9], fake_kv([7, 8, 9]))
+        
+        self.assertLessEqual(cache.size_bytes, cache.max_bytes)
+        self.assertEqual(cache.lookup([1, 2, 3])[0], 3)
+        self.assertEqual(cache.lookup([7, 8, 9])[0], 3)
+        self.assertEqual(cache.lookup([4, 5, 6])[0], 0)
+
+    def test_hit_rate(self):
+        cache = PrefixCache(max_bytes=10**6)
+        cache.insert([1, 2], fake_kv([1, 2]))
+        
+        cache.lookup([1, 2])
+        cache.lookup([3])
+        
+        self.assertEqual(cache.hit_rate, 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import patch, MagicMock
+from dataclasses import replace
+from main import app
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+@pytest.mark.asyncio
+async def test_ready_after_warm_up(client):
+    app.state.ready = True
+    
+    try:
+        response = client.get("/ready")
+        assert response.status_code == 200
+        assert response.json() == {"status": "ready"}
+    finally:
+        del app.state.ready
+
+@pytest.mark.asyncio
+async def test_not_ready_during_warm_up(client):
+    app.state.ready = False
+    
+    try:
+        with patch('api.logger') as mock_logger:
+            response = client.get("/ready")
+            assert response.status_code == 503
+            assert response.json() == {"status": "not ready", "detail": "Warm-up has not finished"}
+            mock_logger.info.assert_called_once_with("Readiness check failed - Warm-up has not finished")
+    finally:
+        del app.state.ready
+
+
+@pytest.mark.asyncio
+async def test_not_ready_while_overloaded(client):
+    app.state.ready = True
+    app.state.batcher = MagicMock(pending=6)
+    app.state.executor = MagicMock(max_queue_depth=8)
+    config = app.state.config
+    app.state.config = replace(config, ready_max_saturation=0.75)
+    
+    try:
+        response = client.get("/ready")
+        assert response.status_code == 503
+        assert response.json() == {"status": "overloaded", "detail": "Inference queue is 75% full"}
+        
+        app.state.batcher.pending = 5
+        assert client.get("/ready").status_code == 200
+    finally:
+        app.state.config = config
+        del app.state.ready, app.state.batcher, app.state.executor
\ No newline at end of file
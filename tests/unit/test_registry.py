@@ -0,0 +1,106 @@
+import os
+import time
+import threading
+import pytest
+from unittest.mock import patch, MagicMock
+from registry import ModelRegistry
+
+MODEL_BYTES = 100
+
+@pytest.fixture
+def root(tmp_path):
+    for name in ("distilgpt2", "gpt2", "tiny"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "config.json").write_text("{}")
+        (tmp_path / name / "model.safetensors").write_bytes(bytes(MODEL_BYTES))
+    # not a model, it has no config.json
+    (tmp_path / "notes").mkdir()
+    return tmp_path
+
+@pytest.fixture
+def load_model():
+    def fake_load_model(path):
+        model = MagicMock()
+        model.get_memory_footprint.return_value = MODEL_BYTES
+        return model, MagicMock(), "cpu"
+    
+    with patch('registry.load_model', side_effect=fake_load_model) as mock_load_model:
+        yield mock_load_model
+
+def test_models_are_discovered_and_loaded_on_first_use(root, load_model):
+    registry = ModelRegistry(str(root), max_bytes=1000, pinned=[])
+    
+    assert [model["name"] for model in registry.describe()] == ["distilgpt2", "gpt2", "tiny"]
+    assert "notes" not in registry
+    load_model.assert_not_called()
+    
+    first = registry.get("gpt2")
+    assert registry.get("gpt2") is first
+    load_model.assert_called_once_with(str(root / "gpt2"))
+    assert registry.used_bytes == MODEL_BYTES
+
+def test_concurrent_requests_load_a_model_once(root, load_model):
+    registry = ModelRegistry(str(root), max_bytes=1000, pinned=[])
+    load_model.side_effect = lambda path: (time.sleep(0.2), (MagicMock(**{"get_memory_footprint.return_value": 1}), MagicMock(), "cpu"))[1]
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("tiny"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert load_model.call_count == 1
+    assert all(result is results[0] for result in results)
+
+def test_least_recently_used_model_is_evicted_over_budget(root, load_model):
+    registry = ModelRegistry(str(root), max_bytes=2 * MODEL_BYTES, pinned=[])
+    
+    registry.get("distilgpt2")
+    registry.get("gpt2")
+    registry.get("distilgpt2")
+    registry.get("tiny")
+    
+    loaded = {model["name"]: model["loaded"] for model in registry.describe()}
+    assert loaded == {"distilgpt2": True, "gpt2": False, "tiny": True}
+    assert registry.used_bytes == 2 * MODEL_BYTES
+
+def test_pinned_models_stay_loaded(root, load_model):
+    registry = ModelRegistry(str(root), max_bytes=2 * MODEL_BYTES, pinned=["gpt2"])
+    registry.load_pinned()
+    
+    for name in ("distilgpt2", "tiny", "distilgpt2"):
+        registry.get(name)
+    
+    loaded = {model["name"]: model["loaded"] for model in registry.describe()}
+    assert loaded == {"distilgpt2": True, "gpt2": True, "tiny": False}
+
+def test_unknown_models_are_rejected(root, load_model):
+    with pytest.raises(ValueError, match="Pinned models llama not found"):
+        ModelRegistry(str(root), pinned=["llama"])
+    
+    registry = ModelRegistry(str(root), pinned=[])
+    with pytest.raises(ValueError, match="Unknown model llama"):
+        registry.get("llama")
+
+def test_failed_load_is_a_runtime_error(root, load_model):
+    registry = ModelRegistry(str(root), max_bytes=1000, pinned=[])
+    load_model.side_effect = OSError("no weights")
+    
+    with pytest.raises(RuntimeError, match="Model tiny could not be loaded"):
+        registry.get("tiny")
+    assert registry.used_bytes == 0
+
+def test_unknown_names_rescan_the_root_at_most_once_per_interval(root, load_model):
+    registry = ModelRegistry(str(root), max_bytes=1000, pinned=[], rescan_seconds=60)
+    (root / "llama").mkdir()
+    (root / "llama" / "config.json").write_text("{}")
+    
+    with patch('registry.os.listdir', wraps=os.listdir) as listdir:
+        assert "llama" not in registry
+        assert "mistral" not in registry
+        listdir.assert_not_called()
+        
+        registry.rescan_seconds = 0
+        assert "llama" in registry
+        listdir.assert_called_once()
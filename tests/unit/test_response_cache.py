@@ -0,0 +1,137 @@
+import asyncio
+import pytest
+from unittest.mock import patch
+from dataclasses import replace
+from response_cache import ResponseCache, CacheBackend, cache_key
+from config import GenerationParams
+
+class DictBackend(CacheBackend):
+
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, ttl):
+        self.values[key] = value
+
+def test_cache_key_depends_on_model_prompt_and_params():
+    params = GenerationParams(temperature=0, max_new_tokens=10)
+    key = cache_key("model-a", "Once upon a time", params)
+    
+    assert key == cache_key("model-a", "Once upon a time", GenerationParams(temperature=0, max_new_tokens=10))
+    assert key != cache_key("model-b", "Once upon a time", params)
+    assert key != cache_key("model-a", "Once upon a time ", params)
+    assert key != cache_key("model-a", "Once upon a time", replace(params, max_new_tokens=11))
+    assert key != cache_key("model-a", "Once upon a time", replace(params, stop=("\n",)))
+    
+    # canonically equivalent unicode prompts share an entry
+    assert cache_key("model-a", "café", params) == cache_key("model-a", "café", params)
+
+def test_is_deterministic():
+    assert GenerationParams(temperature=0).deterministic
+    assert GenerationParams(temperature=0.7, seed=3).deterministic
+    assert not GenerationParams(temperature=0.7).deterministic
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_requests_generate_once():
+    cache = ResponseCache(max_entries=8, ttl=60)
+    calls = []
+    
+    async def generate():
+        calls.append(True)
+        await asyncio.sleep(0.01)
+        return "generated text"
+    
+    results = await asyncio.gather(*(cache.get_or_generate("key", generate) for _ in range(5)))
+    
+    assert results == ["generated text"] * 5
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (4, 1)
+    
+    # later requests are served from the cache
+    assert await cache.get_or_generate("key", generate) == "generated text"
+    assert len(calls) == 1
+
+@pytest.mark.asyncio
+async def test_generation_is_cancelled_once_every_caller_has_gone():
+    cache = ResponseCache(max_entries=8, ttl=60)
+    generating = asyncio.Event()
+    cancelled = asyncio.Event()
+    
+    async def generate():
+        generating.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+    
+    first = asyncio.ensure_future(cache.get_or_generate("key", generate))
+    second = asyncio.ensure_future(cache.get_or_generate("key", generate))
+    await generating.wait()
+    
+    # one caller going away leaves the generation to the other
+    first.cancel()
+    await asyncio.sleep(0.01)
+    assert not cancelled.is_set()
+    
+    second.cancel()
+    await asyncio.wait_for(cancelled.wait(), 1)
+    assert len(cache) == 0
+    
+    # nothing is left behind for the next request of the key
+    assert await cache.get_or_generate("key", lambda: asyncio.sleep(0, result="generated text")) == "generated text"
+
+@pytest.mark.asyncio
+async def test_entries_expire_after_ttl():
+    cache = ResponseCache(max_entries=8, ttl=10)
+    
+    async def generate():
+        return "generated text"
+    
+    with patch('response_cache.time.monotonic', return_value=100):
+        await cache.get_or_generate("key", generate)
+    with patch('response_cache.time.monotonic', return_value=111):
+        await cache.get_or_generate("key", generate)
+    
+    assert cache.misses == 2
+
+@pytest.mark.asyncio
+async def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2, ttl=60)
+    
+    async def generate():
+        return "generated text"
+    
+    for key in ["a", "b", "a", "c"]:
+        await cache.get_or_generate(key, generate)
+    
+    assert len(cache) == 2
+    await cache.get_or_generate("b", generate)
+    assert cache.misses == 4
+
+@pytest.mark.asyncio
+async def test_failed_generation_is_not_cached():
+    cache = ResponseCache(max_entries=8, ttl=60)
+    
+    async def fail():
+        raise RuntimeError("Model generation error")
+    
+    with pytest.raises(RuntimeError):
+        await cache.get_or_generate("key", fail)
+    assert len(cache) == 0
+
+@pytest.mark.asyncio
+async def test_shared_backend_is_consulted_and_filled():
+    backend = DictBackend()
+    backend.values["shared"] = "from another replica"
+    cache = ResponseCache(max_entries=8, ttl=60, backend=backend)
+    
+    async def generate():
+        return "generated text"
+    
+    assert await cache.get_or_generate("shared", generate) == "from another replica"
+    assert await cache.get_or_generate("local", generate) == "generated text"
+    assert backend.values["local"] == "generated text"
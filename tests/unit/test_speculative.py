@@ -0,0 +1,90 @@
+import unittest
+import torch
+from decoding import Sequence, sampling_processor
+from speculative import SpeculativeDecoder, verify_draft
+from stopping import StopTokenCriterion
+from transformers import GPT2Config, GPT2LMHeadModel
+
+EOS = 63
+
+def tiny_model(seed, n_layer=2):
+    torch.manual_seed(seed)
+    config = GPT2Config(n_layer=n_layer, n_head=2, n_embd=32, n_positions=128, vocab_size=64, bos_token_id=EOS, eos_token_id=EOS)
+    return GPT2LMHeadModel(config).eval()
+
+class TestSpeculativeDecoding(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model = tiny_model(0)
+        cls.draft_model = tiny_model(1, n_layer=1)
+
+    def reference(self, prompt_ids, max_new_tokens):
+        with torch.no_grad():
+            outputs = self.model.generate(torch.tensor([prompt_ids]), do_sample=False,
+                max_new_tokens=max_new_tokens, pad_token_id=EOS)
+        return outputs[0].tolist()
+
+    def generate(self, decoder, sequence):
+        with torch.no_grad():
+            return decoder.generate(self.model, sequence, "cpu")
+
+    def test_greedy_output_is_the_model_own(self):
+        decoder = SpeculativeDecoder(self.draft_model, draft_tokens=3)
+        sequence = Sequence([1, 2, 3, 4], 12, EOS, sampling_processor(0, 0, 1.0, 1.0), do_sample=False)
+
+        self.generate(decoder, sequence)
+
+        self.assertEqual(sequence.token_ids, self.reference([1, 2, 3, 4], 12))
+        self.assertEqual(sequence.finish_reason, "length")
+        self.assertIsNone(sequence.past)
+        self.assertGreater(decoder.drafted, 0)
+
+    def test_drafts_of_the_model_itself_are_all_accepted(self):
+        decoder = SpeculativeDecoder(self.model, draft_tokens=4)
+        sequence = Sequence([5, 6, 7], 11, EOS, sampling_processor(0, 0, 1.0, 1.0), do_sample=False)
+
+        self.generate(decoder, sequence)
+
+        self.assertEqual(sequence.token_ids, self.reference([5, 6, 7], 11))
+        # prefill gives the first token, then two steps of four drafts and one token of the model's own
+        self.assertEqual((decoder.drafted, decoder.accepted), (8, 8))
+        self.assertEqual(decoder.acceptance_rate, 1.0)
+
+    def test_stop_token_in_accepted_drafts_ends_the_sequence(self):
+        expected = self.reference([1, 2, 3, 4], 10)[4:]
+        decoder = SpeculativeDecoder(self.model, draft_tokens=4)
+        sequence = Sequence([1, 2, 3, 4], 10, EOS, sampling_processor(0, 0, 1.0, 1.0), do_sample=False,
+            stopping_criteria=[StopTokenCriterion([expected[2]])])
+
+        self.generate(decoder, sequence)
+
+        first = expected.index(expected[2])
+        self.assertEqual(sequence.generated_ids, expected[:first + 1])
+        self.assertEqual(sequence.finish_reason, "stop_token")
+
+    def test_seeded_sampling_is_reproducible(self):
+        decoder = SpeculativeDecoder(self.draft_model, draft_tokens=3)
+        outputs = []
+        for _ in range(2):
+            sequence = Sequence([1, 2, 3], 10, EOS, sampling_processor(1.0, 0, 1.0, 1.0), seed=7)
+            self.generate(decoder, sequence)
+            outputs.append(sequence.generated_ids)
+
+        self.assertEqual(len(outputs[0]), 10)
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_verified_drafts_follow_the_model_distribution(self):
+        p = torch.tensor([0.5, 0.3, 0.2, 0.0])
+        q = torch.tensor([0.1, 0.6, 0.1, 0.2])
+        generator = torch.Generator().manual_seed(0)
+
+        counts = torch.zeros(4)
+        for _ in range(20000):
+            token = int(torch.multinomial(q, num_samples=1, generator=generator))
+            counts[verify_draft(p, q, token, generator)] += 1
+
+        self.assertTrue(torch.allclose(counts / counts.sum(), p, atol=0.02))
+
+if __name__ == '__main__':
+    unittest.main()
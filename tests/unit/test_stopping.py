@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from stopping import StopStringCriterion, StopTokenCriterion, truncate_at_stop, held_back
+
+def letter_tokenizer():
+    # token ids decode to letters, one character per token
+    tokenizer = MagicMock()
+    tokenizer.decode.side_effect = lambda ids, **kwargs: "".join(chr(ord('a') + i) for i in ids)
+    return tokenizer
+
+def test_truncate_at_stop_uses_earliest_match():
+    assert truncate_at_stop("abc. def! ghi", 0, ("!", ".")) == "abc"
+    assert truncate_at_stop("abc. def! ghi", 4, ("!", ".")) == "abc. def"
+    assert truncate_at_stop("abc", 0, ("x",)) == "abc"
+
+def test_held_back_keeps_possible_stop_prefix():
+    assert held_back("hello wor", ("world",)) == 3
+    assert held_back("hello", ("world",)) == 0
+    assert held_back("ab", ("###",)) == 0
+    assert held_back("ab#", ("###", "b#!")) == 2
+
+def test_stop_string_criterion_checks_decoded_tail():
+    tokenizer = letter_tokenizer()
+    criterion = StopStringCriterion(tokenizer, ("cd",))
+    
+    assert not criterion(SimpleNamespace(generated_ids=[0, 1, 2]))
+    assert criterion(SimpleNamespace(generated_ids=[0, 1, 2, 3]))
+    
+    # only the last few tokens are decoded, however long the output gets
+    criterion(SimpleNamespace(generated_ids=list(range(20))))
+    assert tokenizer.decode.call_args.args[0] == [17, 18, 19]
+
+def test_stop_token_criterion_checks_newest_token():
+    criterion = StopTokenCriterion([7, 9])
+    
+    assert criterion(SimpleNamespace(generated_ids=[1, 9]))
+    assert not criterion(SimpleNamespace(generated_ids=[9, 1]))
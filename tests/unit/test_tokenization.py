@@ -0,0 +1,61 @@
+import pytest
+from unittest.mock import MagicMock
+from tokenization import PromptCache, encode
+from generate import generate_text
+from config import GenerationParams
+
+@pytest.fixture
+def tokenizer():
+    # one token per character, encoding a list of prompts in a single call
+    return MagicMock(side_effect=lambda prompts, **kwargs: {'input_ids': [[ord(c) for c in p][:kwargs['max_length']] for p in prompts]})
+
+def test_repeated_prompts_are_encoded_once(tokenizer):
+    cache = PromptCache(max_entries=8)
+    
+    assert encode(tokenizer, "abc", 8, cache) == [97, 98, 99]
+    assert encode(tokenizer, "abc", 8, cache) == [97, 98, 99]
+    
+    tokenizer.assert_called_once_with(["abc"], padding=False, truncation=True, max_length=8)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_misses_are_encoded_together(tokenizer):
+    cache = PromptCache(max_entries=8)
+    encode(tokenizer, "a", 8, cache)
+    
+    assert encode(tokenizer, ["a", "bc", "d", "bc"], 8, cache) == [[97], [98, 99], [100], [98, 99]]
+    
+    # the cached prompt is not encoded again, the repeated one only once
+    assert tokenizer.call_args.args[0] == ["bc", "d"]
+
+def test_truncation_length_is_part_of_the_key(tokenizer):
+    cache = PromptCache(max_entries=8)
+    
+    assert encode(tokenizer, "abcd", 2, cache) == [97, 98]
+    assert encode(tokenizer, "abcd", 8, cache) == [97, 98, 99, 100]
+
+def test_least_recently_used_prompt_is_evicted(tokenizer):
+    cache = PromptCache(max_entries=2)
+    encode(tokenizer, ["a", "b"], 8, cache)
+    encode(tokenizer, "a", 8, cache)
+    encode(tokenizer, "c", 8, cache)
+    
+    assert len(cache) == 2
+    assert cache.get("a", 8) == [97]
+    assert cache.get("b", 8) is None
+
+def test_cached_ids_cannot_be_changed_by_callers(tokenizer):
+    cache = PromptCache(max_entries=8)
+    encode(tokenizer, "ab", 8, cache).append(0)
+    
+    assert encode(tokenizer, "ab", 8, cache) == [97, 98]
+
+def test_generate_text_uses_the_prompt_cache():
+    tokenizer = MagicMock(eos_token_id=63)
+    tokenizer.decode.return_value = ""
+    cache = PromptCache(max_entries=8)
+    cache.put("hello", 512, [1, 2, 3])
+    
+    generate_text("hello", tokenizer, MagicMock(), "cpu", GenerationParams(max_new_tokens=0), prompt_cache=cache)
+    
+    tokenizer.assert_not_called()
+    assert tokenizer.decode.call_args.args[0] == [1, 2, 3]
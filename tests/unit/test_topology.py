@@ -0,0 +1,82 @@
+import pytest
+from unittest.mock import patch
+from topology import cgroup_cpu_limit, thread_settings, calibrated_threads, ThreadSettings
+from calibrate import save, thread_counts
+
+@pytest.fixture
+def host():
+    # eight cores, with whatever quota a test sets
+    with patch('topology.available_cpus', return_value=list(range(8))), \
+            patch('topology.node_type', side_effect=lambda budget: f"Xeon x{budget}"), \
+            patch('topology.cgroup_cpu_limit', return_value=None) as limit:
+        yield limit
+
+def test_cgroup_quota_is_read_from_v2_or_v1(tmp_path):
+    (tmp_path / "cpu.max").write_text("150000 100000\n")
+    assert cgroup_cpu_limit(str(tmp_path)) == 1.5
+    
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    assert cgroup_cpu_limit(str(tmp_path)) is None
+    
+    (tmp_path / "cpu.max").unlink()
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("200000\n")
+    (tmp_path / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    assert cgroup_cpu_limit(str(tmp_path)) == 2.0
+    
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+    assert cgroup_cpu_limit(str(tmp_path)) is None
+
+def test_threads_follow_the_quota_shared_between_workers(host, monkeypatch):
+    monkeypatch.delenv('TORCH_THREADS', raising=False)
+    monkeypatch.delenv('THREAD_CALIBRATION_PATH', raising=False)
+    
+    host.return_value = 1.5
+    settings = thread_settings(workers=1)
+    assert (settings.intra_op, settings.inter_op, settings.cpus) == (1, 1, (0,))
+    
+    host.return_value = 4
+    assert thread_settings(workers=2).intra_op == 2
+    
+    # without a quota every available core counts
+    host.return_value = None
+    assert thread_settings(workers=1).intra_op == 8
+    
+    # continuous batching decodes on a single thread, which gets them all
+    monkeypatch.setenv('INFERENCE_WORKERS', "2")
+    assert thread_settings().intra_op == 4
+    monkeypatch.setenv('BATCHING_MODE', "continuous")
+    assert thread_settings().intra_op == 8
+
+def test_calibration_and_environment_override_the_quota(host, monkeypatch, tmp_path):
+    path = str(tmp_path / "calibration.json")
+    save(path, "Xeon x4", {"threads": 3})
+    save(path, "Xeon x8", {"threads": 6})
+    assert calibrated_threads(path, "Xeon x8") == 6
+    assert calibrated_threads(path, "Epyc x8") is None
+    
+    host.return_value = 4
+    monkeypatch.setenv('THREAD_CALIBRATION_PATH', path)
+    monkeypatch.delenv('TORCH_THREADS', raising=False)
+    assert thread_settings(workers=1).intra_op == 3
+    
+    monkeypatch.setenv('TORCH_THREADS', "2")
+    settings = thread_settings(workers=1)
+    assert (settings.intra_op, settings.source) == (2, "TORCH_THREADS")
+
+def test_each_worker_is_pinned_to_its_own_cores():
+    settings = ThreadSettings(intra_op=2, inter_op=1, cpus=(4, 5, 6, 7), pinned=True, source="test")
+    
+    assert [settings.worker_cpus(worker) for worker in range(3)] == [{4, 5}, {6, 7}, {4, 5}]
+    with patch('topology.os.sched_setaffinity', create=True) as setaffinity:
+        pin = settings.pinner()
+        pin()
+        pin()
+    assert [call.args for call in setaffinity.call_args_list] == [(0, {4, 5}), (0, {6, 7})]
+    
+    assert ThreadSettings(2, 1, (0, 1), pinned=False, source="test").pinner() is None
+
+def test_calibration_tries_powers_of_two_up_to_the_budget():
+    assert thread_counts(1) == [1]
+    assert thread_counts(6) == [1, 2, 4, 6]
+    assert thread_counts(8) == [1, 2, 4, 8]
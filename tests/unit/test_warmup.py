@@ -0,0 +1,64 @@
+import pytest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+from config import GenerationParams, ServiceConfig
+from executor import InferenceExecutor
+from warmup import warm_up, synthetic_prompt
+
+@pytest.fixture
+def state():
+    # one token per character keeps prompt lengths easy to check
+    tokenizer = MagicMock(side_effect=lambda text, **kwargs: {'input_ids': list(text)})
+    tokenizer.decode.side_effect = lambda ids, **kwargs: "".join(ids)
+    
+    executor = InferenceExecutor(max_workers=1, max_queue_depth=3, retry_after=1)
+    yield SimpleNamespace(tokenizer=tokenizer, model="model", device="cpu", executor=executor,
+        config=ServiceConfig(GenerationParams(), max_new_tokens_limit=50),
+        batcher=None, prefix_cache=MagicMock(), ready=False)
+    executor.shutdown()
+
+def test_synthetic_prompt_has_requested_length(state):
+    assert len(synthetic_prompt(state.tokenizer, 5)) == 5
+    assert len(synthetic_prompt(state.tokenizer, 300)) == 300
+
+@pytest.mark.asyncio
+async def test_warm_up_runs_each_batch_size_and_length(state):
+    mock_generate_text = MagicMock(return_value="generated")
+    
+    with patch('warmup.generate_text', new=mock_generate_text), \
+            patch.dict('os.environ', {'WARMUP_BATCH_SIZES': "1,4", 'WARMUP_PROMPT_LENGTHS': "4,16", 'WARMUP_MAX_NEW_TOKENS': "2"}):
+        await warm_up(state)
+    
+    # the batch of 4 is capped at the queue depth of 3
+    prompts = [call.args[0] for call in mock_generate_text.call_args_list]
+    assert [len(p) for p in prompts] == [4] * 4 + [16] * 4
+    assert mock_generate_text.call_args.args[4].max_new_tokens == 2
+    state.prefix_cache.clear.assert_called_once()
+    assert state.ready
+
+@pytest.mark.asyncio
+async def test_failed_warm_up_is_retried_with_backoff(state):
+    mock_generate_text = MagicMock(side_effect=[RuntimeError("Model generation error"), "generated", "generated"])
+    
+    with patch('warmup.generate_text', new=mock_generate_text), patch('warmup.asyncio.sleep') as mock_sleep, \
+            patch.dict('os.environ', {'WARMUP_BATCH_SIZES': "1", 'WARMUP_PROMPT_LENGTHS': "4,16", 'WARMUP_RETRY_BACKOFF': "2"}):
+        await warm_up(state)
+    
+    mock_sleep.assert_called_once_with(2)
+    assert state.ready
+    assert not getattr(state, 'warmup_failed', False)
+
+@pytest.mark.asyncio
+async def test_warm_up_failing_every_attempt_makes_the_pod_unhealthy(state):
+    mock_generate_text = MagicMock(side_effect=RuntimeError("Model generation error"))
+    
+    with patch('warmup.generate_text', new=mock_generate_text), patch('warmup.asyncio.sleep') as mock_sleep, \
+            patch('warmup.logger') as mock_logger, patch.dict('os.environ', {'WARMUP_ATTEMPTS': "3", 'WARMUP_RETRY_BACKOFF': "1"}):
+        await warm_up(state)
+    
+    # waiting twice as long before each retry
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [1, 2]
+    mock_logger.error.assert_called_once_with("Warm-up failed 3 times, the service is unhealthy: Model generation error")
+    assert not state.ready
+    assert state.warmup_failed
+    assert state.prefix_cache.clear.call_count == 3
@@ -0,0 +1,38 @@
+import json
+import torch
+from safetensors.torch import load_file
+from transformers import GPT2Config, GPT2LMHeadModel
+from weights import MANIFEST_FILE, build_manifest, write_manifest, read_manifest, mmap_state_dict
+
+def save_tiny_model(path):
+    torch.manual_seed(0)
+    config = GPT2Config(n_layer=2, n_head=2, n_embd=32, n_positions=128, vocab_size=64, bos_token_id=63, eos_token_id=63)
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return path
+
+def test_manifest_covers_every_tensor(tmp_path):
+    manifest = write_manifest(save_tiny_model(tmp_path))
+    expected = load_file(tmp_path / "model.safetensors")
+    
+    assert set(manifest["tensors"]) == set(expected)
+    assert manifest["total_bytes"] == sum(t.nbytes for t in expected.values())
+    assert len(manifest["files"]["model.safetensors"]["sha256"]) == 64
+    assert json.loads((tmp_path / MANIFEST_FILE).read_text()) == manifest
+
+def test_stale_manifest_is_rebuilt(tmp_path):
+    write_manifest(save_tiny_model(tmp_path))
+    manifest = json.loads((tmp_path / MANIFEST_FILE).read_text())
+    manifest["files"]["model.safetensors"]["size"] += 1
+    (tmp_path / MANIFEST_FILE).write_text(json.dumps(manifest))
+    
+    assert read_manifest(tmp_path) == build_manifest(tmp_path, checksums=False)
+
+def test_mmap_state_dict_matches_safetensors(tmp_path):
+    save_tiny_model(tmp_path)
+    state_dict = mmap_state_dict(tmp_path, read_manifest(tmp_path))
+    expected = load_file(tmp_path / "model.safetensors")
+    
+    assert set(state_dict) == set(expected)
+    for key, tensor in expected.items():
+        assert state_dict[key].dtype == tensor.dtype
+        assert torch.equal(state_dict[key], tensor)